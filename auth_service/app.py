@@ -1,10 +1,19 @@
 from flask import Flask, request, jsonify, redirect, url_for, session
-from flask_jwt_extended import JWTManager, create_access_token, decode_token
+from flask_jwt_extended import JWTManager, create_access_token
 from datetime import timedelta
-from models.user_model import create_user, find_user, update_token, check_password
+from models.user_model import (
+    create_user, find_user, record_login_token, check_password, rehash_password_if_needed,
+    password_hasher, token_audit, INDEXES
+)
+from password_hasher import HasherBusyError
+from models.revocation_model import revoke_token, get_revocations_since, REVOCATION_INDEXES
+from token_verifier import TokenVerifier
+from revocation import RevocationList
 from service_registry import register_service
+from index_manager import ensure_indexes
 from config import *
 import consul
+import hmac
 
 app = Flask(__name__)
 app.secret_key = "auth_secret"
@@ -13,11 +22,50 @@ app.secret_key = "auth_secret"
 app.config["JWT_SECRET_KEY"] = JWT_SECRET
 jwt = JWTManager(app)
 
+# jti đã thu hồi (Bloom filter + tập chính xác trong bộ nhớ, cập nhật dần từ MongoDB)
+revocations = RevocationList(get_revocations_since, interval=REVOCATION_REFRESH_INTERVAL)
+
+# Token đã giải mã được cache tới khi hết hạn, token lặp lại không phải kiểm tra chữ ký lần nữa
+token_verifier = TokenVerifier(JWT_SECRET, max_size=TOKEN_CACHE_SIZE, revocations=revocations)
+
+
+def is_service_request():
+    """Request từ service khác (header X-Service-Token khớp SERVICE_TOKEN)"""
+    return hmac.compare_digest(request.headers.get("X-Service-Token", ""), SERVICE_TOKEN)
+
+
 @app.route("/health")
 def health():
     return jsonify({"status": "UP"}), 200
 
 
+@app.route("/internal/stats")
+def internal_stats():
+    """Trạng thái process pool bcrypt và hàng chờ ghi token"""
+    return jsonify({
+        "bcrypt": password_hasher.stats(),
+        "token_audit": token_audit.stats(),
+        "token_cache": token_verifier.stats(),
+        "revocations": revocations.stats()
+    }), 200
+
+
+@app.route("/internal/revocations")
+def internal_revocations():
+    """GET /internal/revocations?since= - Các jti bị thu hồi (còn hạn) từ mốc since, cho các service khác"""
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    since = request.args.get("since", type=float)
+    return jsonify({"revocations": get_revocations_since(since)}), 200
+
+
+@app.errorhandler(HasherBusyError)
+def handle_hasher_busy(e):
+    response = jsonify({"error": "Hệ thống đang quá tải, vui lòng thử lại sau"})
+    response.headers["Retry-After"] = str(BCRYPT_RETRY_AFTER)
+    return response, 503
+
+
 # ---------------- API Endpoints ----------------
 # Frontend đã được tách ra thư mục frontend riêng
 # Các routes chỉ trả về JSON, không render template nữa
@@ -32,10 +80,10 @@ def register():
     if not username or not password:
         return jsonify({"error": "Thiếu thông tin đăng nhập!"}), 400
 
-    if find_user(username):
+    # Index unique username: insert trùng -> None
+    if not create_user(username, password):
         return jsonify({"error": "Tên đăng nhập đã tồn tại!"}), 400
 
-    create_user(username, password)
     return jsonify({"message": "Đăng ký thành công"}), 201
 
 
@@ -57,9 +105,15 @@ def login():
     if not check_password(password, user["password"]):
         return jsonify({"error": "Sai mật khẩu!"}), 401
 
+    # Cost factor đã đổi -> tạo lại hash (bỏ qua nếu pool đang quá tải, lần đăng nhập sau sẽ thử lại)
+    try:
+        rehash_password_if_needed(username, password, user["password"])
+    except HasherBusyError:
+        pass
+
     # Tạo JWT token
     token = create_access_token(identity=username, expires_delta=timedelta(hours=1))
-    update_token(username, token)
+    record_login_token(username, token)
 
     session["username"] = username
     session["token"] = token
@@ -78,13 +132,57 @@ def verify_token():
     if not token:
         return jsonify({"error": "Thiếu token"}), 401
 
-    try:
-        decode_token(token)
-        return jsonify({"valid": True}), 200
-    except Exception as e:
-        return jsonify({"valid": False, "error": str(e)}), 401
+    if token_verifier.verify(token) is None:
+        return jsonify({"valid": False, "error": "Token không hợp lệ hoặc đã hết hạn"}), 401
+    return jsonify({"valid": True}), 200
+
+
+@app.route("/auth/revoke", methods=["POST"])
+def revoke():
+    """Thu hồi token (đăng xuất): token trong body {"token"} hoặc header Authorization"""
+    data = request.get_json(silent=True) or {}
+    token = data.get("token") or request.headers.get("Authorization")
+    if not token:
+        return jsonify({"error": "Thiếu token"}), 401
+
+    claims = token_verifier.verify(token)
+    if claims is None:
+        return jsonify({"error": "Token không hợp lệ, đã hết hạn hoặc đã bị thu hồi"}), 401
+    if not claims.get("jti"):
+        return jsonify({"error": "Token không có jti"}), 400
+
+    revoke_token(claims["jti"], claims["exp"], claims.get("sub"))
+    # Có hiệu lực ngay trên instance này, các instance/service khác nhận qua lần refresh kế tiếp
+    revocations.add(claims["jti"], claims["exp"])
+    if session.get("token") and token.endswith(session["token"]):
+        session.clear()
+    return jsonify({"message": "Đã thu hồi token"}), 200
+
+
+@app.route("/auth/verify/batch", methods=["POST"])
+def verify_token_batch():
+    """Xác thực nhiều token trong một request: {"tokens": [...]} -> kết quả theo đúng thứ tự"""
+    data = request.get_json()
+    if not data or not isinstance(data.get("tokens"), list):
+        return jsonify({"error": "Thiếu danh sách tokens"}), 400
+    if len(data["tokens"]) > VERIFY_BATCH_MAX:
+        return jsonify({"error": f"Tối đa {VERIFY_BATCH_MAX} token mỗi lần"}), 400
+
+    results = []
+    for token in data["tokens"]:
+        claims = token_verifier.verify(token) if isinstance(token, str) else None
+        if claims is None:
+            results.append({"valid": False})
+        else:
+            results.append({"valid": True, "username": claims.get("sub"), "exp": claims.get("exp")})
+    return jsonify({"results": results}), 200
 
 
 if __name__ == "__main__":
+    ensure_indexes(INDEXES + REVOCATION_INDEXES)
+    password_hasher.start()
+    revocations.start()
+    if TOKEN_AUDIT_MODE == "write_behind":
+        token_audit.start()
     register_service()
     app.run(host="0.0.0.0", port=SERVICE_PORT, debug=True)
@@ -0,0 +1,47 @@
+"""Đo throughput đăng nhập (bcrypt checkpw trên process pool) theo từng cost factor.
+
+Chạy: python benchmark_bcrypt.py [cost ...] [--logins N] [--concurrency C] [--workers W]
+Ví dụ: python benchmark_bcrypt.py 10 11 12 --logins 200 --concurrency 16
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from password_hasher import PasswordHasher, HasherBusyError
+
+
+def run(rounds, logins, concurrency, workers):
+    hasher = PasswordHasher(workers=workers, max_pending=concurrency, rounds=rounds, timeout=60)
+    hasher.start()
+    hashed = hasher.hash("benchmark-password")
+
+    def login(_):
+        try:
+            return hasher.check("benchmark-password", hashed)
+        except HasherBusyError:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+    hasher.start().shutdown()
+
+    ok = sum(1 for r in results if r)
+    print(f"[BENCH] cost={rounds}: {ok}/{logins} logins in {elapsed:.2f}s "
+          f"-> {ok / elapsed:.1f} logins/s ({hasher.workers} workers, {hasher.rejected} rejected)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("costs", nargs="*", type=int, default=[10, 11, 12])
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    for rounds in args.costs:
+        run(rounds, args.logins, args.concurrency, args.workers)
+
+
+if __name__ == "__main__":
+    main()
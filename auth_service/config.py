@@ -6,3 +6,27 @@ SERVICE_PORT = int(os.getenv("SERVICE_PORT", "5000"))
 JWT_SECRET = os.getenv("JWT_SECRET", "mysecretkey")
 CONSUL_HOST = os.getenv("CONSUL_HOST", "localhost")
 CONSUL_PORT = int(os.getenv("CONSUL_PORT", "8500"))
+# Khoá dùng chung giữa các service cho API nội bộ (header X-Service-Token)
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "myservicetoken")
+
+# bcrypt: cost factor (đổi cost thì hash cũ được tạo lại khi user đăng nhập)
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Process pool chạy bcrypt, mặc định bằng số CPU
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "0")) or None
+# Số việc bcrypt tối đa đang chờ/chạy, vượt quá trả về 503 + Retry-After
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", "0")) or None
+BCRYPT_TIMEOUT = float(os.getenv("BCRYPT_TIMEOUT", "10"))
+BCRYPT_RETRY_AFTER = int(os.getenv("BCRYPT_RETRY_AFTER", "1"))
+
+# Ghi token vào user khi đăng nhập (không dùng để xác thực):
+# "off" (mặc định, đăng nhập không ghi DB), "sync" (ghi ngay như trước), "write_behind" (ghi theo lô)
+TOKEN_AUDIT_MODE = os.getenv("TOKEN_AUDIT_MODE", "off")
+TOKEN_AUDIT_FLUSH_INTERVAL = float(os.getenv("TOKEN_AUDIT_FLUSH_INTERVAL", "1"))
+
+# Cache token đã giải mã (dùng chung cho /auth/verify và /auth/verify/batch)
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+# Số token tối đa trong một lời gọi /auth/verify/batch
+VERIFY_BATCH_MAX = int(os.getenv("VERIFY_BATCH_MAX", "1000"))
+
+# Thu hồi token: các instance cập nhật danh sách thu hồi mỗi REVOCATION_REFRESH_INTERVAL giây
+REVOCATION_REFRESH_INTERVAL = float(os.getenv("REVOCATION_REFRESH_INTERVAL", "5"))
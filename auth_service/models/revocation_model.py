@@ -0,0 +1,51 @@
+from pymongo import IndexModel, ASCENDING
+from datetime import datetime
+from models.user_model import db
+
+revoked_tokens = db["revoked_tokens"]
+
+REVOCATION_INDEXES = [
+    (revoked_tokens, [
+        IndexModel([("jti", ASCENDING)], name="jti_unique", unique=True),
+        # MongoDB tự xóa bản ghi khi token hết hạn (TTL index)
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+        # Các verifier lấy thu hồi mới theo revoked_at
+        IndexModel([("revoked_at", ASCENDING)], name="revoked_at"),
+    ]),
+]
+
+
+def revoke_token(jti, exp, username=None):
+    """Ghi nhận token (jti) bị thu hồi tới khi hết hạn exp (epoch giây). Gọi lại nhiều lần không sao"""
+    now = datetime.utcnow()
+    revoked_tokens.update_one(
+        {"jti": jti},
+        {"$setOnInsert": {
+            "jti": jti,
+            "username": username,
+            "expires_at": datetime.utcfromtimestamp(exp),
+            "revoked_at": now
+        }},
+        upsert=True
+    )
+
+
+def get_revocations_since(since=None):
+    """Các thu hồi còn hạn có revoked_at >= since (epoch giây, None: tất cả)"""
+    now = datetime.utcnow()
+    query = {"expires_at": {"$gt": now}}
+    if since is not None:
+        query["revoked_at"] = {"$gte": datetime.utcfromtimestamp(since)}
+    cursor = revoked_tokens.find(query, {"_id": 0, "jti": 1, "expires_at": 1, "revoked_at": 1})
+    return [
+        {
+            "jti": entry["jti"],
+            "exp": _epoch(entry["expires_at"]),
+            "revoked_at": _epoch(entry["revoked_at"])
+        }
+        for entry in cursor
+    ]
+
+
+def _epoch(value):
+    return (value - datetime(1970, 1, 1)).total_seconds()
@@ -1,25 +1,58 @@
-from pymongo import MongoClient
-from config import MONGO_URI
-import bcrypt
+from pymongo import MongoClient, IndexModel, ASCENDING
+from pymongo.errors import DuplicateKeyError
+from config import (
+    MONGO_URI, BCRYPT_ROUNDS, BCRYPT_WORKERS, BCRYPT_MAX_PENDING, BCRYPT_TIMEOUT,
+    TOKEN_AUDIT_MODE, TOKEN_AUDIT_FLUSH_INTERVAL
+)
+from password_hasher import PasswordHasher
+from token_audit import TokenAuditWriter
 
 # Kết nối MongoDB
 client = MongoClient(MONGO_URI)
 db = client["userdb"]
 users = db["users"]
 
+# Index khai báo (tạo khi khởi động / python index_manager.py)
+INDEXES = [
+    (users, [IndexModel([("username", ASCENDING)], name="username_unique", unique=True)]),
+]
+
+# bcrypt chạy trên process pool riêng (raise HasherBusyError khi quá tải)
+password_hasher = PasswordHasher(
+    workers=BCRYPT_WORKERS,
+    max_pending=BCRYPT_MAX_PENDING,
+    rounds=BCRYPT_ROUNDS,
+    timeout=BCRYPT_TIMEOUT
+)
+
 def hash_password(password):
     """Mã hoá mật khẩu bằng bcrypt"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return password_hasher.hash(password)
 
 def check_password(password, hashed):
     """Kiểm tra mật khẩu có khớp với hash hay không"""
-    return bcrypt.checkpw(password.encode('utf-8'), hashed)
+    return password_hasher.check(password, hashed)
+
+def rehash_password_if_needed(username, password, hashed):
+    """Tạo lại hash nếu cost factor đã đổi (gọi sau khi đăng nhập đúng mật khẩu)"""
+    if not password_hasher.needs_rehash(hashed):
+        return False
+    new_hash = hash_password(password)
+    # Chỉ ghi nếu hash chưa bị đổi bởi request khác
+    result = users.update_one({"username": username, "password": hashed}, {"$set": {"password": new_hash}})
+    return result.modified_count > 0
 
 def create_user(username, password):
-    """Tạo user mới với mật khẩu đã hash"""
+    """Tạo user mới với mật khẩu đã hash.
+
+    Một lệnh insert dựa trên index unique username; trả về None nếu username đã tồn tại.
+    """
     hashed_pw = hash_password(password)
     user = {"username": username, "password": hashed_pw, "token": ""}
-    users.insert_one(user)
+    try:
+        users.insert_one(user)
+    except DuplicateKeyError:
+        return None
     return user
 
 def find_user(username):
@@ -29,3 +62,13 @@ def find_user(username):
 def update_token(username, token):
     """Cập nhật JWT token cho user"""
     users.update_one({"username": username}, {"$set": {"token": token}})
+
+# Token chỉ được ghi để audit, không dùng khi xác thực
+token_audit = TokenAuditWriter(users, interval=TOKEN_AUDIT_FLUSH_INTERVAL)
+
+def record_login_token(username, token):
+    """Ghi token đăng nhập theo TOKEN_AUDIT_MODE (off: không ghi DB)"""
+    if TOKEN_AUDIT_MODE == "sync":
+        update_token(username, token)
+    elif TOKEN_AUDIT_MODE == "write_behind":
+        token_audit.record(username, token)
@@ -0,0 +1,93 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+
+class HasherBusyError(Exception):
+    """Hàng đợi bcrypt đã đầy hoặc quá thời gian chờ -> trả về 503 + Retry-After"""
+
+
+# Hai hàm chạy trong process con (phải ở mức module để pickle được)
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+class PasswordHasher:
+    """Chạy bcrypt trên process pool riêng, không chiếm CPU/GIL của thread xử lý request.
+
+    Số việc đang chờ + đang chạy bị giới hạn bởi max_pending; vượt quá thì raise
+    HasherBusyError ngay (load shedding) thay vì xếp hàng vô hạn.
+    """
+
+    def __init__(self, workers=None, max_pending=None, rounds=12, timeout=10):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 4
+        self.rounds = rounds
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+
+    def start(self):
+        """Tạo process pool (gọi khi khởi động để không fork giữa lúc đang phục vụ request)"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _release_slot(self, future=None):
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusyError("Hàng đợi bcrypt đã đầy")
+        with self._lock:
+            self.pending += 1
+        try:
+            future = self.start().submit(fn, *args)
+        except Exception:
+            self._release_slot()
+            raise
+        # Slot chỉ được trả khi job thực sự kết thúc (xong, lỗi hoặc bị huỷ), không phải
+        # khi request hết thời gian chờ: job bcrypt có thể vẫn đang chạy trong process con
+        future.add_done_callback(self._release_slot)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HasherBusyError("bcrypt quá thời gian chờ")
+
+    def hash(self, password):
+        return self._run(_hashpw, password.encode("utf-8"), self.rounds)
+
+    def check(self, password, hashed):
+        return self._run(_checkpw, password.encode("utf-8"), hashed)
+
+    def needs_rehash(self, hashed):
+        """Hash được tạo với cost khác BCRYPT_ROUNDS hiện tại ($2b$<cost>$...)"""
+        try:
+            return int(hashed.split(b"$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "rounds": self.rounds,
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "rejected": self.rejected
+            }
@@ -0,0 +1,64 @@
+import threading
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+
+class TokenAuditWriter:
+    """Ghi token đăng nhập vào user theo lô (write-behind) thay vì một lệnh update mỗi lần đăng nhập.
+
+    Mỗi user chỉ giữ token mới nhất chờ ghi; thread nền ghi bằng một bulk_write
+    sau mỗi `interval` giây. Vượt quá max_pending user chờ ghi thì bỏ bớt (audit không chặn đăng nhập).
+    """
+
+    def __init__(self, collection, interval=1.0, max_pending=10000):
+        self.collection = collection
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}  # username -> (token, issued_at)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def record(self, username, token):
+        with self._lock:
+            if username not in self._pending and len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending[username] = (token, datetime.utcnow())
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            self.collection.bulk_write([
+                UpdateOne({"username": username}, {"$set": {"token": token, "token_issued_at": issued_at}})
+                for username, (token, issued_at) in pending.items()
+            ], ordered=False)
+        except Exception:
+            # Ghi lại vào hàng chờ, token mới hơn (nếu có) được giữ
+            with self._lock:
+                for username, entry in pending.items():
+                    self._pending.setdefault(username, entry)
+            raise
+        with self._lock:
+            self.written += len(pending)
+        return len(pending)
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"[AUDIT] Ghi token lỗi: {e}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {"pending": len(self._pending), "written": self.written, "dropped": self.dropped}
@@ -0,0 +1,109 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+
+class TokenVerifier:
+    """Xác thực JWT tại chỗ (cùng JWT_SECRET với Auth Service) kèm cache token đã xác thực.
+
+    mode="local": kiểm tra chữ ký và hạn dùng ngay trong process.
+    mode="remote": gọi POST /auth/verify của Auth Service như trước đây.
+    Cả hai chế độ đều lưu kết quả hợp lệ vào cache LRU cho tới khi token hết hạn (exp).
+    revocations (RevocationList, tuỳ chọn): token có jti đã bị thu hồi là không hợp lệ,
+    kể cả khi claims đang nằm trong cache.
+    """
+
+    def __init__(self, secret, mode="local", max_size=10000, remote_verify=None, revocations=None):
+        self.secret = secret
+        self.mode = mode
+        self.max_size = max_size
+        self.remote_verify = remote_verify  # hàm token -> bool, gọi Auth Service
+        self.revocations = revocations
+        self._cache = OrderedDict()  # sha256(token) -> (claims, exp)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(token):
+        if token and token.startswith("Bearer "):
+            return token[len("Bearer "):]
+        return token
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    # ---- Cache ----
+    def _cache_get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            claims, exp = entry
+            if exp <= time.time():
+                # Token đã hết hạn -> loại khỏi cache
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return claims
+
+    def _cache_put(self, key, claims):
+        exp = claims.get("exp")
+        if not exp:
+            return
+        with self._lock:
+            self._cache[key] = (claims, exp)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_size:
+                self._purge_expired()
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def _purge_expired(self):
+        now = time.time()
+        for key in [k for k, (_, exp) in self._cache.items() if exp <= now]:
+            del self._cache[key]
+
+    # ---- Verify ----
+    def _verify_local(self, token):
+        try:
+            return jwt.decode(token, self.secret, algorithms=["HS256"])
+        except jwt.PyJWTError:
+            return None
+
+    def _verify_remote(self, token):
+        if not self.remote_verify or not self.remote_verify(token):
+            return None
+
+        # Auth Service đã xác thực, chỉ đọc claims để biết exp
+        try:
+            return jwt.decode(token, options={"verify_signature": False})
+        except jwt.PyJWTError:
+            return None
+
+    def verify(self, token):
+        """Trả về claims nếu token hợp lệ, ngược lại trả về None"""
+        token = self._normalize(token)
+        if not token:
+            return None
+
+        key = self._key(token)
+        claims = self._cache_get(key)
+        if claims is None:
+            if self.mode == "remote":
+                claims = self._verify_remote(token)
+            else:
+                claims = self._verify_local(token)
+            if claims is None:
+                return None
+            self._cache_put(key, claims)
+
+        if self.revocations and self.revocations.is_revoked(claims.get("jti")):
+            return None
+        return claims
+
+    def stats(self):
+        with self._lock:
+            return {"mode": self.mode, "size": len(self._cache), "max_size": self.max_size}
@@ -30,7 +30,9 @@ function checkAdminAuth() {
     });
 }
 
-function logout() {
+async function logout() {
+    // Thu hồi token phía server; lỗi mạng không chặn việc đăng xuất
+    await authAPI.revokeToken().catch(() => {});
     removeToken();
     window.location.href = 'index.html';
 }
@@ -84,6 +84,12 @@ const authAPI = {
                 'Authorization': token
             }
         });
+    },
+
+    async revokeToken() {
+        return apiRequest('/auth/revoke', {
+            method: 'POST'
+        });
     }
 };
 
@@ -117,20 +117,8 @@ async function checkout() {
         const order = await ordersAPI.create(orderData);
         console.log('Order created:', order);
 
-        // 2. Update Product Quantity (Stock)
-        // Note: The order service might check stock but doesn't update it automatically in this architecture 
-        // (based on my analysis of order_service/app.py, it checks stock but doesn't call product service to reduce it? 
-        // Wait, let me re-read order_service/app.py. 
-        // It calls check_product_stock but NOT reduce_quantity. 
-        // So we must do it here or Order Service should have done it. 
-        // The prompt says "Cập nhật lại số lượng sp... API: PUT localhost:***1/products/id".
-        // So client must do it.
-        
-        for (const item of cart) {
-            // Calculate new quantity
-            const newQty = item.maxQuantity - item.quantity;
-            await productsAPI.update(item.id, { quantity: newQty });
-        }
+        // 2. Stock is reserved and deducted by the Order Service when the order is created
+        // (POST /products/reservations), so no separate quantity update is needed here.
 
         // 3. Update Order Status (Simulate Payment/Shipping)
         await ordersAPI.update(order.id, { status: 'completed' });
@@ -22,7 +22,9 @@ function checkUserAuth() {
     }
 }
 
-function logout() {
+async function logout() {
+    // Thu hồi token phía server; lỗi mạng không chặn việc đăng xuất
+    await authAPI.revokeToken().catch(() => {});
     removeToken();
     window.location.href = 'index.html';
 }
@@ -1,62 +1,159 @@
 from flask import Flask, jsonify, request, session
 from service_registry import register_service
+from index_manager import ensure_indexes
+from service_discovery import ServiceDiscovery
+from token_verifier import TokenVerifier
+from revocation import RevocationList
+from http_client import ServiceClient, ServiceUnavailableError
 from models.order_model import *
+from pymongo.errors import DuplicateKeyError
 from config import *
-import requests
-import consul
+from datetime import datetime
+import hmac
+import threading
+import time
 
 app = Flask(__name__)
 app.secret_key = "order_secret"
 
 # ---- Consul Service Discovery ----
-def get_service_url(service_name):
-    """Lấy URL của service từ Consul"""
-    c = consul.Consul(host=CONSUL_HOST, port=CONSUL_PORT)
-    services = c.agent.services()
-    for s in services.values():
-        if s["Service"] == service_name:
-            return f"http://{s['Address']}:{s['Port']}"
-    return None
+discovery = ServiceDiscovery(CONSUL_HOST, CONSUL_PORT, strategy=DISCOVERY_STRATEGY, wait=DISCOVERY_WAIT)
 
 
-def verify_token(token):
-    """Xác thực token qua Auth Service"""
-    auth_url = get_service_url(AUTH_SERVICE_NAME)
-    if not auth_url:
+# ---- HTTP client giữa các service (connection pool + circuit breaker) ----
+http_client = ServiceClient(
+    discovery,
+    pool_size=HTTP_POOL_SIZE,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+    max_retries=HTTP_MAX_RETRIES,
+    retry_budget_ratio=HTTP_RETRY_BUDGET_RATIO,
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=BREAKER_RESET_TIMEOUT,
+    service_token=SERVICE_TOKEN
+)
+
+
+def verify_token_remote(token):
+    """Xác thực token qua Auth Service (TOKEN_VERIFY_MODE=remote)"""
+    try:
+        response = http_client.post(AUTH_SERVICE_NAME, "/auth/verify", headers={"Authorization": token})
+        return response.json().get("valid", False)
+    except (ServiceUnavailableError, ValueError):
         return False
-    
+
+
+def fetch_revocations(since):
+    """Lấy các jti bị thu hồi từ Auth Service (GET /internal/revocations)"""
+    params = {"since": since} if since is not None else {}
+    response = http_client.get(AUTH_SERVICE_NAME, "/internal/revocations", params=params)
+    if response.status_code != 200:
+        raise ServiceUnavailableError(f"{AUTH_SERVICE_NAME}: HTTP {response.status_code}")
+    return response.json()["revocations"]
+
+
+# Kiểm tra thu hồi trong bộ nhớ (Bloom filter + tập chính xác), không gọi Auth Service mỗi request
+revocations = RevocationList(fetch_revocations, interval=REVOCATION_REFRESH_INTERVAL)
+
+token_verifier = TokenVerifier(
+    JWT_SECRET,
+    mode=TOKEN_VERIFY_MODE,
+    max_size=TOKEN_CACHE_SIZE,
+    remote_verify=verify_token_remote,
+    revocations=revocations
+)
+
+
+def is_service_request():
+    """Request từ service khác (header X-Service-Token khớp SERVICE_TOKEN)"""
+    return hmac.compare_digest(request.headers.get("X-Service-Token", ""), SERVICE_TOKEN)
+
+
+def verify_token(token):
+    """Xác thực token (tại chỗ hoặc qua Auth Service tuỳ TOKEN_VERIFY_MODE)"""
+    return token_verifier.verify(token) is not None
+
+
+def reserve_stock(items, order_id=None):
+    """Giữ hàng cho các item qua Product Service (một lời gọi, nguyên tử cho cả đơn).
+
+    Trả về (reservation_id, None) hoặc (None, (status_code, message)).
+    """
+    payload = {
+        "items": [{"product_id": item["product_id"], "quantity": item["quantity"]} for item in items],
+        "order_id": order_id
+    }
+    try:
+        response = http_client.post(PRODUCT_SERVICE_NAME, "/products/reservations", json=payload)
+    except ServiceUnavailableError as e:
+        return None, (503, f"Lỗi kết nối Product Service ({e})")
+
+    result = response.json()
+    if response.status_code == 201:
+        return result["id"], None
+    if response.status_code == 409 and result.get("product_id") is not None:
+        return None, (400, f"Sản phẩm {result['product_id']}: {result['error']}")
+    return None, (400, result.get("error", "Lỗi khi giữ hàng"))
+
+
+def _try_commit_stock_reservation(reservation_id, order_id):
+    """Gửi commit một lần. Trả về False nếu lỗi tạm thời (nên thử lại)"""
     try:
-        response = requests.post(
-            f"{auth_url}/auth/verify",
-            headers={"Authorization": token},
-            timeout=5
+        response = http_client.post(
+            PRODUCT_SERVICE_NAME, f"/products/reservations/{reservation_id}/commit",
+            json={"order_id": order_id}
         )
-        return response.json().get("valid", False)
-    except:
+    except ServiceUnavailableError as e:
+        print(f"[RESERVATION] Commit {reservation_id} lỗi: {e}")
         return False
+    if response.status_code != 200:
+        # Reservation đã hết hạn/bị huỷ: thử lại cũng không được
+        print(f"[RESERVATION] Commit {reservation_id} thất bại: {response.status_code}")
+    return True
 
 
-def check_product_stock(product_id, quantity):
-    """Kiểm tra tồn kho sản phẩm từ Product Service"""
-    product_url = get_service_url(PRODUCT_SERVICE_NAME)
-    if not product_url:
-        return {"available": False, "message": "Không tìm thấy Product Service"}
-    
+def _retry_commit_stock_reservation(reservation_id, order_id):
+    deadline = time.time() + RESERVATION_COMMIT_RETRY_WINDOW
+    while time.time() < deadline:
+        time.sleep(RESERVATION_COMMIT_RETRY_INTERVAL)
+        if _try_commit_stock_reservation(reservation_id, order_id):
+            return
+    print(f"[RESERVATION] Commit {reservation_id} (đơn hàng {order_id}) không thành công sau "
+          f"{RESERVATION_COMMIT_RETRY_WINDOW:.0f}s, cần đối soát tồn kho")
+
+
+def commit_stock_reservation(reservation_id, order_id):
+    """Xác nhận giữ hàng sau khi đã ghi đơn hàng.
+
+    Đơn hàng đã được ghi nên commit phải tới được Product Service: nếu không, reservation hết
+    hạn và sweeper trả lại số hàng đã bán. Lỗi tạm thời được thử lại trên thread nền (commit
+    là idempotent nên gửi lại sau khi response bị mất vẫn an toàn).
+    """
+    if not _try_commit_stock_reservation(reservation_id, order_id):
+        threading.Thread(
+            target=_retry_commit_stock_reservation, args=(reservation_id, order_id), daemon=True
+        ).start()
+
+
+def release_stock_reservation(reservation_id):
+    """Huỷ giữ hàng khi không ghi được đơn hàng"""
     try:
-        response = requests.get(f"{product_url}/products/{product_id}", timeout=5)
-        if response.status_code == 200:
-            product = response.json()
-            if product["quantity"] >= quantity:
-                return {"available": True, "product": product}
-            else:
-                return {
-                    "available": False,
-                    "message": f"Không đủ hàng. Tồn kho: {product['quantity']}"
-                }
-        else:
-            return {"available": False, "message": "Sản phẩm không tồn tại"}
-    except:
-        return {"available": False, "message": "Lỗi kết nối Product Service"}
+        http_client.post(PRODUCT_SERVICE_NAME, f"/products/reservations/{reservation_id}/release")
+    except ServiceUnavailableError as e:
+        print(f"[RESERVATION] Release {reservation_id} lỗi: {e}")
+
+
+def return_stock(items):
+    """Trả lại số lượng cho Product Service khi item/đơn hàng bị xoá hoặc giảm số lượng"""
+    items = [{"product_id": item["product_id"], "quantity": item["quantity"]} for item in items if item["quantity"] > 0]
+    if not items:
+        return
+    try:
+        response = http_client.post(PRODUCT_SERVICE_NAME, "/products/stock/return", json={"items": items})
+        if response.status_code != 200:
+            print(f"[STOCK] Trả lại {items} thất bại: {response.status_code}")
+    except ServiceUnavailableError as e:
+        print(f"[STOCK] Trả lại {items} lỗi: {e}")
 
 
 @app.route("/health")
@@ -64,16 +161,97 @@ def health():
     return jsonify({"status": "UP"}), 200
 
 
+@app.route("/internal/stats")
+def internal_stats():
+    """Trạng thái connection pool, circuit breaker, service discovery và token cache"""
+    return jsonify({
+        "http": http_client.stats(),
+        "discovery": discovery.stats(),
+        "token_cache": token_verifier.stats(),
+        "revocations": revocations.stats()
+    }), 200
+
+
+# ==================== INTERNAL API (chỉ cho service khác: header X-Service-Token) ====================
+
+def _parse_datetime_arg(name):
+    value = request.args.get(name)
+    return datetime.fromisoformat(value) if value else None
+
+
+@app.route("/internal/orders", methods=["GET"])
+def internal_find_orders():
+    """GET /internal/orders?created_from=&created_to=&updated_since=&after_owner=&after_id=&limit=
+
+    Danh sách (owner, id) đơn hàng theo thời gian; after_owner/after_id là con trỏ trong cùng updated_since.
+    """
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    try:
+        orders = find_orders(
+            created_from=_parse_datetime_arg("created_from"),
+            created_to=_parse_datetime_arg("created_to"),
+            updated_since=_parse_datetime_arg("updated_since"),
+            after_owner=request.args.get("after_owner"),
+            after_id=request.args.get("after_id", type=int),
+            limit=request.args.get("limit", 0, type=int)
+        )
+    except ValueError:
+        return jsonify({"error": "Thời gian phải theo định dạng ISO 8601"}), 400
+    return jsonify({"orders": orders}), 200
+
+
+@app.route("/internal/orders/batch", methods=["POST"])
+def internal_get_orders_batch():
+    """POST /internal/orders/batch - Lấy nhiều đơn hàng kèm items trong một aggregation
+
+    Body: {"orders": [{"owner", "id"}, ...]} (id đơn hàng chỉ duy nhất theo owner).
+    """
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    data = request.get_json()
+    if not data or not isinstance(data.get("orders"), list):
+        return jsonify({"error": "Thiếu danh sách orders"}), 400
+
+    try:
+        keys = list(dict.fromkeys((str(key["owner"]), int(key["id"])) for key in data["orders"]))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Mỗi phần tử của orders cần owner và id (số nguyên)"}), 400
+
+    orders = get_orders_with_items_by_keys(keys)
+    found = {(order["owner"], order["id"]) for order in orders}
+    missing = [{"owner": owner, "id": order_id} for owner, order_id in keys if (owner, order_id) not in found]
+    return jsonify({"orders": orders, "missing": missing}), 200
+
+
+@app.route("/internal/orders/<int:order_id>", methods=["GET"])
+def internal_get_order(order_id):
+    """GET /internal/orders/id?owner= - Đơn hàng kèm items cho Report Service"""
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    owner = request.args.get("owner")
+    if not owner:
+        return jsonify({"error": "Thiếu owner"}), 400
+    orders = get_orders_with_items_by_keys([(owner, order_id)])
+    if orders:
+        return jsonify(orders[0]), 200
+    return jsonify({"error": "Không tìm thấy đơn hàng"}), 404
+
+
 # ==================== ORDERS API ====================
 
 @app.route("/orders", methods=["GET"])
 def get_orders():
-    """GET /orders - Lấy danh sách tất cả đơn hàng"""
+    """GET /orders - Lấy danh sách tất cả đơn hàng (?include=items để kèm items)"""
     if "username" not in session:
         return jsonify({"error": "Chưa đăng nhập"}), 401
     
     username = session["username"]
-    orders = get_all_orders(username)
+    # ?include=items: nhúng items của mọi đơn trong cùng một aggregation ($lookup)
+    if request.args.get("include") == "items":
+        orders = get_all_orders_with_items(username)
+    else:
+        orders = get_all_orders(username)
     return jsonify(orders), 200
 
 
@@ -84,12 +262,10 @@ def get_order(order_id):
         return jsonify({"error": "Chưa đăng nhập"}), 401
     
     username = session["username"]
-    order = get_order_by_id(order_id, username)
+    # Đơn hàng và items được lấy trong một aggregation
+    order = get_order_with_items(order_id, username)
     
     if order:
-        # Lấy thêm danh sách order items
-        items = get_order_items_by_order(order_id, username)
-        order["items"] = items
         return jsonify(order), 200
     
     return jsonify({"error": "Không tìm thấy đơn hàng"}), 404
@@ -113,34 +289,31 @@ def add_order():
     
     username = session["username"]
     
-    # Kiểm tra tồn kho cho các sản phẩm trong đơn (nếu có items)
-    if "items" in data:
-        for item in data["items"]:
-            stock_check = check_product_stock(item["product_id"], item["quantity"])
-            if not stock_check["available"]:
-                return jsonify({
-                    "error": f"Sản phẩm {item['product_id']}: {stock_check['message']}"
-                }), 400
-    
-    # Tạo đơn hàng
-    new_order = create_order(data, username)
-    
-    # Tạo order items nếu có
-    if "items" in data:
-        for item in data["items"]:
-            item_data = {
-                "id": item["id"],
-                "order_id": data["id"],
-                "product_id": item["product_id"],
-                "product_name": item["product_name"],
-                "quantity": item["quantity"],
-                "unit_price": item["unit_price"]
-            }
-            create_order_item(item_data, username)
-        
-        # Tính lại tổng tiền
-        total = calculate_order_total(data["id"], username)
-        new_order["total_amount"] = total
+    # Giữ hàng cho các sản phẩm trong đơn (nếu có items) - kiểm tra và trừ tồn kho trong một lời gọi
+    reservation_id = None
+    if data.get("items"):
+        reservation_id, error = reserve_stock(data["items"], data["id"])
+        if error:
+            status, message = error
+            return jsonify({"error": message}), status
+    
+    try:
+        # Tạo đơn hàng (kèm toàn bộ items trong một lần ghi nếu có)
+        if data.get("items"):
+            new_order = create_order_with_items(data, data["items"], username)
+        else:
+            new_order = create_order(data, username)
+    except DuplicateKeyError:
+        if reservation_id:
+            release_stock_reservation(reservation_id)
+        return jsonify({"error": "Đơn hàng hoặc mặt hàng đã tồn tại"}), 409
+    except Exception:
+        if reservation_id:
+            release_stock_reservation(reservation_id)
+        raise
+    
+    if reservation_id:
+        commit_stock_reservation(reservation_id, data["id"])
     
     return jsonify(new_order), 201
 
@@ -171,9 +344,10 @@ def delete_order_route(order_id):
         return jsonify({"error": "Chưa đăng nhập"}), 401
     
     username = session["username"]
-    deleted = delete_order(order_id, username)
+    deleted_items = delete_order(order_id, username)
     
-    if deleted:
+    if deleted_items is not None:
+        return_stock(deleted_items)
         return jsonify({"message": "Xóa đơn hàng thành công"}), 200
     
     return jsonify({"error": "Không tìm thấy đơn hàng"}), 404
@@ -223,11 +397,6 @@ def add_item():
         if field not in data:
             return jsonify({"error": f"Thiếu trường {field}"}), 400
     
-    # Kiểm tra tồn kho
-    stock_check = check_product_stock(data["product_id"], data["quantity"])
-    if not stock_check["available"]:
-        return jsonify({"error": stock_check["message"]}), 400
-    
     username = session["username"]
     
     # Kiểm tra order có tồn tại không
@@ -235,10 +404,22 @@ def add_item():
     if not order:
         return jsonify({"error": "Đơn hàng không tồn tại"}), 404
     
-    new_item = create_order_item(data, username)
+    # Giữ hàng (kiểm tra và trừ tồn kho)
+    reservation_id, error = reserve_stock([data], data["order_id"])
+    if error:
+        status, message = error
+        return jsonify({"error": message}), status
     
-    # Cập nhật tổng tiền đơn hàng
-    calculate_order_total(data["order_id"], username)
+    try:
+        # Tổng tiền đơn hàng được cộng dồn trong create_order_item
+        new_item = create_order_item(data, username)
+    except DuplicateKeyError:
+        release_stock_reservation(reservation_id)
+        return jsonify({"error": "Mặt hàng đã tồn tại"}), 409
+    except Exception:
+        release_stock_reservation(reservation_id)
+        raise
+    commit_stock_reservation(reservation_id, data["order_id"])
     
     return jsonify(new_item), 201
 
@@ -260,20 +441,51 @@ def update_item_route(item_id):
     if not item:
         return jsonify({"error": "Không tìm thấy mặt hàng"}), 404
     
-    # Nếu thay đổi số lượng, kiểm tra tồn kho
-    if "quantity" in data and data["quantity"] != item["quantity"]:
-        stock_check = check_product_stock(item["product_id"], data["quantity"])
-        if not stock_check["available"]:
-            return jsonify({"error": stock_check["message"]}), 400
-    
-    updated = update_order_item(item_id, data, username)
+    if "unit_price" in data:
+        try:
+            float(data["unit_price"])
+        except (TypeError, ValueError):
+            return jsonify({"error": "Đơn giá phải là số"}), 400
+
+    # Tăng số lượng: giữ thêm phần chênh lệch; giảm: trả lại phần chênh lệch sau khi cập nhật
+    reservation_id = None
+    delta = 0
+    if "quantity" in data:
+        try:
+            quantity = int(data["quantity"])
+        except (TypeError, ValueError):
+            return jsonify({"error": "Số lượng phải là số nguyên"}), 400
+        if quantity <= 0:
+            return jsonify({"error": "Số lượng phải lớn hơn 0"}), 400
+        delta = quantity - item["quantity"]
+        if delta > 0:
+            reservation_id, error = reserve_stock(
+                [{"product_id": item["product_id"], "quantity": delta}], item["order_id"]
+            )
+            if error:
+                status, message = error
+                return jsonify({"error": message}), status
     
-    if updated:
-        # Cập nhật lại tổng tiền đơn hàng
-        calculate_order_total(item["order_id"], username)
-        return jsonify({"message": "Cập nhật mặt hàng thành công"}), 200
+    try:
+        # Chỉ cập nhật nếu số lượng chưa bị request khác đổi (phần giữ/trả hàng tính theo item đã đọc)
+        updated = update_order_item(item_id, data, username, expected_quantity=item["quantity"] if delta else None)
+    except Exception:
+        if reservation_id:
+            release_stock_reservation(reservation_id)
+        raise
+    
+    if not updated:
+        if reservation_id:
+            release_stock_reservation(reservation_id)
+        if delta and get_order_item_by_id(item_id, username):
+            return jsonify({"error": "Mặt hàng vừa được cập nhật, vui lòng thử lại"}), 409
+        return jsonify({"error": "Không tìm thấy mặt hàng"}), 404
     
-    return jsonify({"error": "Không tìm thấy mặt hàng"}), 404
+    if reservation_id:
+        commit_stock_reservation(reservation_id, item["order_id"])
+    elif delta < 0:
+        return_stock([{"product_id": item["product_id"], "quantity": -delta}])
+    return jsonify({"message": "Cập nhật mặt hàng thành công"}), 200
 
 
 @app.route("/order_items/<int:item_id>", methods=["DELETE"])
@@ -284,17 +496,11 @@ def delete_item_route(item_id):
     
     username = session["username"]
     
-    # Lấy thông tin item để biết order_id
-    item = get_order_item_by_id(item_id, username)
-    if not item:
-        return jsonify({"error": "Không tìm thấy mặt hàng"}), 404
-    
-    order_id = item["order_id"]
+    # Xóa item và trừ tổng tiền đơn hàng trong delete_order_item, rồi trả lại số lượng
     deleted = delete_order_item(item_id, username)
     
     if deleted:
-        # Cập nhật lại tổng tiền đơn hàng
-        calculate_order_total(order_id, username)
+        return_stock([deleted])
         return jsonify({"message": "Xóa mặt hàng thành công"}), 200
     
     return jsonify({"error": "Không tìm thấy mặt hàng"}), 404
@@ -306,5 +512,7 @@ def delete_item_route(item_id):
 
 
 if __name__ == "__main__":
+    ensure_indexes(INDEXES)
     register_service()
+    revocations.start()
     app.run(host="0.0.0.0", port=SERVICE_PORT, debug=True)
\ No newline at end of file
@@ -6,4 +6,41 @@ SERVICE_PORT = int(os.getenv("SERVICE_PORT", "5002"))
 AUTH_SERVICE_NAME = os.getenv("AUTH_SERVICE_NAME", "auth-service")
 PRODUCT_SERVICE_NAME = os.getenv("PRODUCT_SERVICE_NAME", "product-service")
 CONSUL_HOST = os.getenv("CONSUL_HOST", "localhost")
-CONSUL_PORT = int(os.getenv("CONSUL_PORT", "8500"))
\ No newline at end of file
+CONSUL_PORT = int(os.getenv("CONSUL_PORT", "8500"))
+
+# Khoá dùng chung giữa các service cho API nội bộ (header X-Service-Token)
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "myservicetoken")
+
+# JWT - dùng chung JWT_SECRET với Auth Service để xác thực token tại chỗ
+JWT_SECRET = os.getenv("JWT_SECRET", "mysecretkey")
+# "local": kiểm tra chữ ký JWT trong process, "remote": gọi /auth/verify của Auth Service
+TOKEN_VERIFY_MODE = os.getenv("TOKEN_VERIFY_MODE", "local")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+# Service discovery: "round_robin" hoặc "least_outstanding"
+DISCOVERY_STRATEGY = os.getenv("DISCOVERY_STRATEGY", "round_robin")
+# Thời gian chờ tối đa của một Consul blocking query
+DISCOVERY_WAIT = os.getenv("DISCOVERY_WAIT", "30s")
+
+# HTTP client giữa các service
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "3"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "1"))
+# Tỉ lệ retry tối đa so với số request (retry budget)
+HTTP_RETRY_BUDGET_RATIO = float(os.getenv("HTTP_RETRY_BUDGET_RATIO", "0.1"))
+# Circuit breaker: mở sau N lỗi liên tiếp, thử lại sau RESET giây
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "10"))
+
+# Commit giữ hàng lỗi tạm thời: thử lại nền mỗi INTERVAL giây trong tối đa WINDOW giây
+# (WINDOW phải nhỏ hơn RESERVATION_TTL của Product Service, nếu không hàng đã bán bị trả lại)
+RESERVATION_COMMIT_RETRY_WINDOW = float(os.getenv("RESERVATION_COMMIT_RETRY_WINDOW", "120"))
+RESERVATION_COMMIT_RETRY_INTERVAL = float(os.getenv("RESERVATION_COMMIT_RETRY_INTERVAL", "2"))
+
+
+# Ghi đơn hàng + items trong một transaction: "auto" (khi có replica set), "true" hoặc "false"
+MONGO_TRANSACTIONS = os.getenv("MONGO_TRANSACTIONS", "auto").lower()
+
+# Thu hồi token: lấy danh sách jti bị thu hồi từ Auth Service mỗi REVOCATION_REFRESH_INTERVAL giây
+REVOCATION_REFRESH_INTERVAL = float(os.getenv("REVOCATION_REFRESH_INTERVAL", "5"))
@@ -0,0 +1,208 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ServiceUnavailableError(Exception):
+    """Không gọi được service (không có instance, circuit đang mở, lỗi kết nối/timeout, 5xx)"""
+
+
+class CircuitBreaker:
+    """Circuit breaker cho một upstream: closed -> open (sau N lỗi liên tiếp) -> half_open -> closed"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = None       # vé của request thử đang chạy trong half_open
+        self._trial_seq = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Trả về vé nếu được gửi request, None nếu bị chặn.
+
+        Request thử trong half_open nhận vé là số thứ tự lượt thử (>= 1), request bình thường
+        nhận 0. Chỉ request giữ vé lượt thử mới kết thúc được lượt thử đó.
+        """
+        with self._lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return None
+                self.state = "half_open"
+                self._trial = None
+            if self.state == "half_open":
+                # Chỉ cho một request thử trong trạng thái half_open
+                if self._trial is not None:
+                    return None
+                self._trial_seq += 1
+                self._trial = self._trial_seq
+                return self._trial
+            return 0
+
+    def record_success(self, ticket):
+        with self._lock:
+            # Request được cho qua khi còn closed nhưng kết thúc sau khi circuit đã mở: bỏ qua
+            if self.state != "closed" and ticket != self._trial:
+                return
+            self.state = "closed"
+            self.failures = 0
+            self._trial = None
+
+    def release_trial(self, ticket):
+        """Giải phóng lượt thử half_open khi request thử kết thúc mà không ghi nhận kết quả"""
+        with self._lock:
+            if ticket and ticket == self._trial:
+                self._trial = None
+
+    def record_failure(self, ticket):
+        with self._lock:
+            if self.state != "closed" and ticket != self._trial:
+                return
+            self.failures += 1
+            self._trial = None
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures}
+
+
+class RetryBudget:
+    """Giới hạn retry theo tỉ lệ số request: mỗi request nạp `ratio` token, mỗi retry tốn 1 token"""
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class ServiceClient:
+    """HTTP client dùng chung cho các lời gọi giữa các service.
+
+    Mỗi upstream (service name) có Session riêng với connection pool keep-alive,
+    circuit breaker và retry budget riêng. Instance được chọn qua ServiceDiscovery.
+    service_token (tuỳ chọn) được gửi trong header X-Service-Token cho các API nội bộ.
+    """
+
+    def __init__(self, discovery, pool_size=20, connect_timeout=1.0, read_timeout=3.0,
+                 max_retries=1, retry_budget_ratio=0.1, failure_threshold=5, reset_timeout=10,
+                 service_token=None):
+        self.discovery = discovery
+        self.service_token = service_token
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.retry_budget_ratio = retry_budget_ratio
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._upstreams = {}
+        self._lock = threading.Lock()
+
+    def _upstream(self, service_name):
+        upstream = self._upstreams.get(service_name)
+        if upstream:
+            return upstream
+
+        with self._lock:
+            if service_name not in self._upstreams:
+                session = requests.Session()
+                if self.service_token:
+                    session.headers["X-Service-Token"] = self.service_token
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._upstreams[service_name] = {
+                    "session": session,
+                    "adapter": adapter,
+                    "breaker": CircuitBreaker(self.failure_threshold, self.reset_timeout),
+                    "budget": RetryBudget(self.retry_budget_ratio)
+                }
+            return self._upstreams[service_name]
+
+    def request(self, service_name, method, path, retry=None, **kwargs):
+        """Gửi request tới một instance của service.
+
+        Trả về Response cho mọi mã < 500; lỗi kết nối, timeout, 5xx hoặc circuit
+        đang mở đều raise ServiceUnavailableError. Mặc định chỉ retry với GET.
+        """
+        upstream = self._upstream(service_name)
+        breaker = upstream["breaker"]
+        budget = upstream["budget"]
+        kwargs.setdefault("timeout", self.timeout)
+        if retry is None:
+            retry = method.upper() == "GET"
+
+        budget.deposit()
+        attempt = 0
+        while True:
+            with self.discovery.instance(service_name) as instance:
+                if not instance:
+                    raise ServiceUnavailableError(f"{service_name}: không có instance khả dụng")
+                ticket = breaker.allow()
+                if ticket is None:
+                    raise ServiceUnavailableError(f"{service_name}: circuit đang mở")
+                try:
+                    response = upstream["session"].request(method, f"{instance['url']}{path}", **kwargs)
+                    if response.status_code < 500:
+                        breaker.record_success(ticket)
+                        return response
+                    error = f"{service_name}: HTTP {response.status_code}"
+                    breaker.record_failure(ticket)
+                except requests.RequestException as e:
+                    error = f"{service_name}: {e.__class__.__name__}"
+                    breaker.record_failure(ticket)
+                finally:
+                    # Lỗi bất ngờ (không phải RequestException) cũng không được giữ lượt thử mãi;
+                    # chỉ giải phóng khi chính request này là request thử
+                    breaker.release_trial(ticket)
+
+            attempt += 1
+            if not retry or attempt > self.max_retries or not budget.withdraw():
+                raise ServiceUnavailableError(error)
+
+    def get(self, service_name, path, **kwargs):
+        return self.request(service_name, "GET", path, **kwargs)
+
+    def post(self, service_name, path, **kwargs):
+        return self.request(service_name, "POST", path, **kwargs)
+
+    def stats(self):
+        """Trạng thái pool và circuit breaker của từng upstream (cho monitoring)"""
+        result = {}
+        for service_name, upstream in list(self._upstreams.items()):
+            pools = {}
+            poolmanager = upstream["adapter"].poolmanager
+            for key in list(poolmanager.pools.keys()):
+                pool = poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                pools[f"{pool.host}:{pool.port}"] = {
+                    "connections_created": pool.num_connections,
+                    "requests": pool.num_requests,
+                    "idle": sum(1 for conn in pool.pool.queue if conn) if pool.pool else 0,
+                    "maxsize": self.pool_size
+                }
+            result[service_name] = {
+                "breaker": upstream["breaker"].snapshot(),
+                "retry_tokens": round(upstream["budget"].tokens, 2),
+                "pools": pools
+            }
+        return result
@@ -1,18 +1,49 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, IndexModel, ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
 from datetime import datetime
-from config import MONGO_URI
+from config import MONGO_URI, MONGO_TRANSACTIONS
 
 client = MongoClient(MONGO_URI)
 db = client["orderdb"]
 orders_collection = db["orders"]
 order_items_collection = db["order_items"]
 
+# Index khai báo (tạo khi khởi động / python index_manager.py)
+INDEXES = [
+    (orders_collection, [
+        # Mọi truy vấn đơn hàng đều lọc theo owner (+ id)
+        IndexModel([("owner", ASCENDING), ("id", ASCENDING)], name="owner_id_unique", unique=True),
+        # Truy vấn nội bộ theo id (không có owner) và theo khoảng thời gian
+        IndexModel([("id", ASCENDING)], name="id"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+        # Report Service duyệt các đơn thay đổi theo con trỏ (updated_at, owner, id)
+        IndexModel([("updated_at", ASCENDING), ("owner", ASCENDING), ("id", ASCENDING)], name="updated_at_owner_id"),
+    ]),
+    (order_items_collection, [
+        IndexModel([("owner", ASCENDING), ("id", ASCENDING)], name="owner_id_unique", unique=True),
+        # Items của một đơn ($lookup theo order_id, lọc owner)
+        IndexModel([("order_id", ASCENDING), ("owner", ASCENDING)], name="order_id_owner"),
+    ]),
+]
+
+_transactions_supported = None
+
+
+def supports_transactions():
+    """Transaction chỉ dùng được trên replica set / sharded cluster (MONGO_TRANSACTIONS=auto|true|false)"""
+    global _transactions_supported
+    if MONGO_TRANSACTIONS != "auto":
+        return MONGO_TRANSACTIONS == "true"
+    if _transactions_supported is None:
+        hello = client.admin.command("hello")
+        _transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _transactions_supported
+
 # ==================== ORDERS ====================
 
-def create_order(data, username):
-    """Tạo đơn hàng mới"""
-    now = datetime.utcnow()
-    order = {
+def _build_order(data, username, now):
+    return {
         "id": data["id"],
         "customer_name": data["customer_name"],
         "customer_email": data["customer_email"],
@@ -22,6 +53,12 @@ def create_order(data, username):
         "created_at": now,
         "updated_at": now
     }
+
+
+def create_order(data, username):
+    """Tạo đơn hàng mới"""
+    now = datetime.utcnow()
+    order = _build_order(data, username, now)
     result = orders_collection.insert_one(order)
     order["_id"] = str(result.inserted_id)
     order["created_at"] = now.isoformat()
@@ -29,6 +66,51 @@ def create_order(data, username):
     return order
 
 
+def create_order_with_items(data, items, username):
+    """Tạo đơn hàng cùng toàn bộ items: một insert_one cho order, một insert_many cho items.
+
+    Tổng tiền được tính trong bộ nhớ và ghi sẵn vào order. Order được ghi trước nên id trùng
+    bị unique index (owner, id) chặn trước khi có item nào được ghi. Nếu có replica set, cả hai
+    lệnh chạy trong một transaction; nếu không, khi ghi items lỗi chỉ các document do chính
+    lần gọi này tạo ra (theo _id sinh sẵn) bị xoá lại, không đụng tới dữ liệu đã có.
+    Id trùng (order hoặc item) được báo bằng DuplicateKeyError.
+    """
+    now = datetime.utcnow()
+    order_items = [
+        {**_build_order_item({**item, "order_id": data["id"]}, username), "_id": ObjectId()}
+        for item in items
+    ]
+    order = _build_order(data, username, now)
+    order["_id"] = ObjectId()
+    order["total_amount"] = sum(item["total_price"] for item in order_items)
+
+    try:
+        if supports_transactions():
+            def write(session):
+                orders_collection.insert_one(order, session=session)
+                order_items_collection.insert_many(order_items, session=session)
+
+            with client.start_session() as session:
+                session.with_transaction(write)
+        else:
+            orders_collection.insert_one(order)
+            try:
+                order_items_collection.insert_many(order_items)
+            except Exception:
+                order_items_collection.delete_many({"_id": {"$in": [item["_id"] for item in order_items]}})
+                orders_collection.delete_one({"_id": order["_id"]})
+                raise
+    except BulkWriteError as e:
+        if any(error.get("code") == 11000 for error in e.details.get("writeErrors", [])):
+            raise DuplicateKeyError("Mặt hàng đã tồn tại", 11000) from e
+        raise
+
+    order["_id"] = str(order["_id"])
+    order["created_at"] = now.isoformat()
+    order["updated_at"] = now.isoformat()
+    return order
+
+
 def get_all_orders(username):
     """Lấy tất cả đơn hàng của user"""
     orders = list(orders_collection.find({"owner": username}, {"_id": 0}))
@@ -51,6 +133,92 @@ def get_order_by_id(order_id, username):
     return order
 
 
+def _format_dates(order):
+    if isinstance(order.get("created_at"), datetime):
+        order["created_at"] = order["created_at"].isoformat()
+    if isinstance(order.get("updated_at"), datetime):
+        order["updated_at"] = order["updated_at"].isoformat()
+    return order
+
+
+def _orders_with_items_pipeline(match):
+    """Pipeline lấy đơn hàng kèm items bằng $lookup (một truy vấn phía server)"""
+    return [
+        {"$match": match},
+        {"$lookup": {
+            "from": order_items_collection.name,
+            "localField": "id",
+            "foreignField": "order_id",
+            "let": {"owner": "$owner"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$owner", "$$owner"]}}},
+                {"$project": {"_id": 0}}
+            ],
+            "as": "items"
+        }},
+        {"$project": {"_id": 0}}
+    ]
+
+
+def get_order_with_items(order_id, username):
+    """Lấy đơn hàng cùng danh sách items trong một aggregation"""
+    orders = list(orders_collection.aggregate(_orders_with_items_pipeline({"id": order_id, "owner": username})))
+    return _format_dates(orders[0]) if orders else None
+
+
+def get_all_orders_with_items(username):
+    """Lấy tất cả đơn hàng của user, mỗi đơn kèm items, trong một aggregation"""
+    orders = list(orders_collection.aggregate(_orders_with_items_pipeline({"owner": username})))
+    return [_format_dates(order) for order in orders]
+
+
+# ==================== TRUY VẤN NỘI BỘ (cho Report Service, không lọc theo owner) ====================
+
+def get_orders_with_items_by_keys(keys):
+    """Lấy nhiều đơn hàng kèm items trong một aggregation. keys: danh sách (owner, id)
+    (id đơn hàng chỉ duy nhất theo từng owner)"""
+    keys = list(keys)
+    if not keys:
+        return []
+    pipeline = _orders_with_items_pipeline({"$or": [{"owner": owner, "id": order_id} for owner, order_id in keys]})
+    return [_format_dates(order) for order in orders_collection.aggregate(pipeline)]
+
+
+def find_orders(created_from=None, created_to=None, updated_since=None, after_owner=None, after_id=None, limit=0):
+    """Tìm đơn hàng theo khoảng created_at, hoặc các đơn thay đổi sau updated_since.
+
+    Khi lọc updated_since, kết quả sắp xếp theo (updated_at, owner, id) và after_owner/after_id
+    là con trỏ keyset: lấy các đơn cùng updated_at nhưng đứng sau (after_owner, after_id),
+    nên nhiều đơn trùng updated_at vẫn được duyệt hết qua nhiều trang.
+    Chỉ trả về owner, id, created_at, updated_at để bên gọi lấy chi tiết theo lô.
+    """
+    query = {}
+    if created_from or created_to:
+        query["created_at"] = {}
+        if created_from:
+            query["created_at"]["$gte"] = created_from
+        if created_to:
+            query["created_at"]["$lt"] = created_to
+
+    if updated_since:
+        if after_owner is not None and after_id is not None:
+            query["$or"] = [
+                {"updated_at": {"$gt": updated_since}},
+                {"updated_at": updated_since, "owner": {"$gt": after_owner}},
+                {"updated_at": updated_since, "owner": after_owner, "id": {"$gt": after_id}}
+            ]
+        else:
+            query["updated_at"] = {"$gt": updated_since}
+        sort = [("updated_at", ASCENDING), ("owner", ASCENDING), ("id", ASCENDING)]
+    else:
+        sort = [("created_at", ASCENDING)]
+
+    cursor = orders_collection.find(
+        query, {"_id": 0, "owner": 1, "id": 1, "created_at": 1, "updated_at": 1}
+    ).sort(sort).limit(limit)
+    return [_format_dates(order) for order in cursor]
+
+
 def update_order(order_id, data, username):
     """Cập nhật trạng thái đơn hàng"""
     now = datetime.utcnow()
@@ -70,20 +238,44 @@ def update_order(order_id, data, username):
 
 
 def delete_order(order_id, username):
-    """Xóa đơn hàng"""
-    # Xóa các order items liên quan
-    order_items_collection.delete_many({"order_id": order_id, "owner": username})
-    
-    # Xóa order
+    """Xóa đơn hàng và các items. Trả về danh sách items đã xoá (để trả lại số lượng),
+    hoặc None nếu không tìm thấy đơn hàng"""
     result = orders_collection.delete_one({"id": order_id, "owner": username})
-    return result.deleted_count > 0
+    if result.deleted_count == 0:
+        return None
+
+    # Xoá từng item (find_one_and_delete): item bị xoá đồng thời qua /order_items chỉ được tính một lần
+    deleted_items = []
+    for item in order_items_collection.find({"order_id": order_id, "owner": username}, {"id": 1}):
+        deleted = order_items_collection.find_one_and_delete({"_id": item["_id"]}, {"_id": 0})
+        if deleted:
+            deleted_items.append(deleted)
+    return deleted_items
 
 
 # ==================== ORDER ITEMS ====================
 
-def create_order_item(data, username):
-    """Tạo chi tiết đơn hàng mới"""
-    order_item = {
+def _inc_order_total(order_id, username, delta, session=None):
+    """Cộng dồn chênh lệch vào total_amount của đơn hàng ($inc, không đọc lại các item)"""
+    orders_collection.update_one(
+        {"id": order_id, "owner": username},
+        {"$inc": {"total_amount": delta}, "$set": {"updated_at": datetime.utcnow()}},
+        session=session
+    )
+
+
+def _run_item_write(write):
+    """Chạy write(session) - ghi item rồi $inc tổng tiền đơn hàng - trong một transaction
+    nếu MongoDB hỗ trợ; nếu không, hai lệnh ghi chạy nối tiếp (session=None) và lệch tổng
+    tiền (nếu có) được sửa bởi reconcile_order_totals"""
+    if supports_transactions():
+        with client.start_session() as session:
+            return session.with_transaction(write)
+    return write(None)
+
+
+def _build_order_item(data, username):
+    return {
         "id": data["id"],
         "order_id": data["order_id"],
         "product_id": data["product_id"],
@@ -93,8 +285,19 @@ def create_order_item(data, username):
         "total_price": float(data["quantity"]) * float(data["unit_price"]),
         "owner": username
     }
-    result = order_items_collection.insert_one(order_item)
-    order_item["_id"] = str(result.inserted_id)
+
+
+def create_order_item(data, username):
+    """Tạo chi tiết đơn hàng mới và cộng total_price vào tổng tiền đơn hàng"""
+    order_item = _build_order_item(data, username)
+    order_item["_id"] = ObjectId()
+
+    def write(session):
+        order_items_collection.insert_one(order_item, session=session)
+        _inc_order_total(order_item["order_id"], username, order_item["total_price"], session=session)
+
+    _run_item_write(write)
+    order_item["_id"] = str(order_item["_id"])
     return order_item
 
 
@@ -115,38 +318,65 @@ def get_order_items_by_order(order_id, username):
     return items
 
 
-def update_order_item(item_id, data, username):
-    """Cập nhật order item"""
+def update_order_item(item_id, data, username, expected_quantity=None, max_attempts=5):
+    """Cập nhật order item và điều chỉnh tổng tiền đơn hàng theo chênh lệch total_price.
+
+    expected_quantity: chỉ cập nhật khi quantity hiện tại bằng giá trị này (giữ hàng đã tính theo nó).
+    Giá trị không hợp lệ (quantity/unit_price không phải số) raise ValueError.
+    """
     update_data = {}
     
-    allowed_fields = ["product_name", "quantity", "unit_price"]
-    for field in allowed_fields:
+    allowed_fields = {"product_name": str, "quantity": int, "unit_price": float}
+    for field, cast in allowed_fields.items():
         if field in data:
-            update_data[field] = data[field]
+            update_data[field] = cast(data[field])
     
-    # Tính lại total_price nếu có thay đổi quantity hoặc unit_price
-    if "quantity" in update_data or "unit_price" in update_data:
-        item = order_items_collection.find_one({"id": item_id, "owner": username})
-        if item:
-            qty = update_data.get("quantity", item["quantity"])
-            price = update_data.get("unit_price", item["unit_price"])
-            update_data["total_price"] = float(qty) * float(price)
+    if not update_data:
+        return False
     
-    result = order_items_collection.update_one(
-        {"id": item_id, "owner": username},
-        {"$set": update_data}
-    )
-    return result.modified_count > 0
+    def write(session):
+        for _ in range(max_attempts):
+            before = order_items_collection.find_one({"id": item_id, "owner": username}, session=session)
+            if not before:
+                return False
+            if expected_quantity is not None and before["quantity"] != expected_quantity:
+                return False
+            
+            # total_price tính phía server từ giá trị mới; $set thường nên chuỗi người dùng
+            # nhập (vd "$unit_price") được lưu nguyên văn, không bị hiểu là biểu thức
+            qty = update_data.get("quantity", before["quantity"])
+            price = update_data.get("unit_price", before["unit_price"])
+            total_price = float(qty) * float(price)
+            result = order_items_collection.update_one(
+                # Chỉ ghi nếu quantity/unit_price chưa bị request khác đổi kể từ lúc đọc
+                {"_id": before["_id"], "quantity": before["quantity"], "unit_price": before["unit_price"]},
+                {"$set": {**update_data, "total_price": total_price}},
+                session=session
+            )
+            if result.matched_count:
+                # Luôn gọi (kể cả chênh lệch = 0) để updated_at của đơn hàng đổi theo mọi thay đổi item
+                _inc_order_total(before["order_id"], username, total_price - before["total_price"], session=session)
+                return True
+        return False
+    
+    return _run_item_write(write)
 
 
 def delete_order_item(item_id, username):
-    """Xóa order item"""
-    result = order_items_collection.delete_one({"id": item_id, "owner": username})
-    return result.deleted_count > 0
+    """Xóa order item và trừ total_price khỏi tổng tiền đơn hàng. Trả về item đã xoá hoặc None"""
+    def write(session):
+        item = order_items_collection.find_one_and_delete(
+            {"id": item_id, "owner": username}, {"_id": 0}, session=session
+        )
+        if item:
+            _inc_order_total(item["order_id"], username, -item["total_price"], session=session)
+        return item
+
+    return _run_item_write(write)
 
 
 def calculate_order_total(order_id, username):
-    """Tính tổng tiền của đơn hàng"""
+    """Tính lại tổng tiền của một đơn hàng từ các item (dùng để đối soát, không chạy trên đường request)"""
     items = get_order_items_by_order(order_id, username)
     total = sum(item["total_price"] for item in items)
     
@@ -156,4 +386,31 @@ def calculate_order_total(order_id, username):
         {"$set": {"total_amount": total, "updated_at": datetime.utcnow()}}
     )
     
-    return total
\ No newline at end of file
+    return total
+
+
+def reconcile_order_totals(batch_size=1000):
+    """Đối soát hàng loạt: tính lại tổng tiền mọi đơn hàng bằng một aggregation trên item
+    (đơn không có item có tổng 0) và chỉ ghi (bulk_write) những đơn bị lệch. Trả về số đơn đã sửa."""
+    totals = {}
+    pipeline = [{"$group": {"_id": {"owner": "$owner", "order_id": "$order_id"}, "total": {"$sum": "$total_price"}}}]
+    for row in order_items_collection.aggregate(pipeline):
+        totals[(row["_id"]["owner"], row["_id"]["order_id"])] = row["total"]
+    
+    fixed = 0
+    operations = []
+    cursor = orders_collection.find({}, {"_id": 0, "id": 1, "owner": 1, "total_amount": 1})
+    for order in cursor:
+        # Đơn không có item (ví dụ đã xoá hết item) phải có tổng 0
+        total = totals.get((order["owner"], order["id"]), 0.0)
+        if abs(order.get("total_amount", 0.0) - total) > 1e-6:
+            operations.append(UpdateOne(
+                {"id": order["id"], "owner": order["owner"]},
+                {"$set": {"total_amount": total}}
+            ))
+        if len(operations) >= batch_size:
+            fixed += orders_collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        fixed += orders_collection.bulk_write(operations, ordered=False).modified_count
+    return fixed
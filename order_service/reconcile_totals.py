@@ -0,0 +1,11 @@
+"""Đối soát tổng tiền đơn hàng (total_amount) với tổng total_price của các order items.
+
+Tổng tiền được duy trì tăng dần bằng $inc khi thêm/sửa/xóa item; job này sửa các
+đơn bị lệch (ví dụ do ghi dở dang). Chạy: python reconcile_totals.py
+"""
+from models.order_model import reconcile_order_totals
+
+
+if __name__ == "__main__":
+    fixed = reconcile_order_totals()
+    print(f"[RECONCILE] Đã sửa tổng tiền cho {fixed} đơn hàng")
@@ -0,0 +1,127 @@
+import hashlib
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    """Bloom filter cho jti đã thu hồi: không có false negative, false positive ~fp_rate"""
+
+    def __init__(self, capacity=100000, fp_rate=0.001):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RevocationList:
+    """Danh sách token đã thu hồi trong bộ nhớ: Bloom filter phía trước + tập chính xác jti -> exp.
+
+    Token chưa bị thu hồi (trường hợp thường gặp) chỉ cần kiểm tra Bloom filter, không có I/O.
+    fetch(since) trả về các thu hồi có revoked_at >= since (since=None: toàn bộ còn hạn),
+    mỗi phần tử {"jti", "exp", "revoked_at"} (epoch giây). Thread nền gọi fetch mỗi `interval`
+    giây để cập nhật dần; jti quá exp được loại bỏ và Bloom filter được tạo lại.
+    """
+
+    # Lấy lại một khoảng nhỏ trước mốc cũ để không sót các thu hồi ghi lệch giờ giữa các instance
+    OVERLAP = 5
+
+    def __init__(self, fetch, interval=5, capacity=100000, fp_rate=0.001):
+        self.fetch = fetch
+        self.interval = interval
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self._revoked = {}  # jti -> exp
+        self._bloom = BloomFilter(capacity, fp_rate)
+        self._since = None
+        self._lock = threading.Lock()
+        self.last_refresh = None
+
+    def add(self, jti, exp):
+        with self._lock:
+            self._add(jti, exp)
+
+    def _add(self, jti, exp):
+        if jti in self._revoked:
+            return
+        self._revoked[jti] = exp
+        if len(self._revoked) > self._bloom.capacity:
+            self._rebuild(self._bloom.capacity * 2)
+        else:
+            self._bloom.add(jti)
+
+    def _rebuild(self, capacity):
+        bloom = BloomFilter(capacity, self.fp_rate)
+        for jti in self._revoked:
+            bloom.add(jti)
+        self._bloom = bloom
+
+    def is_revoked(self, jti):
+        if not jti:
+            return False
+        bloom = self._bloom
+        if jti not in bloom:
+            return False
+        with self._lock:
+            exp = self._revoked.get(jti)
+        return exp is not None and exp > time.time()
+
+    def refresh(self):
+        """Lấy các thu hồi mới và dọn jti đã hết hạn. Trả về số jti mới"""
+        started = time.time()
+        entries = self.fetch(self._since)
+        now = time.time()
+        with self._lock:
+            before = len(self._revoked)
+            for entry in entries:
+                if entry["exp"] > now:
+                    self._add(entry["jti"], entry["exp"])
+            added = len(self._revoked) - before
+
+            expired = [jti for jti, exp in self._revoked.items() if exp <= now]
+            for jti in expired:
+                del self._revoked[jti]
+            if expired:
+                # Bloom filter không xóa được phần tử -> tạo lại từ các jti còn hạn
+                self._rebuild(self._bloom.capacity)
+
+            latest = max((entry["revoked_at"] for entry in entries), default=None)
+            if self._since is None:
+                self._since = started - self.OVERLAP
+            if latest is not None:
+                self._since = max(self._since, latest - self.OVERLAP)
+            self.last_refresh = now
+        return added
+
+    def start(self):
+        def run():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[REVOCATION] Refresh lỗi: {e}")
+                time.sleep(self.interval)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "revoked": len(self._revoked),
+                "bloom_bits": self._bloom.size,
+                "bloom_hashes": self._bloom.hashes,
+                "last_refresh": self.last_refresh
+            }
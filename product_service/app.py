@@ -1,32 +1,77 @@
-from flask import Flask, jsonify, request, session
+from flask import Flask, jsonify, request, session, Response, stream_with_context
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from service_registry import register_service
+from index_manager import ensure_indexes
+from service_discovery import ServiceDiscovery
 from models.product_model import *
+from models.reservation_model import *
 from config import *
-import requests, consul
+import requests
+import json
+import hmac
+from datetime import datetime
+import threading
+import time
 
 app = Flask(__name__)
 app.secret_key = "product_secret"
 
 # ---- Consul Service Discovery ----
-def get_auth_service_url():
-    c = consul.Consul(host=CONSUL_HOST, port=CONSUL_PORT)
-    services = c.agent.services()
-    for s in services.values():
-        if s["Service"] == AUTH_SERVICE_NAME:
-            return f"http://{s['Address']}:{s['Port']}"
-    return None
+discovery = ServiceDiscovery(CONSUL_HOST, CONSUL_PORT, strategy=DISCOVERY_STRATEGY, wait=DISCOVERY_WAIT)
+
+
+def is_service_request():
+    """Request từ service khác (header X-Service-Token khớp SERVICE_TOKEN)"""
+    return hmac.compare_digest(request.headers.get("X-Service-Token", ""), SERVICE_TOKEN)
+
 
 @app.route("/health")
 def health():
     return jsonify({"status": "UP"}), 200
 
 
+@app.route("/internal/stats")
+def internal_stats():
+    """Số liệu hit/miss/eviction của cache sản phẩm"""
+    return jsonify({"cache": get_cache_stats(), "discovery": discovery.stats()}), 200
+
+
 # ---------------- RESTful API ----------------
 
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
 @app.route("/products", methods=["GET"])
 def get_products():
-    return jsonify(get_all_products()), 200
+    """GET /products - Danh sách sản phẩm.
+
+    ?limit=&after=      phân trang keyset theo id, trả về {"products", "next_after"}
+    ?format=ndjson      stream từng dòng JSON trực tiếp từ cursor MongoDB
+    Không có tham số    trả về toàn bộ danh sách như trước
+    """
+    limit = request.args.get("limit", type=int)
+    after = request.args.get("after", type=int)
+
+    if request.args.get("format") == "ndjson":
+        cursor = iter_products(after, limit or 0, PRODUCT_STREAM_BATCH_SIZE)
+
+        def generate():
+            for product in cursor:
+                yield json.dumps(product, default=_json_default, ensure_ascii=False) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    if limit is None and after is None:
+        return jsonify(get_all_products()), 200
+
+    limit = max(1, min(limit or PRODUCT_PAGE_SIZE, PRODUCT_MAX_PAGE_SIZE))
+    products = get_products_page(limit, after)
+    next_after = products[-1]["id"] if len(products) == limit else None
+    return jsonify({"products": products, "next_after": next_after, "limit": limit}), 200
 
 @app.route("/products/<int:pid>", methods=["GET"])
 def get_product(pid):
@@ -35,6 +80,119 @@ def get_product(pid):
         return jsonify(product), 200
     return jsonify({"error": "Product not found"}), 404
 
+@app.route("/products/batch", methods=["POST"])
+def get_products_batch():
+    """POST /products/batch - Lấy nhiều sản phẩm trong một lần gọi (dùng nội bộ giữa các service)"""
+    data = request.get_json()
+    if not data or not isinstance(data.get("ids"), list):
+        return jsonify({"error": "Thiếu danh sách ids"}), 400
+
+    try:
+        pids = list(dict.fromkeys(int(pid) for pid in data["ids"]))
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids phải là danh sách số nguyên"}), 400
+
+    products = get_products_by_ids(pids)
+    found = {p["id"] for p in products}
+    missing = [pid for pid in pids if pid not in found]
+    return jsonify({"products": products, "missing": missing}), 200
+
+# ---------------- Stock Reservations (chỉ cho service nội bộ, Nginx chặn từ bên ngoài) ----------------
+
+@app.route("/products/reservations", methods=["POST"])
+def create_reservation_route():
+    """POST /products/reservations - Giữ hàng (trừ số lượng khả dụng) cho nhiều sản phẩm, hết hạn sau TTL"""
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    data = request.get_json()
+    if not data or not isinstance(data.get("items"), list) or not data["items"]:
+        return jsonify({"error": "Thiếu danh sách items"}), 400
+
+    try:
+        for item in data["items"]:
+            if int(item["quantity"]) <= 0:
+                return jsonify({"error": "Số lượng phải lớn hơn 0"}), 400
+            int(item["product_id"])
+        # TTL do bên gọi chọn nhưng không vượt quá RESERVATION_MAX_TTL
+        ttl = max(1, min(int(data.get("ttl", RESERVATION_TTL)), RESERVATION_MAX_TTL))
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Mỗi item cần product_id và quantity là số nguyên"}), 400
+
+    reservation, failure = create_reservation(data["items"], ttl, data.get("order_id"))
+    if failure:
+        return jsonify({"error": failure["message"], "product_id": failure["product_id"]}), 409
+    return jsonify(reservation), 201
+
+
+@app.route("/products/reservations/<reservation_id>", methods=["GET"])
+def get_reservation_route(reservation_id):
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    reservation = get_reservation(reservation_id)
+    if reservation:
+        return jsonify(reservation), 200
+    return jsonify({"error": "Reservation not found"}), 404
+
+
+@app.route("/products/reservations/<reservation_id>/commit", methods=["POST"])
+def commit_reservation_route(reservation_id):
+    """POST /products/reservations/id/commit - Xác nhận giữ hàng (đơn hàng đã tạo)"""
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    data = request.get_json(silent=True) or {}
+    reservation = commit_reservation(reservation_id, data.get("order_id"))
+    if reservation:
+        return jsonify(reservation), 200
+    return jsonify({"error": "Reservation không tồn tại, đã hết hạn hoặc đã xử lý"}), 409
+
+
+@app.route("/products/reservations/<reservation_id>/release", methods=["POST"])
+def release_reservation_route(reservation_id):
+    """POST /products/reservations/id/release - Huỷ giữ hàng và trả lại số lượng"""
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    reservation = release_reservation(reservation_id)
+    if reservation:
+        return jsonify(reservation), 200
+    return jsonify({"error": "Reservation không tồn tại hoặc đã xử lý"}), 409
+
+
+@app.route("/products/stock/return", methods=["POST"])
+def return_stock_route():
+    """POST /products/stock/return - Trả lại số lượng của hàng đã bán khi đơn hàng/item bị xoá hoặc giảm"""
+    if not is_service_request():
+        return jsonify({"error": "Chỉ dành cho service nội bộ"}), 403
+    data = request.get_json()
+    if not data or not isinstance(data.get("items"), list) or not data["items"]:
+        return jsonify({"error": "Thiếu danh sách items"}), 400
+
+    try:
+        for item in data["items"]:
+            if int(item["quantity"]) <= 0:
+                return jsonify({"error": "Số lượng phải lớn hơn 0"}), 400
+            int(item["product_id"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Mỗi item cần product_id và quantity là số nguyên"}), 400
+
+    return_stock(data["items"])
+    return jsonify({"message": "Đã trả lại số lượng"}), 200
+
+
+def start_reservation_sweeper():
+    """Thread nền trả lại hàng cho các reservation quá hạn"""
+    def sweep():
+        while True:
+            try:
+                expired = expire_reservations()
+                if expired:
+                    print(f"[RESERVATION] Expired {expired} reservation(s)")
+            except Exception as e:
+                print(f"[RESERVATION] Sweep lỗi: {e}")
+            time.sleep(RESERVATION_SWEEP_INTERVAL)
+
+    threading.Thread(target=sweep, daemon=True).start()
+
+
 @app.route("/products", methods=["POST"])
 def add_product():
     if "username" not in session:
@@ -42,7 +200,10 @@ def add_product():
 
     data = request.get_json()
     username = session["username"]
-    new_product = create_product(data, username)
+    try:
+        new_product = create_product(data, username)
+    except DuplicateKeyError:
+        return jsonify({"error": "Sản phẩm đã tồn tại"}), 409
     return jsonify(new_product), 201
 
 
@@ -104,5 +265,7 @@ def delete_product_route(pid):
 
 
 if __name__ == "__main__":
+    ensure_indexes(INDEXES + RESERVATION_INDEXES, OBSOLETE_INDEXES)
     register_service()
+    start_reservation_sweeper()
     app.run(host="0.0.0.0", port=SERVICE_PORT, debug=True)
@@ -6,3 +6,26 @@ SERVICE_PORT = int(os.getenv("SERVICE_PORT", "5001"))
 AUTH_SERVICE_NAME = os.getenv("AUTH_SERVICE_NAME", "auth-service")
 CONSUL_HOST = os.getenv("CONSUL_HOST", "localhost")
 CONSUL_PORT = int(os.getenv("CONSUL_PORT", "8500"))
+
+# Khoá dùng chung giữa các service cho API nội bộ (header X-Service-Token)
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "myservicetoken")
+
+# Service discovery: "round_robin" hoặc "least_outstanding"
+DISCOVERY_STRATEGY = os.getenv("DISCOVERY_STRATEGY", "round_robin")
+# Thời gian chờ tối đa của một Consul blocking query
+DISCOVERY_WAIT = os.getenv("DISCOVERY_WAIT", "30s")
+
+# Giữ hàng (reservation): thời gian giữ mặc định và chu kỳ dọn reservation quá hạn (giây)
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "300"))
+RESERVATION_MAX_TTL = int(os.getenv("RESERVATION_MAX_TTL", "900"))
+RESERVATION_SWEEP_INTERVAL = int(os.getenv("RESERVATION_SWEEP_INTERVAL", "10"))
+
+# Phân trang / stream danh sách sản phẩm
+PRODUCT_PAGE_SIZE = int(os.getenv("PRODUCT_PAGE_SIZE", "50"))
+PRODUCT_MAX_PAGE_SIZE = int(os.getenv("PRODUCT_MAX_PAGE_SIZE", "500"))
+PRODUCT_STREAM_BATCH_SIZE = int(os.getenv("PRODUCT_STREAM_BATCH_SIZE", "500"))
+
+# Cache sản phẩm trong process (TTL tính bằng giây)
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+PRODUCT_LIST_CACHE_SIZE = int(os.getenv("PRODUCT_LIST_CACHE_SIZE", "100"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "5"))
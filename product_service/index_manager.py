@@ -0,0 +1,80 @@
+"""Tạo các index đã khai báo trong models (idempotent) và báo cáo index thiếu / không được dùng.
+
+Chạy: python index_manager.py          -> tạo index còn thiếu rồi in báo cáo
+      python index_manager.py --check  -> chỉ in báo cáo
+"""
+import sys
+
+from pymongo.errors import OperationFailure
+
+
+def drop_obsolete_indexes(obsolete):
+    """Xoá các index cũ đã được thay thế. obsolete: [(collection, [tên index, ...]), ...]
+
+    Index cũ trùng key nhưng khác tên/option với index mới làm create_indexes lỗi
+    (IndexOptionsConflict), nên phải xoá trước khi tạo.
+    """
+    for collection, names in obsolete:
+        existing = {index["name"] for index in collection.list_indexes()}
+        for name in names:
+            if name in existing:
+                collection.drop_index(name)
+                print(f"[INDEX] Đã xoá index cũ {collection.name}.{name}")
+
+
+def ensure_indexes(declared, obsolete=()):
+    """Tạo các index khai báo. declared: [(collection, [IndexModel, ...]), ...]
+
+    create_indexes là idempotent nên có thể chạy mỗi lần khởi động.
+    obsolete: index cũ cần xoá trước (xem drop_obsolete_indexes).
+    Trả về danh sách index không tạo được (ví dụ dữ liệu trùng với index unique).
+    """
+    drop_obsolete_indexes(obsolete)
+    failed = []
+    for collection, models in declared:
+        for model in models:
+            try:
+                collection.create_indexes([model])
+            except OperationFailure as e:
+                name = f"{collection.name}.{model.document['name']}"
+                failed.append(name)
+                print(f"[INDEX] Không tạo được {name}: {e}")
+    return failed
+
+
+def index_report(declared):
+    """So sánh index khai báo với index thực tế.
+
+    missing:    index đã khai báo nhưng chưa có trong collection
+    unused:     index có trong collection nhưng chưa được truy vấn nào dùng ($indexStats, tính từ lần khởi động mongod)
+    undeclared: index có trong collection nhưng không khai báo trong models
+    """
+    report = {"missing": [], "unused": [], "undeclared": []}
+    for collection, models in declared:
+        existing = {index["name"] for index in collection.list_indexes()}
+        names = {model.document["name"] for model in models}
+
+        report["missing"] += [f"{collection.name}.{name}" for name in sorted(names - existing)]
+        report["undeclared"] += [
+            f"{collection.name}.{name}" for name in sorted(existing - names) if name != "_id_"
+        ]
+        try:
+            for stats in collection.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection.name}.{stats['name']}")
+        except OperationFailure:
+            pass
+    return report
+
+
+def main(declared, argv, obsolete=()):
+    if "--check" not in argv:
+        ensure_indexes(declared, obsolete)
+    for kind, names in index_report(declared).items():
+        print(f"[INDEX] {kind}: {', '.join(names) if names else '-'}")
+
+
+if __name__ == "__main__":
+    from models.product_model import INDEXES, OBSOLETE_INDEXES
+    from models.reservation_model import RESERVATION_INDEXES
+    main(INDEXES + RESERVATION_INDEXES, sys.argv[1:], OBSOLETE_INDEXES)
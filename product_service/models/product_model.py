@@ -1,11 +1,43 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, IndexModel, ASCENDING
 from datetime import datetime
-from config import MONGO_URI
+from config import MONGO_URI, PRODUCT_CACHE_SIZE, PRODUCT_CACHE_TTL, PRODUCT_LIST_CACHE_SIZE
+from cache import TTLCache
 
 client = MongoClient(MONGO_URI)
 db = client["productdb"]
 collection = db["products"]
 
+# Cache read-through trong process: theo id và cho danh sách/trang sản phẩm.
+# TTL ngắn vì các instance khác không invalidate được cache của process này.
+product_cache = TTLCache(max_size=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
+product_list_cache = TTLCache(max_size=PRODUCT_LIST_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
+
+def invalidate_product(pid):
+    """Xoá sản phẩm khỏi cache sau khi ghi (và toàn bộ cache danh sách)"""
+    product_cache.delete(pid)
+    product_list_cache.clear()
+
+def get_cache_stats():
+    return {"product": product_cache.stats(), "product_list": product_list_cache.stats()}
+
+# Index khai báo (tạo khi khởi động / python index_manager.py)
+INDEXES = [
+    (collection, [
+        # Tra cứu theo id, batch $in và keyset pagination
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("owner", ASCENDING)], name="owner"),
+    ]),
+]
+
+# Index cũ đã được thay thế, xoá khi khởi động trước khi tạo index mới
+# (id_1 do create_index([("id", 1)]) cũ tạo, trùng key với id_unique nên chặn việc tạo index unique)
+OBSOLETE_INDEXES = [
+    (collection, ["id_1"]),
+]
+
+# "holds" (id các reservation đang giữ hàng, xem reservation_model) là dữ liệu nội bộ
+PUBLIC_FIELDS = {"_id": 0, "holds": 0}
+
 # CREATE
 def create_product(data, username):
     now = datetime.utcnow()
@@ -20,6 +52,7 @@ def create_product(data, username):
         "updated_at": now
     }
     result = collection.insert_one(product)
+    invalidate_product(product["id"])
     product["_id"] = str(result.inserted_id)
     product["created_at"] = now.isoformat()
     product["updated_at"] = now.isoformat()
@@ -27,11 +60,53 @@ def create_product(data, username):
 
 # READ (all)
 def get_all_products():
-    return list(collection.find({}, {"_id": 0}))
+    hit, products = product_list_cache.get(("all",))
+    if not hit:
+        products = list(collection.find({}, PUBLIC_FIELDS))
+        product_list_cache.set(("all",), products)
+    return products
+
+# READ (keyset pagination theo id: chỉ đọc các sản phẩm có id > after)
+def get_products_page(limit, after=None):
+    key = ("page", limit, after)
+    hit, products = product_list_cache.get(key)
+    if not hit:
+        query = {"id": {"$gt": after}} if after is not None else {}
+        products = list(collection.find(query, PUBLIC_FIELDS).sort("id", ASCENDING).limit(limit))
+        product_list_cache.set(key, products)
+    return products
+
+# READ (cursor để stream, không giữ toàn bộ danh sách trong bộ nhớ)
+def iter_products(after=None, limit=0, batch_size=500):
+    query = {"id": {"$gt": after}} if after is not None else {}
+    return collection.find(query, PUBLIC_FIELDS).sort("id", ASCENDING).limit(limit).batch_size(batch_size)
 
 # READ (by id)
 def get_product_by_id(pid):
-    return collection.find_one({"id": pid}, {"_id": 0})
+    hit, product = product_cache.get(pid)
+    if not hit:
+        product = collection.find_one({"id": pid}, PUBLIC_FIELDS)
+        if product is None:
+            return None
+        product_cache.set(pid, product)
+    return dict(product)
+
+# READ (nhiều id: lấy từ cache, phần còn thiếu đọc bằng một truy vấn $in)
+def get_products_by_ids(pids):
+    products = []
+    misses = []
+    for pid in pids:
+        hit, product = product_cache.get(pid)
+        if hit:
+            products.append(dict(product))
+        else:
+            misses.append(pid)
+
+    if misses:
+        for product in collection.find({"id": {"$in": misses}}, PUBLIC_FIELDS):
+            product_cache.set(product["id"], product)
+            products.append(dict(product))
+    return products
 
 # ---- UPDATE ----
 def update_product(pid, data, username):
@@ -39,11 +114,28 @@ def update_product(pid, data, username):
     update_data = {
         "updated_at": now
     }
-    return result.deleted_count > 0
+
+    allowed_fields = {"name": str, "description": str, "price": float, "quantity": int}
+    for field, cast in allowed_fields.items():
+        if field in data:
+            update_data[field] = cast(data[field])
+
+    result = collection.update_one({"id": pid, "owner": username}, {"$set": update_data})
+    invalidate_product(pid)
+    return result.modified_count > 0
+
+# ---- UPDATE QUANTITY (không kiểm tra owner, dùng khi người mua cập nhật tồn kho) ----
+def update_product_quantity(pid, quantity):
+    result = collection.update_one(
+        {"id": pid},
+        {"$set": {"quantity": int(quantity), "updated_at": datetime.utcnow()}}
+    )
+    invalidate_product(pid)
+    return result.modified_count > 0
 
 # ---- READ ----
 def get_products_by_user(username):
-    products = list(collection.find({"owner": username}))
+    products = list(collection.find({"owner": username}, {"holds": 0}))
     for p in products:
         p["_id"] = str(p["_id"])
         p["created_at"] = p["created_at"].isoformat()
@@ -52,19 +144,19 @@ def get_products_by_user(username):
 
 # ---- REDUCE QUANTITY OR DELETE ----
 def reduce_quantity(pid, amount, username):
-    product = collection.find_one({"id": pid, "owner": username})
-    if not product:
-        return {"error": "Product not found"}
-
-    current_qty = product["quantity"]
-    if amount >= current_qty:
-        # Xóa hẳn nếu hết hàng
-        collection.delete_one({"id": pid, "owner": username})
+    # Giảm số lượng bằng $inc có điều kiện (nguyên tử, không đọc trước)
+    product = collection.find_one_and_update(
+        {"id": pid, "owner": username, "quantity": {"$gt": amount}},
+        {"$inc": {"quantity": -amount}, "$set": {"updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    invalidate_product(pid)
+    if product:
+        return {"message": f"Đã giảm {amount} sản phẩm. Số lượng còn lại: {product['quantity']}."}
+
+    # Xóa hẳn nếu hết hàng
+    product = collection.find_one_and_delete({"id": pid, "owner": username, "quantity": {"$lte": amount}})
+    invalidate_product(pid)
+    if product:
         return {"message": f"Sản phẩm {product['name']} đã được xóa hoàn toàn."}
-    else:
-        new_qty = current_qty - amount
-        collection.update_one(
-            {"id": pid, "owner": username},
-            {"$set": {"quantity": new_qty, "updated_at": datetime.utcnow()}}
-        )
-        return {"message": f"Đã giảm {amount} sản phẩm. Số lượng còn lại: {new_qty}."}
\ No newline at end of file
+    return {"error": "Product not found"}
@@ -0,0 +1,180 @@
+from pymongo import ReturnDocument, IndexModel, ASCENDING
+from datetime import datetime, timedelta
+from uuid import uuid4
+from models.product_model import db, collection, invalidate_product
+
+reservations = db["reservations"]
+
+RESERVATION_INDEXES = [
+    (reservations, [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Tìm reservation quá hạn cho sweeper
+        IndexModel([("status", ASCENDING), ("expires_at", ASCENDING)], name="status_expires_at"),
+    ]),
+]
+
+# Trạng thái của một reservation:
+#   pending   -> đã ghi reservation, đang trừ số lượng từng sản phẩm
+#   held      -> đã trừ số lượng khả dụng, chờ commit/release
+#   committed -> đơn hàng đã được tạo, số lượng trừ là vĩnh viễn
+#   released  -> huỷ giữ hàng, số lượng đã được trả lại
+#   expired   -> quá TTL mà chưa commit, số lượng đã được trả lại
+#
+# Reservation được ghi trước khi trừ hàng. Mỗi lệnh trừ đồng thời thêm id reservation vào
+# "holds" của sản phẩm, lệnh trả hàng chỉ cộng lại khi id còn trong "holds" rồi xoá nó đi.
+# Nhờ vậy trả hàng là idempotent và chỉ trả đúng những sản phẩm đã bị trừ, kể cả khi process
+# chết giữa chừng (sweeper dọn các reservation pending bị bỏ dở sau PENDING_TIMEOUT).
+PENDING_TIMEOUT = timedelta(seconds=60)
+
+
+def _serialize(reservation):
+    reservation.pop("_id", None)
+    for field in ("expires_at", "created_at", "updated_at"):
+        if isinstance(reservation.get(field), datetime):
+            reservation[field] = reservation[field].isoformat()
+    return reservation
+
+
+def _take_stock(reservation_id, pid, quantity, now):
+    """Trừ quantity của sản phẩm nếu đủ hàng và reservation chưa trừ sản phẩm này"""
+    result = collection.update_one(
+        {"id": pid, "quantity": {"$gte": quantity}, "holds": {"$ne": reservation_id}},
+        {"$inc": {"quantity": -quantity}, "$push": {"holds": reservation_id}, "$set": {"updated_at": now}}
+    )
+    invalidate_product(pid)
+    return result.modified_count > 0
+
+
+def _restore_stock(reservation_id, items):
+    """Trả lại số lượng mà reservation đã giữ (bỏ qua sản phẩm chưa bị trừ hoặc đã trả)"""
+    now = datetime.utcnow()
+    for item in items:
+        collection.update_one(
+            {"id": item["product_id"], "holds": reservation_id},
+            {"$inc": {"quantity": item["quantity"]}, "$pull": {"holds": reservation_id}, "$set": {"updated_at": now}}
+        )
+        invalidate_product(item["product_id"])
+
+
+def _drop_holds(reservation_id, items):
+    """Reservation đã commit: số lượng trừ là vĩnh viễn, chỉ xoá id khỏi "holds" """
+    collection.update_many(
+        {"id": {"$in": [item["product_id"] for item in items]}, "holds": reservation_id},
+        {"$pull": {"holds": reservation_id}}
+    )
+
+
+def create_reservation(items, ttl_seconds, order_id=None):
+    """Giữ hàng cho nhiều sản phẩm bằng các lệnh $inc có điều kiện.
+
+    Mỗi sản phẩm chỉ bị trừ khi quantity >= số lượng cần, nên không thể bán quá số tồn.
+    Nếu một sản phẩm không đủ, các sản phẩm đã trừ trước đó được trả lại.
+    Trả về (reservation, None) hoặc (None, {"product_id", "message"}).
+    """
+    # Gộp các dòng trùng product_id
+    quantities = {}
+    for item in items:
+        pid = int(item["product_id"])
+        quantities[pid] = quantities.get(pid, 0) + int(item["quantity"])
+
+    now = datetime.utcnow()
+    reservation = {
+        "id": uuid4().hex,
+        "order_id": order_id,
+        "items": [{"product_id": pid, "quantity": quantity} for pid, quantity in quantities.items()],
+        "status": "pending",
+        "expires_at": now + timedelta(seconds=ttl_seconds),
+        "created_at": now,
+        "updated_at": now
+    }
+    reservations.insert_one(reservation)
+
+    for item in reservation["items"]:
+        if not _take_stock(reservation["id"], item["product_id"], item["quantity"], now):
+            _restore_stock(reservation["id"], reservation["items"])
+            reservations.delete_one({"id": reservation["id"]})
+            pid = item["product_id"]
+            product = collection.find_one({"id": pid}, {"_id": 0, "quantity": 1})
+            if not product:
+                return None, {"product_id": pid, "message": "Sản phẩm không tồn tại"}
+            return None, {"product_id": pid, "message": f"Không đủ hàng. Tồn kho: {product['quantity']}"}
+
+    reservation = reservations.find_one_and_update(
+        {"id": reservation["id"], "status": "pending"},
+        {"$set": {"status": "held", "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not reservation:
+        # Sweeper đã coi reservation là bị bỏ dở và trả hàng
+        return None, {"product_id": None, "message": "Giữ hàng quá thời gian, vui lòng thử lại"}
+    return _serialize(reservation), None
+
+
+def get_reservation(reservation_id):
+    reservation = reservations.find_one({"id": reservation_id})
+    return _serialize(reservation) if reservation else None
+
+
+def commit_reservation(reservation_id, order_id=None):
+    """held -> committed (chỉ khi chưa hết hạn). Trả về reservation hoặc None.
+
+    Idempotent: commit lại một reservation đã committed trả về chính nó (bên gọi thử lại sau lỗi mạng).
+    """
+    now = datetime.utcnow()
+    update = {"status": "committed", "updated_at": now}
+    if order_id is not None:
+        update["order_id"] = order_id
+    reservation = reservations.find_one_and_update(
+        {"id": reservation_id, "status": "held", "expires_at": {"$gt": now}},
+        {"$set": update},
+        return_document=ReturnDocument.AFTER
+    )
+    if not reservation:
+        reservation = reservations.find_one({"id": reservation_id, "status": "committed"})
+        return _serialize(reservation) if reservation else None
+    _drop_holds(reservation_id, reservation["items"])
+    return _serialize(reservation)
+
+
+def release_reservation(reservation_id):
+    """held -> released và trả lại số lượng. Trả về reservation hoặc None"""
+    reservation = reservations.find_one_and_update(
+        {"id": reservation_id, "status": "held"},
+        {"$set": {"status": "released", "updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not reservation:
+        return None
+    _restore_stock(reservation_id, reservation["items"])
+    return _serialize(reservation)
+
+
+def expire_reservations():
+    """Trả lại hàng cho các reservation quá hạn chưa commit và các reservation pending bị bỏ dở.
+    Trả về số reservation đã xử lý"""
+    count = 0
+    while True:
+        now = datetime.utcnow()
+        # Chuyển trạng thái từng reservation một cách nguyên tử để nhiều worker chạy song song không trả hàng hai lần
+        reservation = reservations.find_one_and_update(
+            {"$or": [
+                {"status": "held", "expires_at": {"$lte": now}},
+                {"status": "pending", "created_at": {"$lte": now - PENDING_TIMEOUT}}
+            ]},
+            {"$set": {"status": "expired", "updated_at": now}}
+        )
+        if not reservation:
+            return count
+        _restore_stock(reservation["id"], reservation["items"])
+        count += 1
+
+
+def return_stock(items):
+    """Cộng lại số lượng cho hàng đã bán nhưng bị huỷ (xoá item/đơn hàng, giảm số lượng)"""
+    now = datetime.utcnow()
+    for item in items:
+        collection.update_one(
+            {"id": int(item["product_id"])},
+            {"$inc": {"quantity": int(item["quantity"])}, "$set": {"updated_at": now}}
+        )
+        invalidate_product(int(item["product_id"]))
@@ -1,209 +1,514 @@
-from flask import Flask, jsonify, request, session
+import csv
+import io
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from flask import Flask, Response, jsonify, request, session, stream_with_context
 from service_registry import register_service
+from index_manager import ensure_indexes
+from service_discovery import ServiceDiscovery
+from token_verifier import TokenVerifier
+from revocation import RevocationList
+from report_engine import ReportEngine
+from leaderboard import METRICS as TOP_METRICS
+from cache import TTLCache
+from http_client import ServiceClient, ServiceUnavailableError
 from models.report_model import *
 from config import *
-import requests
-import consul
 
 app = Flask(__name__)
 app.secret_key = "report_secret"
 
 # ==================== SERVICE DISCOVERY ====================
 
-def get_service_url(service_name):
-    """Lấy URL của service từ Consul"""
-    c = consul.Consul(host=CONSUL_HOST, port=CONSUL_PORT)
-    services = c.agent.services()
-    for s in services.values():
-        if s["Service"] == service_name:
-            return f"http://{s['Address']}:{s['Port']}"
-    return None
+discovery = ServiceDiscovery(CONSUL_HOST, CONSUL_PORT, strategy=DISCOVERY_STRATEGY, wait=DISCOVERY_WAIT)
 
 
-def verify_token(token):
-    """Xác thực token qua Auth Service"""
-    auth_url = get_service_url(AUTH_SERVICE_NAME)
-    if not auth_url:
-        return False
-    
+# ==================== HTTP CLIENT ====================
+
+http_client = ServiceClient(
+    discovery,
+    pool_size=HTTP_POOL_SIZE,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+    max_retries=HTTP_MAX_RETRIES,
+    retry_budget_ratio=HTTP_RETRY_BUDGET_RATIO,
+    failure_threshold=BREAKER_FAILURE_THRESHOLD,
+    reset_timeout=BREAKER_RESET_TIMEOUT,
+    service_token=SERVICE_TOKEN
+)
+
+
+def verify_token_remote(token):
+    """Xác thực token qua Auth Service (TOKEN_VERIFY_MODE=remote)"""
     try:
-        response = requests.post(
-            f"{auth_url}/auth/verify",
-            headers={"Authorization": token},
-            timeout=5
-        )
+        response = http_client.post(AUTH_SERVICE_NAME, "/auth/verify", headers={"Authorization": token})
         return response.json().get("valid", False)
-    except:
+    except (ServiceUnavailableError, ValueError):
         return False
 
 
-def get_order_data(order_id):
-    """Lấy dữ liệu đơn hàng từ Order Service"""
-    order_url = get_service_url(ORDER_SERVICE_NAME)
-    if not order_url:
-        return None
-    
-    try:
-        # Lấy thông tin đơn hàng
-        response = requests.get(f"{order_url}/orders/{order_id}", timeout=5)
-        if response.status_code == 200:
-            return response.json()
-        return None
-    except:
-        return None
+def fetch_revocations(since):
+    """Lấy các jti bị thu hồi từ Auth Service (GET /internal/revocations)"""
+    params = {"since": since} if since is not None else {}
+    response = http_client.get(AUTH_SERVICE_NAME, "/internal/revocations", params=params)
+    if response.status_code != 200:
+        raise ServiceUnavailableError(f"{AUTH_SERVICE_NAME}: HTTP {response.status_code}")
+    return response.json()["revocations"]
 
 
-def get_order_items_data(order_id):
-    """Lấy danh sách order items từ Order Service"""
-    order_url = get_service_url(ORDER_SERVICE_NAME)
-    if not order_url:
-        return []
-    
-    try:
-        response = requests.get(f"{order_url}/orders/{order_id}", timeout=5)
-        if response.status_code == 200:
-            order = response.json()
-            return order.get("items", [])
-        return []
-    except:
-        return []
+# Kiểm tra thu hồi trong bộ nhớ (Bloom filter + tập chính xác), không gọi Auth Service mỗi request
+revocations = RevocationList(fetch_revocations, interval=REVOCATION_REFRESH_INTERVAL)
 
+token_verifier = TokenVerifier(
+    JWT_SECRET,
+    mode=TOKEN_VERIFY_MODE,
+    max_size=TOKEN_CACHE_SIZE,
+    remote_verify=verify_token_remote,
+    revocations=revocations
+)
 
-def get_product_data(product_id):
-    """Lấy dữ liệu sản phẩm từ Product Service"""
-    product_url = get_service_url(PRODUCT_SERVICE_NAME)
-    if not product_url:
-        return None
-    
-    try:
-        response = requests.get(f"{product_url}/products/{product_id}", timeout=5)
+
+def verify_token(token):
+    """Xác thực token (tại chỗ hoặc qua Auth Service tuỳ TOKEN_VERIFY_MODE)"""
+    return token_verifier.verify(token) is not None
+
+
+def get_token_username(token):
+    """Username (claim sub) của token hợp lệ, None nếu token không hợp lệ"""
+    claims = token_verifier.verify(token)
+    return claims.get("sub") if claims else None
+
+
+# Lỗi kết nối/timeout/circuit mở sẽ raise ServiceUnavailableError (trả về 503),
+# chỉ 404 mới được coi là "không tìm thấy"
+
+def get_order_data(order_id, owner):
+    """Lấy dữ liệu đơn hàng (kèm items) từ Order Service (id đơn hàng chỉ duy nhất theo owner)"""
+    response = http_client.get(ORDER_SERVICE_NAME, f"/internal/orders/{order_id}", params={"owner": owner})
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+def get_orders_data(order_keys):
+    """Lấy nhiều đơn hàng kèm items qua POST /internal/orders/batch.
+
+    order_keys: danh sách (owner, order_id). Trả về {(owner, order_id): order}.
+    """
+    order_keys = list(dict.fromkeys((owner, int(oid)) for owner, oid in order_keys))
+    orders = {}
+    for i in range(0, len(order_keys), ORDER_BATCH_SIZE):
+        response = http_client.post(
+            ORDER_SERVICE_NAME, "/internal/orders/batch",
+            json={"orders": [{"owner": owner, "id": oid} for owner, oid in order_keys[i:i + ORDER_BATCH_SIZE]]},
+            retry=True
+        )
         if response.status_code == 200:
-            return response.json()
-        return None
-    except:
-        return None
+            for order in response.json()["orders"]:
+                orders[(order["owner"], order["id"])] = order
+    return orders
+
+
+def find_order_keys(date_from, date_to, limit):
+    """Lấy (owner, id) của tối đa limit đơn hàng tạo trong khoảng [date_from, date_to] (chuỗi ISO 8601).
+
+    Ngày không hợp lệ raise ValueError; Order Service trả lỗi (403, 5xx...) raise ServiceUnavailableError.
+    """
+    params = {"limit": limit}
+    if date_from:
+        params["created_from"] = datetime.fromisoformat(date_from).isoformat()
+    if date_to:
+        params["created_to"] = datetime.fromisoformat(date_to).isoformat()
+    response = http_client.get(ORDER_SERVICE_NAME, "/internal/orders", params=params)
+    if response.status_code != 200:
+        raise ServiceUnavailableError(f"{ORDER_SERVICE_NAME}: HTTP {response.status_code}")
+    return [(order["owner"], order["id"]) for order in response.json()["orders"]]
+
+
+def get_products_data(product_ids):
+    """Lấy nhiều sản phẩm một lần qua POST /products/batch, trả về {product_id: product}"""
+    product_ids = list(dict.fromkeys(int(pid) for pid in product_ids))
+    products = {}
+    for i in range(0, len(product_ids), PRODUCT_BATCH_SIZE):
+        response = http_client.post(
+            PRODUCT_SERVICE_NAME, "/products/batch",
+            json={"ids": product_ids[i:i + PRODUCT_BATCH_SIZE]}, retry=True
+        )
+        if response.status_code == 200:
+            for product in response.json()["products"]:
+                products[product["id"]] = product
+    return products
+
+
+class ReportFetchMemo:
+    """Memo cho một lần tính báo cáo: mỗi đơn hàng / sản phẩm chỉ được lấy từ service khác một lần"""
+
+    def __init__(self):
+        self.orders = {}
+        self.products = {}
+
+    def order(self, order_id, owner):
+        key = (owner, int(order_id))
+        if key not in self.orders:
+            self.orders[key] = get_order_data(key[1], owner)
+        return self.orders[key]
+
+    def prefetch_orders(self, order_keys):
+        """Nạp trước nhiều đơn hàng (owner, id) bằng lời gọi batch; đơn không tìm thấy được ghi nhớ là None"""
+        missing = [(owner, int(oid)) for owner, oid in order_keys if (owner, int(oid)) not in self.orders]
+        if missing:
+            fetched = get_orders_data(missing)
+            for key in missing:
+                self.orders[key] = fetched.get(key)
+
+    def order_items(self, order_id, owner):
+        order = self.order(order_id, owner)
+        return order.get("items", []) if order else []
+
+    def products_by_id(self, product_ids):
+        """Trả về {product_id: product hoặc None}; id chưa có trong memo được lấy bằng một lời gọi batch"""
+        ids = {int(pid) for pid in product_ids}
+        missing = [pid for pid in ids if pid not in self.products]
+        if missing:
+            fetched = get_products_data(missing)
+            for pid in missing:
+                self.products[pid] = fetched.get(pid)
+        return {pid: self.products[pid] for pid in ids}
 
 
 # ==================== HELPER FUNCTIONS ====================
 
-def calculate_order_report(order_id):
-    """Tính toán và tạo báo cáo đơn hàng dựa trên dữ liệu từ Order Service"""
-    # Lấy dữ liệu đơn hàng
-    order = get_order_data(order_id)
+# Cache báo cáo đã tính: (owner, order_id) -> (updated_at của đơn hàng, báo cáo kèm product_reports)
+report_cache = TTLCache(max_size=REPORT_CACHE_SIZE, ttl=REPORT_CACHE_TTL)
+
+# Python cho đơn nhỏ, numpy (nếu có) khi số item >= REPORT_ENGINE_MIN_ITEMS
+report_engine = ReportEngine(mode=REPORT_ENGINE, min_items=REPORT_ENGINE_MIN_ITEMS)
+
+
+def calculate_order_report(order_id, owner, memo=None):
+    """Tính toán và tạo báo cáo đơn hàng (order_id của owner) dựa trên dữ liệu từ Order Service"""
+    memo = memo or ReportFetchMemo()
+    
+    # Lấy dữ liệu đơn hàng (GET /internal/orders/id?owner= đã kèm items)
+    order = memo.order(order_id, owner)
     if not order:
         return None, "Không tìm thấy đơn hàng"
     
-    # Lấy danh sách order items
     items = order.get("items", [])
-    if not items:
-        items = get_order_items_data(order_id)
-    
     if not items:
         return None, "Đơn hàng không có sản phẩm"
     
-    total_revenue = 0.0
-    total_cost = 0.0
-    
-    # Tính toán doanh thu và chi phí từ các order items
-    product_reports_data = []
-    
-    for item in items:
-        product_id = item.get("product_id")
-        quantity = int(item.get("quantity", 0))
-        unit_price = float(item.get("unit_price", 0))
-        revenue = quantity * unit_price
-        total_revenue += revenue
-        
-        # Lấy thông tin sản phẩm để tính chi phí
-        product = get_product_data(product_id)
-        if product:
-            # Giả sử cost là giá nhập, nếu không có thì dùng giá bán * 0.7
-            # Trong thực tế, cần có trường cost trong product
-            cost_per_unit = float(product.get("cost", product.get("price", 0) * 0.7))
-            cost = quantity * cost_per_unit
-            total_cost += cost
-            
-            profit = revenue - cost
-            
-            product_reports_data.append({
-                "product_id": product_id,
-                "total_sold": quantity,
-                "revenue": revenue,
-                "cost": cost,
-                "profit": profit
-            })
-        else:
-            # Nếu không lấy được product, giả sử cost = 70% revenue
-            cost = revenue * 0.7
-            total_cost += cost
-            profit = revenue - cost
-            
-            product_reports_data.append({
-                "product_id": product_id,
-                "total_sold": quantity,
-                "revenue": revenue,
-                "cost": cost,
-                "profit": profit
-            })
-    
-    total_profit = total_revenue - total_cost
+    # Lấy tất cả sản phẩm (không trùng) của đơn trong một lời gọi
+    products = memo.products_by_id(item.get("product_id") for item in items)
     
-    return {
-        "order_id": order_id,
-        "total_revenue": total_revenue,
-        "total_cost": total_cost,
-        "total_profit": total_profit,
-        "product_reports": product_reports_data
-    }, None
+    # Doanh thu, chi phí (giá vốn hoặc 70% nếu thiếu), lợi nhuận cho từng item và tổng đơn
+    report = report_engine.order_reports([order], products)[0]
+    report["order_id"] = order_id
+    report["owner"] = owner
+    report["order_version"] = order.get("updated_at")
+    return report, None
 
 
-def calculate_product_report(order_report_id, product_id):
-    """Tính toán và tạo báo cáo sản phẩm từ order items của một order_report cụ thể"""
+def calculate_product_report(order_report_id, product_id, owner, memo=None):
+    """Tính toán và tạo báo cáo sản phẩm từ order items của một order_report (của owner)"""
+    memo = memo or ReportFetchMemo()
+    
     # order_report_id có thể là order_id
-    order_report = get_order_report_by_id(order_report_id)
+    order_report = get_order_report_by_id(order_report_id, owner)
     if not order_report:
         return None
     
     order_id = order_report.get("order_id", order_report_id)
-    
-    # Lấy order items từ order này
-    items = get_order_items_data(order_id)
-    
-    total_sold = 0
-    total_revenue = 0.0
-    total_cost = 0.0
+    owner = order_report.get("owner") or owner
     
     # Tìm các item có product_id này trong order này
-    for item in items:
-        if item.get("product_id") == product_id:
-            quantity = int(item.get("quantity", 0))
-            unit_price = float(item.get("unit_price", 0))
-            revenue = quantity * unit_price
-            
-            # Lấy thông tin sản phẩm để tính cost
-            product = get_product_data(product_id)
-            if product:
-                # Giả sử cost là giá nhập, nếu không có thì dùng giá bán * 0.7
-                cost_per_unit = float(product.get("cost", product.get("price", 0) * 0.7))
-                cost = quantity * cost_per_unit
-            else:
-                # Nếu không lấy được product, giả sử cost = 70% revenue
-                cost = revenue * 0.7
-            
-            total_sold += quantity
-            total_revenue += revenue
-            total_cost += cost
-    
-    total_profit = total_revenue - total_cost
+    matched = [item for item in memo.order_items(order_id, owner) if item.get("product_id") == product_id]
+    
+    totals = {"total_sold": 0, "revenue": 0.0, "cost": 0.0, "profit": 0.0}
+    if matched:
+        # Lấy thông tin sản phẩm một lần (không lấy lại trong vòng lặp)
+        products = memo.products_by_id([product_id])
+        totals = report_engine.product_totals(matched, products)[int(product_id)]
     
     return {
         "order_report_id": order_report_id,
         "product_id": product_id,
-        "total_sold": total_sold,
-        "revenue": total_revenue,
-        "cost": total_cost,
-        "profit": total_profit
+        "owner": owner,
+        **totals
+    }
+
+
+# Pool dùng chung cho POST /reports/orders/batch để giới hạn số báo cáo tính song song
+report_executor = ThreadPoolExecutor(max_workers=REPORT_BATCH_WORKERS, thread_name_prefix="report-batch")
+
+
+def _calculate_order_report_safe(order_key, memo):
+    owner, order_id = order_key
+    try:
+        return calculate_order_report(order_id, owner, memo)
+    except ServiceUnavailableError as e:
+        return None, f"Service phụ thuộc không khả dụng: {e}"
+
+
+def _persist_reports(pending):
+    """Ghi các báo cáo đã tính, trả về kết quả cho từng đơn"""
+    errors = create_order_reports_bulk(pending)
+    results = []
+    for report_data in pending:
+        order_id = report_data["order_id"]
+        key = (report_data["owner"], order_id)
+        if key in errors:
+            results.append({"order_id": order_id, "status": "error", "error": errors[key]})
+        else:
+            results.append({
+                "order_id": order_id,
+                "status": "created",
+                "total_revenue": report_data["total_revenue"],
+                "total_profit": report_data["total_profit"]
+            })
+    return results
+
+
+def generate_order_reports(order_keys):
+    """Tạo báo cáo cho nhiều đơn hàng (owner, id), yield kết quả của từng đơn theo từng nhóm.
+
+    Mỗi nhóm REPORT_BATCH_WRITE_SIZE đơn: lấy đơn hàng và sản phẩm bằng lời gọi batch,
+    tính báo cáo trên report_executor, rồi ghi bằng insert_many.
+    """
+    order_keys = list(dict.fromkeys((owner, int(oid)) for owner, oid in order_keys))
+    for i in range(0, len(order_keys), REPORT_BATCH_WRITE_SIZE):
+        chunk = order_keys[i:i + REPORT_BATCH_WRITE_SIZE]
+        existing = get_existing_order_report_ids(chunk)
+        for key in chunk:
+            if key in existing:
+                yield {"order_id": key[1], "status": "exists"}
+        todo = [key for key in chunk if key not in existing]
+        if not todo:
+            continue
+
+        memo = ReportFetchMemo()
+        try:
+            memo.prefetch_orders(todo)
+            memo.products_by_id({
+                item["product_id"]
+                for order in memo.orders.values() if order
+                for item in order.get("items", [])
+            })
+        except ServiceUnavailableError as e:
+            for _, order_id in todo:
+                yield {"order_id": order_id, "status": "error", "error": f"Service phụ thuộc không khả dụng: {e}"}
+            continue
+
+        pending = []
+        item_count = sum(len(order.get("items", [])) for order in memo.orders.values() if order)
+        if report_engine.use_numpy(item_count):
+            # Nhóm lớn: tính cả nhóm theo cột trong một lần (numpy), không cần chia cho các worker
+            valid = []
+            for key in todo:
+                order = memo.orders.get(key)
+                if not order:
+                    yield {"order_id": key[1], "status": "error", "error": "Không tìm thấy đơn hàng"}
+                elif not order.get("items"):
+                    yield {"order_id": key[1], "status": "error", "error": "Đơn hàng không có sản phẩm"}
+                else:
+                    valid.append(order)
+            for order, report_data in zip(valid, report_engine.order_reports(valid, memo.products)):
+                report_data["order_id"] = order["id"]
+                report_data["owner"] = order["owner"]
+                report_data["order_version"] = order.get("updated_at")
+                pending.append(report_data)
+        else:
+            for key, (report_data, error) in zip(
+                    todo, report_executor.map(lambda key: _calculate_order_report_safe(key, memo), todo)):
+                if error:
+                    yield {"order_id": key[1], "status": "error", "error": error}
+                else:
+                    pending.append(report_data)
+        if pending:
+            yield from _persist_reports(pending)
+
+
+# ==================== SCHEDULED REFRESH ====================
+
+REFRESH_JOB = "order_report_refresh"
+# Định danh instance để giữ lease của job (nhiều instance chỉ một instance chạy)
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def refresh_changed_orders():
+    """Tính lại báo cáo cho một trang đơn hàng thay đổi sau con trỏ (updated_at, owner, id).
+
+    Đơn hàng chưa có báo cáo cũng được tạo báo cáo. Báo cáo đã đúng phiên bản thì bỏ qua.
+    Lần chạy đầu tiên chỉ đặt con trỏ ở thời điểm hiện tại (không tự tính lại toàn bộ lịch sử;
+    dùng POST /reports/orders/batch với date_from/date_to để tạo báo cáo cho đơn cũ).
+    Trả về số liệu lần chạy, hoặc None nếu instance khác đang chạy job.
+    """
+    state = acquire_job_lease(REFRESH_JOB, INSTANCE_ID, REPORT_REFRESH_INTERVAL * 2)
+    if not state:
+        return None
+    
+    started = time.time()
+    cursor = state.get("cursor")
+    if not cursor and state.get("watermark"):
+        # Trạng thái cũ chỉ có watermark: bắt đầu lại từ đầu mốc đó (đơn đã tính được bỏ qua nhờ order_version)
+        cursor = {"updated_at": state["watermark"], "owner": "", "id": 0}
+    if not cursor:
+        cursor = {"updated_at": datetime.utcnow(), "owner": "", "id": 0}
+        run_stats = {
+            "run_at": datetime.utcnow(), "duration_ms": 0.0, "fetched": 0, "processed": 0,
+            "skipped": 0, "failed": 0, "caught_up": True, "lag_seconds": 0
+        }
+        finish_job_run(REFRESH_JOB, INSTANCE_ID, cursor, run_stats)
+        return run_stats
+    
+    response = http_client.get(ORDER_SERVICE_NAME, "/internal/orders", params={
+        "updated_since": cursor["updated_at"].isoformat(),
+        "after_owner": cursor["owner"],
+        "after_id": cursor["id"],
+        "limit": REPORT_REFRESH_BATCH_SIZE
+    })
+    if response.status_code != 200:
+        raise ServiceUnavailableError(f"{ORDER_SERVICE_NAME}: HTTP {response.status_code}")
+    changed = response.json()["orders"]
+    
+    versions = get_order_report_versions((order["owner"], order["id"]) for order in changed)
+    todo = [
+        (order["owner"], order["id"]) for order in changed
+        if versions.get((order["owner"], order["id"])) != order["updated_at"]
+    ]
+    
+    processed = failed = 0
+    if todo:
+        memo = ReportFetchMemo()
+        memo.prefetch_orders(todo)
+        memo.products_by_id({
+            item["product_id"]
+            for order in memo.orders.values() if order
+            for item in order.get("items", [])
+        })
+        for owner, order_id in todo:
+            report_data, error = calculate_order_report(order_id, owner, memo)
+            if error:
+                failed += 1
+                continue
+            upsert_order_report(report_data)
+            report_cache.delete((owner, order_id))
+            processed += 1
+    
+    caught_up = len(changed) < REPORT_REFRESH_BATCH_SIZE
+    if changed:
+        # Con trỏ keyset: trang sau bắt đầu ngay sau đơn cuối, kể cả khi cả trang trùng updated_at
+        last = changed[-1]
+        cursor = {"updated_at": datetime.fromisoformat(last["updated_at"]), "owner": last["owner"], "id": last["id"]}
+    
+    run_stats = {
+        "run_at": datetime.utcnow(),
+        "duration_ms": round((time.time() - started) * 1000, 1),
+        "fetched": len(changed),
+        "processed": processed,
+        "skipped": len(changed) - len(todo),
+        "failed": failed,
+        "caught_up": caught_up,
+        # Độ trễ: thời gian từ con trỏ tới hiện tại khi còn đơn chưa xử lý
+        "lag_seconds": 0 if caught_up else round((datetime.utcnow() - cursor["updated_at"]).total_seconds(), 1)
     }
+    finish_job_run(REFRESH_JOB, INSTANCE_ID, cursor, run_stats)
+    return run_stats
+
+
+def start_report_refresher():
+    """Thread nền tính lại báo cáo của các đơn hàng đã thay đổi sau mỗi REPORT_REFRESH_INTERVAL giây"""
+    def refresh():
+        while True:
+            delay = REPORT_REFRESH_INTERVAL
+            try:
+                run_stats = refresh_changed_orders()
+                if run_stats and run_stats["fetched"]:
+                    print(f"[REFRESH] Processed {run_stats['processed']}, skipped {run_stats['skipped']}, "
+                          f"failed {run_stats['failed']} in {run_stats['duration_ms']} ms")
+                # Còn đơn chưa xử lý: chạy trang tiếp theo sau một khoảng nghỉ ngắn
+                if run_stats and not run_stats["caught_up"]:
+                    delay = REPORT_REFRESH_CATCHUP_DELAY
+            except Exception as e:
+                print(f"[REFRESH] Lỗi: {e}")
+            time.sleep(delay)
+    
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def _parse_datetime_arg(name):
+    """Đọc tham số thời gian ISO 8601 từ query string, quy về UTC naive như dữ liệu trong MongoDB"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _parse_window(value):
+    """"24h" / "7d" / "all" -> timedelta (None = toàn thời gian); raise ValueError nếu sai định dạng"""
+    if value == "all":
+        return None
+    units = {"h": "hours", "d": "days"}
+    if len(value) < 2 or value[-1] not in units or not value[:-1].isdigit() or int(value[:-1]) <= 0:
+        raise ValueError(value)
+    return timedelta(**{units[value[-1]]: int(value[:-1])})
+
+
+# Độ dài xấp xỉ của mỗi bucket, dùng để giới hạn số bucket trong một response
+_BUCKET_LENGTH = {"hour": timedelta(hours=1), "day": timedelta(days=1), "month": timedelta(days=28)}
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _export_response(rows, fields, fmt, filename):
+    """Stream các dòng từ cursor MongoDB dưới dạng CSV hoặc NDJSON (bộ nhớ không phụ thuộc số dòng)"""
+    if fmt == "csv":
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(fields)
+            for row in rows:
+                writer.writerow([_export_value(row.get(field)) for field in fields])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        mimetype = "text/csv"
+    else:
+        def generate():
+            for row in rows:
+                yield json.dumps({field: _export_value(row.get(field)) for field in fields}, ensure_ascii=False) + "\n"
+        mimetype = "application/x-ndjson"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"}
+    )
+
+
+def _export_args():
+    """(format, date_from, date_to, product_id) từ query string; raise ValueError nếu không hợp lệ"""
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        raise ValueError("format phải là csv hoặc ndjson")
+    try:
+        date_from = _parse_datetime_arg("from")
+        date_to = _parse_datetime_arg("to")
+    except ValueError:
+        raise ValueError("from/to phải theo định dạng ISO 8601")
+    return fmt, date_from, date_to, request.args.get("product_id", type=int)
 
 
 # ==================== HEALTH CHECK ====================
@@ -213,6 +518,25 @@ def health():
     return jsonify({"status": "UP"}), 200
 
 
+@app.route("/internal/stats")
+def internal_stats():
+    """Trạng thái connection pool, circuit breaker, service discovery và token cache"""
+    return jsonify({
+        "http": http_client.stats(),
+        "discovery": discovery.stats(),
+        "token_cache": token_verifier.stats(),
+        "revocations": revocations.stats(),
+        "report_cache": report_cache.stats(),
+        "report_refresh": get_job_state(REFRESH_JOB),
+        "leaderboard": product_leaderboard.stats()
+    }), 200
+
+
+@app.errorhandler(ServiceUnavailableError)
+def handle_service_unavailable(e):
+    return jsonify({"error": f"Service phụ thuộc không khả dụng: {e}"}), 503
+
+
 # ==================== ORDERS REPORTS API ====================
 
 @app.route("/reports/orders", methods=["GET"])
@@ -227,18 +551,36 @@ def get_order_reports():
     return jsonify(reports), 200
 
 
+@app.route("/reports/orders/export", methods=["GET"])
+def export_order_reports():
+    """GET /reports/orders/export?format=csv|ndjson&from=&to=&product_id= - Xuất báo cáo đơn hàng (stream)"""
+    # Kiểm tra token
+    token = request.headers.get("Authorization")
+    if not token or not verify_token(token):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    try:
+        fmt, date_from, date_to, product_id = _export_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    rows = iter_order_reports(date_from, date_to, product_id, REPORT_EXPORT_BATCH_SIZE)
+    return _export_response(rows, ORDER_REPORT_EXPORT_FIELDS, fmt, "order_reports")
+
+
 @app.route("/reports/orders/<int:report_id>", methods=["GET"])
 def get_order_report(report_id):
     """GET /reports/orders/id - Lấy chi tiết báo cáo cho một đơn hàng"""
-    # Kiểm tra token
+    # Kiểm tra token (id đơn hàng chỉ duy nhất theo user: lấy báo cáo đơn hàng của chính user)
     token = request.headers.get("Authorization")
-    if not token or not verify_token(token):
+    username = get_token_username(token) if token else None
+    if not username:
         return jsonify({"error": "Unauthorized"}), 401
     
-    report = get_order_report_by_id(report_id)
+    report = get_order_report_by_id(report_id, username)
     if report:
         # Lấy thêm các product reports liên quan
-        product_reports = get_product_reports_by_order_report_id(report_id)
+        product_reports = get_product_reports_by_order_report_id(report_id, username)
         report["product_reports"] = product_reports
         return jsonify(report), 200
     
@@ -246,11 +588,16 @@ def get_order_report(report_id):
 
 
 @app.route("/reports/orders", methods=["POST"])
-def create_order_report():
-    """POST /reports/orders - Tạo báo cáo đơn hàng mới dựa trên dữ liệu từ dịch vụ quản lý đơn hàng"""
-    # Kiểm tra token
+def create_order_report_route():
+    """POST /reports/orders - Tạo báo cáo đơn hàng mới dựa trên dữ liệu từ dịch vụ quản lý đơn hàng
+
+    Đơn hàng chưa thay đổi (cùng updated_at) -> trả về báo cáo đã có (200) mà không tính lại.
+    Đơn hàng đã thay đổi -> tính lại và cập nhật báo cáo (200); chưa có báo cáo -> tạo mới (201).
+    """
+    # Kiểm tra token (báo cáo được tính cho đơn hàng của chính user)
     token = request.headers.get("Authorization")
-    if not token or not verify_token(token):
+    username = get_token_username(token) if token else None
+    if not username:
         return jsonify({"error": "Unauthorized"}), 401
     
     data = request.get_json()
@@ -261,59 +608,110 @@ def create_order_report():
     if "order_id" not in data:
         return jsonify({"error": "Thiếu trường order_id"}), 400
     
-    order_id = data["order_id"]
-    
-    # Kiểm tra xem đã có báo cáo cho order này chưa
-    existing_report = get_order_report_by_order_id(order_id)
-    if existing_report:
-        return jsonify({"error": "Báo cáo cho đơn hàng này đã tồn tại", "report": existing_report}), 400
+    try:
+        order_id = int(data["order_id"])
+    except (TypeError, ValueError):
+        return jsonify({"error": "order_id phải là số nguyên"}), 400
+    
+    # Phiên bản hiện tại của đơn hàng (updated_at); đơn hàng được memo lại để tính báo cáo nếu cần
+    memo = ReportFetchMemo()
+    order = memo.order(order_id, username)
+    order_version = order.get("updated_at") if order else None
+    
+    # Cache và báo cáo đã lưu đều theo (owner, order_id): chỉ trả về báo cáo của chính user
+    cache_key = (username, order_id)
+    if order_version:
+        hit, cached = report_cache.get(cache_key)
+        if hit and cached[0] == order_version:
+            return jsonify(cached[1]), 200
+        
+        # Báo cáo đã lưu vẫn đúng với phiên bản đơn hàng hiện tại
+        existing_report = get_order_report_by_order_id(order_id, username)
+        if existing_report and existing_report.get("order_version") == order_version:
+            existing_report["product_reports"] = get_product_reports_by_order_report_id(order_id, username)
+            report_cache.set(cache_key, (order_version, existing_report))
+            return jsonify(existing_report), 200
     
     # Tính toán báo cáo
-    report_data, error = calculate_order_report(order_id)
+    report_data, error = calculate_order_report(order_id, username, memo)
     if error:
         return jsonify({"error": error}), 400
     
-    # Tạo order report
-    order_report = create_order_report(
-        report_data["order_id"],
-        report_data["total_revenue"],
-        report_data["total_cost"],
-        report_data["total_profit"]
-    )
+    # Tạo mới hoặc cập nhật order report và các product reports
+    created, report = upsert_order_report(report_data)
+    if not report:
+        # Báo cáo vừa bị xoá bởi request khác
+        return jsonify({"error": "Báo cáo vừa bị thay đổi, vui lòng thử lại"}), 409
     
-    if not order_report:
-        return jsonify({"error": "Lỗi khi tạo báo cáo đơn hàng"}), 500
-    
-    order_report_id = order_report.get("order_id")
-    
-    # Tạo các product reports
-    for product_report_data in report_data["product_reports"]:
-        create_product_report(
-            order_report_id,
-            product_report_data["product_id"],
-            product_report_data["total_sold"],
-            product_report_data["revenue"],
-            product_report_data["cost"],
-            product_report_data["profit"]
-        )
+    report["product_reports"] = get_product_reports_by_order_report_id(order_id, username)
+    if order_version:
+        report_cache.set(cache_key, (order_version, report))
     
-    # Lấy lại report đầy đủ
-    created_report = get_order_report_by_id(order_report_id)
-    product_reports = get_product_reports_by_order_report_id(order_report_id)
-    created_report["product_reports"] = product_reports
+    return jsonify(report), 201 if created else 200
+
+
+@app.route("/reports/orders/batch", methods=["POST"])
+def create_order_reports_batch():
+    """POST /reports/orders/batch - Tạo báo cáo cho nhiều đơn hàng (order_ids hoặc date_from/date_to)
+
+    Trả về kết quả từng đơn: created / exists / error.
+    "stream": true -> trả về NDJSON, mỗi dòng là kết quả của một đơn (theo dõi tiến độ).
+    """
+    # Kiểm tra token
+    token = request.headers.get("Authorization")
+    username = get_token_username(token) if token else None
+    if not username:
+        return jsonify({"error": "Unauthorized"}), 401
     
-    return jsonify(created_report), 201
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "Thiếu dữ liệu JSON"}), 400
+    
+    if "order_ids" in data:
+        if not isinstance(data["order_ids"], list):
+            return jsonify({"error": "order_ids phải là danh sách"}), 400
+        try:
+            # order_ids: đơn hàng của chính user
+            order_keys = [(username, int(oid)) for oid in data["order_ids"]]
+        except (TypeError, ValueError):
+            return jsonify({"error": "order_ids phải là danh sách số nguyên"}), 400
+    elif data.get("date_from") or data.get("date_to"):
+        # Lấy thêm một đơn để biết khoảng thời gian có vượt quá giới hạn hay không
+        try:
+            order_keys = find_order_keys(data.get("date_from"), data.get("date_to"), REPORT_BATCH_MAX_ORDERS + 1)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Khoảng thời gian không hợp lệ (ISO 8601)"}), 400
+    else:
+        return jsonify({"error": "Thiếu order_ids hoặc date_from/date_to"}), 400
+    
+    if len(order_keys) > REPORT_BATCH_MAX_ORDERS:
+        return jsonify({"error": f"Tối đa {REPORT_BATCH_MAX_ORDERS} đơn hàng mỗi lần, hãy thu hẹp khoảng thời gian"}), 400
+    
+    if data.get("stream"):
+        def stream():
+            for result in generate_order_reports(order_keys):
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+    
+    results = list(generate_order_reports(order_keys))
+    return jsonify({
+        "results": results,
+        "created": sum(1 for r in results if r["status"] == "created"),
+        "failed": sum(1 for r in results if r["status"] == "error")
+    }), 200
 
 
 @app.route("/reports/orders/<int:report_id>", methods=["DELETE"])
 def delete_order_report_route(report_id):
     """DELETE /reports/orders/id - Xóa báo cáo đơn hàng"""
-    # Kiểm tra token
+    # Kiểm tra token (chỉ xoá báo cáo đơn hàng của chính user)
     token = request.headers.get("Authorization")
-    if not token or not verify_token(token):
+    username = get_token_username(token) if token else None
+    if not username:
         return jsonify({"error": "Unauthorized"}), 401
     
-    deleted = delete_order_report(report_id)
+    deleted = delete_order_report(report_id, username)
+    report_cache.delete((username, report_id))
     if deleted:
         return jsonify({"message": "Xóa báo cáo đơn hàng thành công"}), 200
     
@@ -334,6 +732,59 @@ def get_product_reports():
     return jsonify(reports), 200
 
 
+@app.route("/reports/products/export", methods=["GET"])
+def export_product_reports():
+    """GET /reports/products/export?format=csv|ndjson&from=&to=&product_id= - Xuất báo cáo sản phẩm (stream)"""
+    # Kiểm tra token
+    token = request.headers.get("Authorization")
+    if not token or not verify_token(token):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    try:
+        fmt, date_from, date_to, product_id = _export_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    rows = iter_product_reports(date_from, date_to, product_id, REPORT_EXPORT_BATCH_SIZE)
+    return _export_response(rows, PRODUCT_REPORT_EXPORT_FIELDS, fmt, "product_reports")
+
+
+@app.route("/reports/products/top", methods=["GET"])
+def get_top_products():
+    """GET /reports/products/top?by=revenue|profit|total_sold&n=20&window=24h|7d|all
+
+    window <= REPORT_TOP_EXACT_DAYS ngày hoặc "all": chính xác (report_buckets / product_stats).
+    Dài hơn: ước lượng từ count-min sketch theo tuần, kèm số đơn hàng khác nhau (HyperLogLog).
+    """
+    # Kiểm tra token
+    token = request.headers.get("Authorization")
+    if not token or not verify_token(token):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    by = request.args.get("by", "revenue")
+    if by not in TOP_METRICS:
+        return jsonify({"error": f"by phải là một trong {', '.join(TOP_METRICS)}"}), 400
+    
+    n = request.args.get("n", 20, type=int)
+    if not 1 <= n <= REPORT_TOP_MAX_N:
+        return jsonify({"error": f"n phải từ 1 đến {REPORT_TOP_MAX_N}"}), 400
+    
+    window_arg = request.args.get("window", "all")
+    try:
+        window = _parse_window(window_arg)
+    except ValueError:
+        return jsonify({"error": "window phải có dạng 24h, 7d hoặc all"}), 400
+    
+    approximate = window is not None and window > timedelta(days=REPORT_TOP_EXACT_DAYS)
+    since = datetime.utcnow() - window if window is not None else None
+    if approximate:
+        products = product_leaderboard.top(by, n, since)
+    else:
+        products = get_top_products_exact(by, n, since)
+    
+    return jsonify({"by": by, "n": n, "window": window_arg, "approximate": approximate, "products": products}), 200
+
+
 @app.route("/reports/products/<int:report_id>", methods=["GET"])
 def get_product_report(report_id):
     """GET /reports/products/id - Lấy chi tiết báo cáo cho một sản phẩm"""
@@ -354,7 +805,8 @@ def create_product_report_route():
     """POST /reports/products - Tạo báo cáo sản phẩm mới dựa trên dữ liệu từ dịch vụ quản lý sản phẩm và quản lý đơn hàng"""
     # Kiểm tra token
     token = request.headers.get("Authorization")
-    if not token or not verify_token(token):
+    username = get_token_username(token) if token else None
+    if not username:
         return jsonify({"error": "Unauthorized"}), 401
     
     data = request.get_json()
@@ -371,12 +823,12 @@ def create_product_report_route():
     product_id = data["product_id"]
     
     # Kiểm tra order_report có tồn tại không
-    order_report = get_order_report_by_id(order_report_id)
+    order_report = get_order_report_by_id(order_report_id, username)
     if not order_report:
         return jsonify({"error": "Báo cáo đơn hàng không tồn tại"}), 404
     
     # Tính toán báo cáo sản phẩm
-    report_data = calculate_product_report(order_report_id, product_id)
+    report_data = calculate_product_report(order_report_id, product_id, username)
     if not report_data:
         return jsonify({"error": "Lỗi khi tính toán báo cáo sản phẩm"}), 500
     
@@ -387,7 +839,8 @@ def create_product_report_route():
         report_data["total_sold"],
         report_data["revenue"],
         report_data["cost"],
-        report_data["profit"]
+        report_data["profit"],
+        owner=report_data["owner"]
     )
     
     if not created_report:
@@ -417,6 +870,47 @@ def delete_product_report_route(report_id):
     return jsonify({"error": "Không tìm thấy báo cáo sản phẩm"}), 404
 
 
+# ==================== TIME SERIES API ====================
+
+@app.route("/reports/timeseries", methods=["GET"])
+def get_report_timeseries():
+    """GET /reports/timeseries?granularity=hour|day|month&from=&to=&product_id=
+
+    Doanh thu / chi phí / lợi nhuận theo bucket thời gian, đọc từ các bucket gộp sẵn.
+    Mặc định: granularity=day, TIMESERIES_DEFAULT_DAYS ngày gần nhất (theo giờ: 7 ngày).
+    """
+    # Kiểm tra token
+    token = request.headers.get("Authorization")
+    if not token or not verify_token(token):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    granularity = request.args.get("granularity", "day")
+    if granularity not in GRANULARITIES:
+        return jsonify({"error": f"granularity phải là một trong {', '.join(GRANULARITIES)}"}), 400
+    
+    try:
+        date_to = _parse_datetime_arg("to") or datetime.utcnow()
+        # Theo giờ: mặc định 7 ngày gần nhất để không vượt TIMESERIES_MAX_BUCKETS
+        default_days = 7 if granularity == "hour" else TIMESERIES_DEFAULT_DAYS
+        date_from = _parse_datetime_arg("from") or date_to - timedelta(days=default_days)
+    except ValueError:
+        return jsonify({"error": "from/to phải theo định dạng ISO 8601"}), 400
+    if date_from >= date_to:
+        return jsonify({"error": "from phải trước to"}), 400
+    if (date_to - date_from) / _BUCKET_LENGTH[granularity] > TIMESERIES_MAX_BUCKETS:
+        return jsonify({"error": f"Khoảng thời gian quá dài cho granularity={granularity} (tối đa {TIMESERIES_MAX_BUCKETS} bucket)"}), 400
+    
+    product_id = request.args.get("product_id", type=int)
+    buckets = get_timeseries(granularity, date_from, date_to, product_id)
+    return jsonify({
+        "granularity": granularity,
+        "from": date_from.isoformat(),
+        "to": date_to.isoformat(),
+        "product_id": product_id,
+        "buckets": buckets
+    }), 200
+
+
 # ==================== STATISTICS API (Bonus) ====================
 
 @app.route("/reports/products/<int:product_id>/statistics", methods=["GET"])
@@ -435,6 +929,12 @@ def get_product_statistics(product_id):
 
 
 if __name__ == "__main__":
+    ensure_indexes(INDEXES, OBSOLETE_INDEXES)
     register_service()
+    revocations.start()
+    if REPORT_REFRESH_ENABLED:
+        start_report_refresher()
+    # Nạp sketch top-N từ product_reports gần đây (chạy nền, không chặn khởi động)
+    threading.Thread(target=warm_up_leaderboard, daemon=True).start()
     app.run(host="0.0.0.0", port=SERVICE_PORT, debug=True)
 
@@ -0,0 +1,79 @@
+"""So sánh tốc độ tính báo cáo giữa vòng lặp Python và numpy trên dữ liệu giả lập.
+
+Kiểm tra hai cách tính cho kết quả giống hệt nhau rồi in thời gian mỗi cách.
+Chạy: python benchmark_report_engine.py [số đơn hàng] [số item mỗi đơn]
+"""
+import random
+import sys
+import time
+
+from report_engine import ReportEngine
+
+
+def make_data(order_count, items_per_order, product_count=500, seed=42):
+    rng = random.Random(seed)
+    products = {}
+    for pid in range(1, product_count + 1):
+        roll = rng.random()
+        if roll < 0.1:
+            products[pid] = None  # không lấy được sản phẩm
+        elif roll < 0.5:
+            products[pid] = {"id": pid, "price": round(rng.uniform(1, 500), 2)}
+        else:
+            price = round(rng.uniform(1, 500), 2)
+            products[pid] = {"id": pid, "price": price, "cost": round(price * rng.uniform(0.3, 0.9), 2)}
+    orders = [
+        {
+            "id": oid,
+            "items": [
+                {
+                    "product_id": rng.randint(1, product_count),
+                    "quantity": rng.randint(1, 20),
+                    "unit_price": round(rng.uniform(1, 500), 2)
+                }
+                for _ in range(items_per_order)
+            ]
+        }
+        for oid in range(1, order_count + 1)
+    ]
+    return orders, products
+
+
+def timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def main(argv):
+    order_count = int(argv[0]) if len(argv) > 0 else 2000
+    items_per_order = int(argv[1]) if len(argv) > 1 else 50
+    orders, products = make_data(order_count, items_per_order)
+    items = [item for order in orders for item in order["items"]]
+    print(f"[BENCH] {order_count} đơn hàng, {len(items)} items")
+
+    python_engine = ReportEngine(mode="python")
+    numpy_engine = ReportEngine(mode="numpy")
+    if not numpy_engine.numpy_available:
+        print("[BENCH] Chưa cài numpy, chỉ có cách tính Python")
+        return
+
+    for name, run in (
+        ("order_reports", lambda engine: engine.order_reports(orders, products)),
+        ("product_totals", lambda engine: engine.product_totals(items, products)),
+    ):
+        expected, python_time = timed(lambda: run(python_engine))
+        actual, numpy_time = timed(lambda: run(numpy_engine))
+        if actual != expected:
+            print(f"[BENCH] {name}: kết quả numpy KHÁC Python")
+            sys.exit(1)
+        print(f"[BENCH] {name}: python {python_time * 1000:.1f} ms, numpy {numpy_time * 1000:.1f} ms, "
+              f"x{python_time / numpy_time:.2f} (kết quả giống hệt)")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -16,3 +16,71 @@ ORDER_SERVICE_NAME = os.getenv("ORDER_SERVICE_NAME", "order-service")
 CONSUL_HOST = os.getenv("CONSUL_HOST", "localhost")
 CONSUL_PORT = int(os.getenv("CONSUL_PORT", "8500"))
 
+# Khoá dùng chung giữa các service cho API nội bộ (header X-Service-Token)
+SERVICE_TOKEN = os.getenv("SERVICE_TOKEN", "myservicetoken")
+
+# Service Discovery Configuration: "round_robin" hoặc "least_outstanding"
+DISCOVERY_STRATEGY = os.getenv("DISCOVERY_STRATEGY", "round_robin")
+DISCOVERY_WAIT = os.getenv("DISCOVERY_WAIT", "30s")
+
+# HTTP Client Configuration (gọi Auth/Order/Product Service)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "3"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "1"))
+# Tỉ lệ retry tối đa so với số request (retry budget)
+HTTP_RETRY_BUDGET_RATIO = float(os.getenv("HTTP_RETRY_BUDGET_RATIO", "0.1"))
+# Circuit breaker: mở sau N lỗi liên tiếp, thử lại sau RESET giây
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "10"))
+# Số product_id tối đa trong một lời gọi POST /products/batch
+PRODUCT_BATCH_SIZE = int(os.getenv("PRODUCT_BATCH_SIZE", "100"))
+# Số order_id tối đa trong một lời gọi POST /internal/orders/batch
+ORDER_BATCH_SIZE = int(os.getenv("ORDER_BATCH_SIZE", "100"))
+
+# Bulk Report Configuration (POST /reports/orders/batch)
+REPORT_BATCH_WORKERS = int(os.getenv("REPORT_BATCH_WORKERS", "8"))
+# Số báo cáo ghi vào MongoDB trong một lần insert_many
+REPORT_BATCH_WRITE_SIZE = int(os.getenv("REPORT_BATCH_WRITE_SIZE", "200"))
+REPORT_BATCH_MAX_ORDERS = int(os.getenv("REPORT_BATCH_MAX_ORDERS", "10000"))
+# Cách tính báo cáo: "auto" (numpy khi số item >= REPORT_ENGINE_MIN_ITEMS), "python" hoặc "numpy"
+REPORT_ENGINE = os.getenv("REPORT_ENGINE", "auto")
+REPORT_ENGINE_MIN_ITEMS = int(os.getenv("REPORT_ENGINE_MIN_ITEMS", "1000"))
+
+# Report Cache Configuration (báo cáo đã tính, theo order_id + updated_at của đơn hàng)
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "10000"))
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "300"))
+
+# JWT Configuration (dùng chung JWT_SECRET với Auth Service)
+JWT_SECRET = os.getenv("JWT_SECRET", "mysecretkey")
+# "local": kiểm tra chữ ký JWT trong process, "remote": gọi /auth/verify của Auth Service
+TOKEN_VERIFY_MODE = os.getenv("TOKEN_VERIFY_MODE", "local")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+# Time Series Configuration (GET /reports/timeseries)
+TIMESERIES_DEFAULT_DAYS = int(os.getenv("TIMESERIES_DEFAULT_DAYS", "90"))
+# Số bucket tối đa trong một response (tránh hỏi theo giờ cho khoảng thời gian quá dài)
+TIMESERIES_MAX_BUCKETS = int(os.getenv("TIMESERIES_MAX_BUCKETS", "2000"))
+
+# Export Configuration (GET /reports/orders/export, /reports/products/export)
+REPORT_EXPORT_BATCH_SIZE = int(os.getenv("REPORT_EXPORT_BATCH_SIZE", "1000"))
+
+# Scheduled Report Refresh (tính lại báo cáo cho đơn hàng thay đổi sau watermark)
+REPORT_REFRESH_ENABLED = os.getenv("REPORT_REFRESH_ENABLED", "true").lower() == "true"
+REPORT_REFRESH_INTERVAL = int(os.getenv("REPORT_REFRESH_INTERVAL", "60"))
+# Số đơn hàng tối đa mỗi lần chạy
+REPORT_REFRESH_BATCH_SIZE = int(os.getenv("REPORT_REFRESH_BATCH_SIZE", "500"))
+# Nghỉ giữa hai trang khi còn đơn chưa xử lý (giây), để không dồn tải lên Order Service
+REPORT_REFRESH_CATCHUP_DELAY = float(os.getenv("REPORT_REFRESH_CATCHUP_DELAY", "1"))
+
+# Top-N Leaderboard (GET /reports/products/top)
+# Khoảng thời gian <= REPORT_TOP_EXACT_DAYS ngày: tính chính xác từ report_buckets,
+# dài hơn: ước lượng bằng count-min sketch + HyperLogLog theo tuần
+REPORT_TOP_EXACT_DAYS = int(os.getenv("REPORT_TOP_EXACT_DAYS", "31"))
+REPORT_TOP_MAX_N = int(os.getenv("REPORT_TOP_MAX_N", "100"))
+REPORT_TOP_SKETCH_WEEKS = int(os.getenv("REPORT_TOP_SKETCH_WEEKS", "53"))
+REPORT_TOP_SKETCH_WIDTH = int(os.getenv("REPORT_TOP_SKETCH_WIDTH", "1024"))
+REPORT_TOP_SKETCH_DEPTH = int(os.getenv("REPORT_TOP_SKETCH_DEPTH", "4"))
+
+# Thu hồi token: lấy danh sách jti bị thu hồi từ Auth Service mỗi REVOCATION_REFRESH_INTERVAL giây
+REVOCATION_REFRESH_INTERVAL = float(os.getenv("REVOCATION_REFRESH_INTERVAL", "5"))
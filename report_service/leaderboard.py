@@ -0,0 +1,220 @@
+"""Bảng xếp hạng sản phẩm xấp xỉ cho các khoảng thời gian dài.
+
+Mỗi tuần (epoch) giữ:
+- một count-min sketch cho mỗi chỉ số (revenue, profit, total_sold),
+- một tập ứng viên top-K cho mỗi chỉ số (heavy hitters theo ước lượng của sketch),
+- HyperLogLog đếm số đơn hàng khác nhau cho các sản phẩm đang là ứng viên.
+
+Bộ nhớ chỉ phụ thuộc số epoch, kích thước sketch và K, không phụ thuộc số báo cáo.
+"""
+import hashlib
+import heapq
+import math
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+METRICS = ("revenue", "profit", "total_sold")
+EPOCH_DAYS = 7
+_EPOCH_ORIGIN = datetime(1970, 1, 5)  # thứ Hai
+
+
+def _hash64(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def epoch_of(dt):
+    return (dt - _EPOCH_ORIGIN).days // EPOCH_DAYS
+
+
+class CountMinSketch:
+    """Count-min sketch width x depth với giá trị thực (cho phép cộng số âm khi xóa báo cáo).
+
+    nonnegative=False (ví dụ lợi nhuận có thể âm): ước lượng bằng trung vị các hàng thay vì min.
+    """
+
+    def __init__(self, width=1024, depth=4, nonnegative=True):
+        self.width = width
+        self.depth = depth
+        self.nonnegative = nonnegative
+        self.rows = [array("d", bytes(8 * width)) for _ in range(depth)]
+        self.total = 0.0
+
+    def _cells(self, key):
+        h = _hash64(key)
+        h1, h2 = h & 0xFFFFFFFF, h >> 32
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, value):
+        for row, cell in zip(self.rows, self._cells(key)):
+            row[cell] += value
+        self.total += value
+
+    def estimate(self, key):
+        values = [row[cell] for row, cell in zip(self.rows, self._cells(key))]
+        if self.nonnegative:
+            return min(values)
+        values.sort()
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+class HyperLogLog:
+    """HyperLogLog với 2^precision thanh ghi (precision=10: ~1KB, sai số ~3%)"""
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, item):
+        h = _hash64(item)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for i, value in enumerate(other.registers):
+            if value > self.registers[i]:
+                self.registers[i] = value
+
+    def count(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Khoảng nhỏ: linear counting
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+
+class _Epoch:
+    def __init__(self, width, depth, capacity, hll_precision):
+        self.sketches = {metric: CountMinSketch(width, depth, nonnegative=(metric != "profit")) for metric in METRICS}
+        self.candidates = {metric: {} for metric in METRICS}  # product_id -> ước lượng
+        self.orders = {}  # product_id -> HyperLogLog (chỉ cho ứng viên)
+        self.capacity = capacity
+        self.hll_precision = hll_precision
+
+    def add(self, product_id, order_id, values):
+        for metric in METRICS:
+            sketch = self.sketches[metric]
+            sketch.add(product_id, values[metric])
+            estimate = sketch.estimate(product_id)
+            candidates = self.candidates[metric]
+            if product_id in candidates or len(candidates) < self.capacity:
+                candidates[product_id] = estimate
+            else:
+                weakest = min(candidates, key=candidates.get)
+                if estimate > candidates[weakest]:
+                    del candidates[weakest]
+                    candidates[product_id] = estimate
+                    self._drop_orders_if_unused(weakest)
+
+        if any(product_id in self.candidates[metric] for metric in METRICS):
+            if product_id not in self.orders:
+                self.orders[product_id] = HyperLogLog(self.hll_precision)
+            self.orders[product_id].add(order_id)
+
+    def _drop_orders_if_unused(self, product_id):
+        if not any(product_id in self.candidates[metric] for metric in METRICS):
+            self.orders.pop(product_id, None)
+
+
+class ProductLeaderboard:
+    """Top-N sản phẩm xấp xỉ theo tuần, giữ tối đa `epochs` tuần gần nhất (an toàn đa luồng)"""
+
+    def __init__(self, epochs=53, width=1024, depth=4, capacity=100, hll_precision=10):
+        self.max_epochs = epochs
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity
+        self.hll_precision = hll_precision
+        self._epochs = {}
+        # Trong lúc nạp lại từ MongoDB: bỏ qua delta trực tiếp của báo cáo tạo trước mốc này
+        self._backfill_before = None
+        self._lock = threading.Lock()
+
+    @property
+    def horizon(self):
+        """Khoảng thời gian xa nhất sketch còn giữ"""
+        return timedelta(days=self.max_epochs * EPOCH_DAYS)
+
+    def begin_backfill(self, before):
+        """Bắt đầu nạp lại các báo cáo tạo trước `before` từ MongoDB.
+
+        Tới khi gọi end_backfill, delta trực tiếp (add với backfill=False) của các báo cáo đó bị bỏ
+        qua: lần quét đã đọc trạng thái hiện tại của chúng, cộng thêm delta sẽ tính hai lần
+        (hoặc trừ trước khi cộng). Báo cáo tạo từ `before` trở đi vẫn được cộng trực tiếp.
+        """
+        with self._lock:
+            self._backfill_before = before
+
+    def end_backfill(self):
+        with self._lock:
+            self._backfill_before = None
+
+    def add(self, product_report, sign=1, backfill=False):
+        """Cộng (sign=1) hoặc trừ (sign=-1) một product report.
+
+        backfill=True: báo cáo được đọc bởi lần nạp lại (xem begin_backfill).
+        HyperLogLog không hỗ trợ xóa nên số đơn hàng khác nhau chỉ tăng.
+        """
+        epoch = epoch_of(product_report["created_at"])
+        values = {
+            "revenue": sign * float(product_report["revenue"]),
+            "profit": sign * float(product_report["profit"]),
+            "total_sold": sign * int(product_report["total_sold"])
+        }
+        with self._lock:
+            before = self._backfill_before
+            if not backfill and before is not None and product_report["created_at"] < before:
+                return
+            current = max(self._epochs, default=epoch)
+            if epoch <= current - self.max_epochs:
+                return
+            if epoch not in self._epochs:
+                self._epochs[epoch] = _Epoch(self.width, self.depth, self.capacity, self.hll_precision)
+                # Bỏ các tuần quá cũ để bộ nhớ không tăng
+                newest = max(current, epoch)
+                for old in [e for e in self._epochs if e <= newest - self.max_epochs]:
+                    del self._epochs[old]
+            self._epochs[epoch].add(int(product_report["product_id"]), product_report["order_report_id"], values)
+
+    def top(self, metric, n, since):
+        """Top n sản phẩm theo metric từ các tuần giao với [since, hiện tại].
+
+        Ước lượng = tổng ước lượng của sketch các tuần; distinct_orders từ HyperLogLog đã gộp.
+        """
+        first = epoch_of(since)
+        with self._lock:
+            epochs = [self._epochs[e] for e in sorted(self._epochs) if e >= first]
+            candidates = set()
+            for epoch in epochs:
+                candidates.update(epoch.candidates[metric])
+            scored = [
+                (sum(epoch.sketches[metric].estimate(pid) for epoch in epochs), pid)
+                for pid in candidates
+            ]
+            result = []
+            for value, pid in heapq.nlargest(n, scored):
+                orders = HyperLogLog(self.hll_precision)
+                for epoch in epochs:
+                    if pid in epoch.orders:
+                        orders.merge(epoch.orders[pid])
+                result.append({"product_id": pid, metric: value, "distinct_orders": orders.count()})
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "epochs": len(self._epochs),
+                "max_epochs": self.max_epochs,
+                "width": self.width,
+                "depth": self.depth,
+                "capacity": self.capacity,
+                "candidates": sum(len(e.candidates[m]) for e in self._epochs.values() for m in METRICS)
+            }
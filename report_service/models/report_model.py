@@ -1,27 +1,117 @@
-from pymongo import MongoClient
-from datetime import datetime
-from config import MONGO_URI
+from pymongo import MongoClient, IndexModel, ASCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import heapq
+from datetime import datetime, timedelta
+from config import (
+    MONGO_URI, REPORT_TOP_MAX_N, REPORT_TOP_SKETCH_WEEKS, REPORT_TOP_SKETCH_WIDTH, REPORT_TOP_SKETCH_DEPTH
+)
+from leaderboard import ProductLeaderboard
 
 client = MongoClient(MONGO_URI)
 db = client["reportdb"]
 orders_reports_collection = db["orders_reports"]
 product_reports_collection = db["product_reports"]
+# Thống kê tổng hợp theo sản phẩm, cập nhật bằng $inc mỗi khi thêm/xóa product report
+product_stats_collection = db["product_stats"]
+# Doanh thu / chi phí / lợi nhuận gộp sẵn theo giờ, ngày, tháng (product_id=None: tổng mọi đơn hàng)
+report_buckets_collection = db["report_buckets"]
+# Trạng thái các job nền (watermark, lease, số liệu lần chạy gần nhất)
+report_jobs_collection = db["report_jobs"]
+
+GRANULARITIES = ("hour", "day", "month")
+
+# Top-N sản phẩm xấp xỉ cho khoảng thời gian dài, cập nhật cùng product_stats
+product_leaderboard = ProductLeaderboard(
+    epochs=REPORT_TOP_SKETCH_WEEKS,
+    width=REPORT_TOP_SKETCH_WIDTH,
+    depth=REPORT_TOP_SKETCH_DEPTH,
+    capacity=REPORT_TOP_MAX_N
+)
+
+# Index khai báo (tạo khi khởi động / python index_manager.py)
+INDEXES = [
+    (orders_reports_collection, [
+        # Mỗi đơn hàng chỉ có một báo cáo (id đơn hàng chỉ duy nhất theo owner)
+        IndexModel([("owner", ASCENDING), ("order_id", ASCENDING)], name="owner_order_id_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ]),
+    (product_reports_collection, [
+        IndexModel([("product_id", ASCENDING)], name="product_id"),
+        IndexModel([("order_report_id", ASCENDING)], name="order_report_id"),
+        IndexModel([("product_id", ASCENDING), ("created_at", ASCENDING)], name="product_id_created_at"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ]),
+    (product_stats_collection, [
+        IndexModel([("product_id", ASCENDING)], name="product_id_unique", unique=True),
+    ]),
+    (report_buckets_collection, [
+        IndexModel(
+            [("granularity", ASCENDING), ("product_id", ASCENDING), ("bucket", ASCENDING)],
+            name="granularity_product_id_bucket_unique", unique=True
+        ),
+    ]),
+    (report_jobs_collection, [
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+    ]),
+]
+
+# Index cũ đã được thay thế, xoá khi khởi động trước khi tạo index mới
+OBSOLETE_INDEXES = [
+    (orders_reports_collection, ["order_id_unique"]),
+]
+
+
+def _owner_filter(owner):
+    """Báo cáo cũ chưa lưu owner (None) được coi là của owner đang truy vấn"""
+    return {"$in": [owner, None]}
+
+
+def _find_order_reports_by_keys(keys, projection):
+    """{(owner, order_id): báo cáo} cho các cặp (owner, order_id) đã có báo cáo (một truy vấn $or)"""
+    keys = list(dict.fromkeys((owner, int(oid)) for owner, oid in keys))
+    if not keys:
+        return {}
+    cursor = orders_reports_collection.find(
+        {"$or": [{"order_id": oid, "owner": _owner_filter(owner)} for owner, oid in keys]},
+        dict(projection, _id=0, owner=1, order_id=1)
+    )
+    found = {}
+    for report in cursor:
+        if report.get("owner") is not None:
+            found[(report["owner"], report["order_id"])] = report
+        else:
+            for owner, oid in keys:
+                if oid == report["order_id"]:
+                    found.setdefault((owner, oid), report)
+    return found
 
 # ==================== ORDERS REPORTS ====================
 
-def create_order_report(order_id, total_revenue, total_cost, total_profit):
-    """Tạo báo cáo đơn hàng mới"""
-    now = datetime.utcnow()
-    order_report = {
+def _build_order_report(order_id, total_revenue, total_cost, total_profit, now, order_version=None, owner=None):
+    return {
         "id": order_id,  # Dùng order_id làm id chính, có thể tự động generate ID nếu cần
         "order_id": order_id,
+        # Chủ đơn hàng (id đơn hàng chỉ duy nhất theo owner)
+        "owner": owner,
         "total_revenue": float(total_revenue),
         "total_cost": float(total_cost),
         "total_profit": float(total_profit),
+        # updated_at của đơn hàng lúc tính báo cáo, dùng để biết báo cáo còn đúng hay không
+        "order_version": order_version,
+        # Tăng mỗi lần báo cáo được tính lại; product_reports mang revision của lần tính tạo ra chúng
+        "revision": 1,
         "created_at": now,
         "updated_at": now
     }
+
+
+def create_order_report(order_id, total_revenue, total_cost, total_profit, owner=None):
+    """Tạo báo cáo đơn hàng mới"""
+    now = datetime.utcnow()
+    order_report = _build_order_report(order_id, total_revenue, total_cost, total_profit, now, owner=owner)
     result = orders_reports_collection.insert_one(order_report)
+    apply_report_buckets([order_report])
     order_report["_id"] = str(result.inserted_id)
     # Tạo id dựa trên inserted_id nếu chưa có
     if "_id" in order_report:
@@ -43,13 +133,13 @@ def get_all_order_reports():
     return reports
 
 
-def get_order_report_by_id(report_id):
-    """Lấy báo cáo đơn hàng theo ID (có thể là order_id hoặc _id)"""
+def get_order_report_by_id(report_id, owner):
+    """Lấy báo cáo đơn hàng của owner theo ID (có thể là order_id hoặc _id)"""
     # Thử tìm theo order_id trước
-    report = orders_reports_collection.find_one({"order_id": int(report_id)}, {"_id": 0})
+    report = orders_reports_collection.find_one({"order_id": int(report_id), "owner": _owner_filter(owner)}, {"_id": 0})
     if not report:
         # Thử tìm theo id
-        report = orders_reports_collection.find_one({"id": int(report_id)}, {"_id": 0})
+        report = orders_reports_collection.find_one({"id": int(report_id), "owner": _owner_filter(owner)}, {"_id": 0})
     
     if report:
         if isinstance(report.get("created_at"), datetime):
@@ -59,9 +149,9 @@ def get_order_report_by_id(report_id):
     return report
 
 
-def get_order_report_by_order_id(order_id):
-    """Lấy báo cáo đơn hàng theo order_id"""
-    report = orders_reports_collection.find_one({"order_id": int(order_id)}, {"_id": 0})
+def get_order_report_by_order_id(order_id, owner):
+    """Lấy báo cáo đơn hàng theo (owner, order_id)"""
+    report = orders_reports_collection.find_one({"order_id": int(order_id), "owner": _owner_filter(owner)}, {"_id": 0})
     if report:
         if isinstance(report.get("created_at"), datetime):
             report["created_at"] = report["created_at"].isoformat()
@@ -70,39 +160,211 @@ def get_order_report_by_order_id(order_id):
     return report
 
 
-def delete_order_report(report_id):
-    """Xóa báo cáo đơn hàng (sẽ xóa các product_reports liên quan)"""
+def delete_order_report(report_id, owner):
+    """Xóa báo cáo đơn hàng của owner (sẽ xóa các product_reports liên quan)"""
     # Tìm order_report để lấy order_id
-    order_report = get_order_report_by_id(report_id)
+    order_report = get_order_report_by_id(report_id, owner)
     if not order_report:
         return False
     
     order_id = order_report.get("order_id")
     
-    # Xóa các product_reports liên quan
-    product_reports_collection.delete_many({"order_report_id": order_id})
+    # Xóa order_report trước: chỉ request xoá được nó mới trừ report_buckets
+    deleted = orders_reports_collection.find_one_and_delete({"order_id": order_id, "owner": _owner_filter(owner)})
+    if not deleted:
+        return False
+    apply_report_buckets([deleted], sign=-1)
     
-    # Xóa order_report
-    result = orders_reports_collection.delete_one({"order_id": order_id})
-    return result.deleted_count > 0
+    # Xóa các product_reports liên quan từng document, chỉ trừ thống kê cho phần thực sự xoá được
+    _delete_product_reports({"order_report_id": order_id, "owner": _owner_filter(owner)})
+    return True
 
 
-# ==================== PRODUCT REPORTS ====================
+def get_existing_order_report_ids(order_keys):
+    """Trả về tập (owner, order_id) đã có báo cáo"""
+    return set(_find_order_reports_by_keys(order_keys, {}))
 
-def create_product_report(order_report_id, product_id, total_sold, revenue, cost, profit):
-    """Tạo báo cáo sản phẩm mới"""
+
+def create_order_reports_bulk(reports):
+    """Ghi nhiều báo cáo đơn hàng (kèm product_reports) bằng insert_many.
+
+    reports: danh sách kết quả của calculate_order_report.
+    Trả về {(owner, order_id): lỗi} cho các báo cáo không ghi được.
+    """
     now = datetime.utcnow()
-    product_report = {
+    order_docs = [
+        _build_order_report(
+            r["order_id"], r["total_revenue"], r["total_cost"], r["total_profit"], now,
+            r.get("order_version"), r.get("owner")
+        )
+        for r in reports
+    ]
+    errors = {}
+    try:
+        orders_reports_collection.insert_many(order_docs, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            doc = order_docs[error["index"]]
+            errors[(doc["owner"], doc["order_id"])] = (
+                "Báo cáo cho đơn hàng này đã tồn tại" if error["code"] == 11000 else error["errmsg"]
+            )
+    apply_report_buckets([doc for doc in order_docs if (doc["owner"], doc["order_id"]) not in errors])
+
+    product_docs = [
+        _build_product_report(
+            r["order_id"], p["product_id"], p["total_sold"], p["revenue"], p["cost"], p["profit"], now,
+            revision=1, owner=r.get("owner")
+        )
+        for r in reports if (r.get("owner"), r["order_id"]) not in errors
+        for p in r["product_reports"]
+    ]
+    if product_docs:
+        product_reports_collection.insert_many(product_docs, ordered=False)
+        apply_product_stats(product_docs)
+        apply_report_buckets(product_docs)
+    return errors
+
+
+def get_order_report_versions(order_keys):
+    """{(owner, order_id): order_version} của các báo cáo đã có"""
+    reports = _find_order_reports_by_keys(order_keys, {"order_version": 1})
+    return {key: report.get("order_version") for key, report in reports.items()}
+
+
+def upsert_order_report(report_data, retries=3):
+    """Tạo mới hoặc tính lại báo cáo đơn hàng (kèm product_reports).
+
+    report_data: kết quả của calculate_order_report.
+    Báo cáo cũ được thay thế bằng cập nhật có điều kiện theo revision: mỗi revision chỉ một
+    request thay thế được, nên product_stats / report_buckets chỉ bị trừ phần cũ một lần
+    kể cả khi job refresh và POST /reports/orders chạy cùng lúc. product_reports giữ
+    created_at của báo cáo đơn hàng để không bị dời sang bucket thời gian khác.
+    Trả về (created, báo cáo đã ghi): created là True nếu là báo cáo mới, False nếu đã cập nhật.
+    """
+    order_id = int(report_data["order_id"])
+    owner = report_data.get("owner")
+    fields = {
+        "owner": owner,
+        "total_revenue": float(report_data["total_revenue"]),
+        "total_cost": float(report_data["total_cost"]),
+        "total_profit": float(report_data["total_profit"]),
+        "order_version": report_data.get("order_version")
+    }
+    for _ in range(retries + 1):
+        now = datetime.utcnow()
+        previous = orders_reports_collection.find_one({"order_id": order_id, "owner": _owner_filter(owner)})
+        if previous is None:
+            order_report = _build_order_report(
+                order_id, fields["total_revenue"], fields["total_cost"], fields["total_profit"],
+                now, fields["order_version"], owner
+            )
+            try:
+                orders_reports_collection.insert_one(order_report)
+            except DuplicateKeyError:
+                # Request khác vừa tạo báo cáo này: đọc lại và thay thế theo revision
+                continue
+            apply_report_buckets([order_report])
+            _replace_product_reports(order_id, owner, 1, now, report_data["product_reports"], now)
+            return True, _format_order_report(order_report)
+
+        # Báo cáo cũ chưa lưu owner (None) được gán owner này khi tính lại
+        current = orders_reports_collection.find_one_and_update(
+            {"_id": previous["_id"], "revision": previous.get("revision")},
+            {"$set": dict(fields, updated_at=now), "$inc": {"revision": 1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not current:
+            # Request khác đã thay thế revision này trước: đọc lại rồi thử lại
+            continue
+        apply_report_buckets([previous], sign=-1)
+        apply_report_buckets([current])
+        _replace_product_reports(
+            order_id, owner, current["revision"], previous["created_at"], report_data["product_reports"], now
+        )
+        return False, _format_order_report(current)
+    # Các request khác liên tục tính lại báo cáo này: báo cáo hiện tại đã là bản mới
+    return False, get_order_report_by_order_id(order_id, owner)
+
+
+def _format_order_report(report):
+    """Bản sao trả về cho API: bỏ _id, ngày dạng ISO 8601"""
+    report = {key: value for key, value in report.items() if key != "_id"}
+    for field in ("created_at", "updated_at"):
+        if isinstance(report.get(field), datetime):
+            report[field] = report[field].isoformat()
+    return report
+
+
+def _delete_product_reports(query):
+    """Xoá các product report khớp query từng document một và chỉ trừ product_stats /
+    report_buckets cho những document thực sự xoá được (request đồng thời không trừ hai lần).
+    Trả về danh sách đã xoá."""
+    deleted = []
+    for report in product_reports_collection.find(query, {"_id": 1}):
+        removed = product_reports_collection.find_one_and_delete({"_id": report["_id"]})
+        if removed:
+            deleted.append(removed)
+    if deleted:
+        apply_product_stats(deleted, sign=-1)
+        apply_report_buckets(deleted, sign=-1)
+    return deleted
+
+
+def _replace_product_reports(order_id, owner, revision, created_at, product_reports, now):
+    """Ghi product_reports của revision mới và xoá các revision cũ hơn"""
+    _delete_product_reports({
+        "order_report_id": order_id,
+        "owner": _owner_filter(owner),
+        "$or": [{"revision": {"$lt": revision}}, {"revision": None}]
+    })
+    product_docs = [
+        _build_product_report(
+            order_id, p["product_id"], p["total_sold"], p["revenue"], p["cost"], p["profit"], now,
+            created_at=created_at, revision=revision, owner=owner
+        )
+        for p in product_reports
+    ]
+    if product_docs:
+        product_reports_collection.insert_many(product_docs)
+        apply_product_stats(product_docs)
+        apply_report_buckets(product_docs)
+
+    # Bị revision mới hơn (hoặc thao tác xoá báo cáo) thay thế trong lúc ghi: bỏ các document vừa ghi
+    current = orders_reports_collection.find_one({"order_id": order_id, "owner": owner}, {"revision": 1})
+    if not current or current.get("revision") != revision:
+        _delete_product_reports({"order_report_id": order_id, "owner": owner, "revision": revision})
+
+
+# ==================== PRODUCT REPORTS ====================
+
+def _build_product_report(order_report_id, product_id, total_sold, revenue, cost, profit, now,
+                          created_at=None, revision=None, owner=None):
+    return {
         "order_report_id": int(order_report_id),
+        # Chủ đơn hàng của báo cáo đơn hàng (order_report_id chỉ duy nhất theo owner)
+        "owner": owner,
         "product_id": int(product_id),
         "total_sold": int(total_sold),
         "revenue": float(revenue),
         "cost": float(cost),
         "profit": float(profit),
-        "created_at": now,
+        # Revision của báo cáo đơn hàng đã tạo ra product report này (None: tạo tay qua API)
+        "revision": revision,
+        # created_at của báo cáo đơn hàng: tính lại không dời báo cáo sang bucket thời gian khác
+        "created_at": created_at or now,
         "updated_at": now
     }
+
+
+def create_product_report(order_report_id, product_id, total_sold, revenue, cost, profit, owner=None):
+    """Tạo báo cáo sản phẩm mới"""
+    now = datetime.utcnow()
+    product_report = _build_product_report(
+        order_report_id, product_id, total_sold, revenue, cost, profit, now, owner=owner
+    )
     result = product_reports_collection.insert_one(product_report)
+    apply_product_stats([product_report])
+    apply_report_buckets([product_report])
     product_report["id"] = str(result.inserted_id)
     product_report["_id"] = str(result.inserted_id)
     product_report["created_at"] = now.isoformat()
@@ -141,9 +403,11 @@ def get_product_report_by_id(report_id):
     return report
 
 
-def get_product_reports_by_order_report_id(order_report_id):
-    """Lấy tất cả báo cáo sản phẩm của một order_report"""
-    reports = list(product_reports_collection.find({"order_report_id": int(order_report_id)}, {"_id": 0}))
+def get_product_reports_by_order_report_id(order_report_id, owner):
+    """Lấy tất cả báo cáo sản phẩm của một order_report (của owner)"""
+    reports = list(product_reports_collection.find(
+        {"order_report_id": int(order_report_id), "owner": _owner_filter(owner)}, {"_id": 0}
+    ))
     for report in reports:
         if isinstance(report.get("created_at"), datetime):
             report["created_at"] = report["created_at"].isoformat()
@@ -166,35 +430,364 @@ def get_product_reports_by_product_id(product_id):
 def delete_product_report(report_id):
     """Xóa báo cáo sản phẩm"""
     # Thử xóa theo id
-    result = product_reports_collection.delete_one({"id": str(report_id)})
-    if result.deleted_count == 0:
+    report = product_reports_collection.find_one_and_delete({"id": str(report_id)})
+    if not report:
         # Thử xóa theo MongoDB _id
         from bson import ObjectId
         try:
-            result = product_reports_collection.delete_one({"_id": ObjectId(str(report_id))})
+            report = product_reports_collection.find_one_and_delete({"_id": ObjectId(str(report_id))})
         except:
             pass
-    return result.deleted_count > 0
+    if not report:
+        return False
+    apply_product_stats([report], sign=-1)
+    apply_report_buckets([report], sign=-1)
+    return True
 
 
-# Thống kê tổng hợp
-def get_product_statistics_by_id(product_id):
-    """Tính toán thống kê tổng hợp cho một sản phẩm"""
+# ==================== EXPORT ====================
+
+ORDER_REPORT_EXPORT_FIELDS = ["id", "order_id", "total_revenue", "total_cost", "total_profit", "created_at", "updated_at"]
+PRODUCT_REPORT_EXPORT_FIELDS = [
+    "id", "order_report_id", "product_id", "total_sold", "revenue", "cost", "profit", "created_at", "updated_at"
+]
+
+
+def _created_at_query(date_from, date_to):
+    created_at = {}
+    if date_from:
+        created_at["$gte"] = date_from
+    if date_to:
+        created_at["$lt"] = date_to
+    return {"created_at": created_at} if created_at else {}
+
+
+def iter_order_reports(date_from=None, date_to=None, product_id=None, batch_size=1000):
+    """Cursor báo cáo đơn hàng theo created_at (không nạp hết vào bộ nhớ).
+
+    product_id: chỉ lấy các đơn hàng có sản phẩm này ($lookup từng báo cáo sang product_reports
+    theo (order_id, owner) ngay trong cursor, không gom trước danh sách order_id).
+    """
+    query = _created_at_query(date_from, date_to)
+    if product_id is None:
+        return orders_reports_collection.find(query, {"_id": 0}).sort("created_at", ASCENDING).batch_size(batch_size)
+
     pipeline = [
-        {"$match": {"product_id": int(product_id)}},
+        {"$match": query},
+        {"$sort": {"created_at": ASCENDING}},
+        {"$lookup": {
+            "from": product_reports_collection.name,
+            "localField": "order_id",
+            "foreignField": "order_report_id",
+            "let": {"owner": {"$ifNull": ["$owner", None]}},
+            "pipeline": [
+                {"$match": {"product_id": int(product_id), "$expr": {"$eq": [{"$ifNull": ["$owner", None]}, "$$owner"]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 1}}
+            ],
+            "as": "matched_products"
+        }},
+        {"$match": {"matched_products": {"$ne": []}}},
+        {"$project": {"_id": 0, "matched_products": 0}}
+    ]
+    return orders_reports_collection.aggregate(pipeline, batchSize=batch_size)
+
+
+def iter_product_reports(date_from=None, date_to=None, product_id=None, batch_size=1000):
+    """Cursor báo cáo sản phẩm theo created_at; id là chuỗi ObjectId như GET /reports/products/id"""
+    query = _created_at_query(date_from, date_to)
+    if product_id is not None:
+        query["product_id"] = int(product_id)
+    cursor = product_reports_collection.find(query).sort("created_at", ASCENDING).batch_size(batch_size)
+    for report in cursor:
+        report["id"] = str(report.pop("_id"))
+        yield report
+
+
+# ==================== PRODUCT STATS (ROLLUP) ====================
+
+_STATS_FIELDS = {"total_sold": "total_sold", "revenue": "total_revenue", "cost": "total_cost", "profit": "total_profit"}
+
+
+def apply_product_stats(product_reports, sign=1):
+    """Cộng (sign=1) hoặc trừ (sign=-1) các product report vào product_stats bằng $inc (upsert)"""
+    deltas = {}
+    for report in product_reports:
+        delta = deltas.setdefault(int(report["product_id"]), {"report_count": 0})
+        for field, stats_field in _STATS_FIELDS.items():
+            delta[stats_field] = delta.get(stats_field, 0) + sign * report.get(field, 0)
+        delta["report_count"] += sign
+    for report in product_reports:
+        product_leaderboard.add(report, sign)
+    if not deltas:
+        return
+    now = datetime.utcnow()
+    product_stats_collection.bulk_write([
+        UpdateOne({"product_id": product_id}, {"$inc": delta, "$set": {"updated_at": now}}, upsert=True)
+        for product_id, delta in deltas.items()
+    ], ordered=False)
+
+
+def rebuild_product_stats():
+    """Tính lại toàn bộ product_stats từ product_reports (dùng khi rollup bị lệch).
+
+    $out thay thế collection một cách nguyên tử và giữ nguyên index đã có.
+    Trả về số sản phẩm trong rollup.
+    """
+    product_reports_collection.aggregate([
         {"$group": {
             "_id": "$product_id",
             "total_sold": {"$sum": "$total_sold"},
             "total_revenue": {"$sum": "$revenue"},
             "total_cost": {"$sum": "$cost"},
-            "total_profit": {"$sum": "$profit"}
-        }}
+            "total_profit": {"$sum": "$profit"},
+            "report_count": {"$sum": 1}
+        }},
+        {"$addFields": {"product_id": "$_id", "updated_at": datetime.utcnow()}},
+        {"$project": {"_id": 0}},
+        {"$out": product_stats_collection.name}
+    ])
+    return product_stats_collection.count_documents({})
+
+
+# ==================== TIME SERIES (BUCKETS) ====================
+
+def bucket_start(dt, granularity):
+    """Mốc đầu của bucket chứa dt"""
+    if granularity == "hour":
+        return dt.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def apply_report_buckets(reports, sign=1):
+    """Cộng/trừ báo cáo vào report_buckets theo created_at của báo cáo.
+
+    Báo cáo đơn hàng cập nhật bucket tổng (product_id=None),
+    báo cáo sản phẩm (có product_id) cập nhật bucket của sản phẩm đó.
+    """
+    deltas = {}
+    for report in reports:
+        product_id = report.get("product_id")
+        if product_id is None:
+            values = {"revenue": report["total_revenue"], "cost": report["total_cost"], "profit": report["total_profit"]}
+        else:
+            product_id = int(product_id)
+            values = {"revenue": report["revenue"], "cost": report["cost"], "profit": report["profit"],
+                      "total_sold": report["total_sold"]}
+        for granularity in GRANULARITIES:
+            key = (granularity, product_id, bucket_start(report["created_at"], granularity))
+            delta = deltas.setdefault(key, {"report_count": 0})
+            for field, value in values.items():
+                delta[field] = delta.get(field, 0) + sign * value
+            delta["report_count"] += sign
+    if not deltas:
+        return
+    now = datetime.utcnow()
+    report_buckets_collection.bulk_write([
+        UpdateOne(
+            {"granularity": granularity, "product_id": product_id, "bucket": bucket},
+            {"$inc": delta, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for (granularity, product_id, bucket), delta in deltas.items()
+    ], ordered=False)
+
+
+def get_timeseries(granularity, date_from, date_to, product_id=None):
+    """Chuỗi thời gian [date_from, date_to) đọc từ report_buckets bằng một truy vấn range trên index.
+
+    Chỉ trả về các bucket có dữ liệu.
+    """
+    query = {
+        "granularity": granularity,
+        "product_id": int(product_id) if product_id is not None else None,
+        "bucket": {"$gte": bucket_start(date_from, granularity), "$lt": date_to},
+        "report_count": {"$gt": 0}
+    }
+    buckets = []
+    for doc in report_buckets_collection.find(query, {"_id": 0, "granularity": 0, "product_id": 0}).sort("bucket", ASCENDING):
+        doc["bucket"] = doc["bucket"].isoformat()
+        buckets.append(doc)
+    return buckets
+
+
+def rebuild_report_buckets(batch_size=1000):
+    """Tính lại toàn bộ report_buckets từ orders_reports và product_reports.
+
+    Việc gộp theo bucket được đẩy xuống MongoDB ($dateTrunc + $group); kết quả được ghi đè
+    từng bucket theo khoá (granularity, product_id, bucket) nên collection không bị xoá trắng
+    và người đọc không thấy bucket rỗng trong lúc tính lại. Bucket không còn báo cáo nào bị xoá
+    ở cuối, trừ khi đã được ghi trực tiếp (apply_report_buckets) sau khi bắt đầu tính lại.
+    Trả về số bucket đã ghi.
+    """
+    started = datetime.utcnow()
+    sources = [
+        (orders_reports_collection, None, {
+            "revenue": {"$sum": "$total_revenue"},
+            "cost": {"$sum": "$total_cost"},
+            "profit": {"$sum": "$total_profit"}
+        }),
+        (product_reports_collection, "$product_id", {
+            "revenue": {"$sum": "$revenue"},
+            "cost": {"$sum": "$cost"},
+            "profit": {"$sum": "$profit"},
+            "total_sold": {"$sum": "$total_sold"}
+        }),
     ]
-    
-    result = list(product_reports_collection.aggregate(pipeline))
-    if result:
-        stats = result[0]
-        stats["product_id"] = stats["_id"]
-        del stats["_id"]
-        return stats
-    return None
+    written = 0
+    for collection, product_id, sums in sources:
+        for granularity in GRANULARITIES:
+            cursor = collection.aggregate([
+                {"$group": {
+                    "_id": {
+                        "product_id": product_id,
+                        "bucket": {"$dateTrunc": {"date": "$created_at", "unit": granularity}}
+                    },
+                    **sums,
+                    "report_count": {"$sum": 1}
+                }}
+            ], batchSize=batch_size)
+            operations = []
+            for row in cursor:
+                operations.append(UpdateOne(
+                    {"granularity": granularity, "product_id": row["_id"]["product_id"], "bucket": row["_id"]["bucket"]},
+                    {"$set": {
+                        **{field: row[field] for field in sums},
+                        "report_count": row["report_count"],
+                        "rebuilt_at": started
+                    }},
+                    upsert=True
+                ))
+                if len(operations) >= batch_size:
+                    report_buckets_collection.bulk_write(operations, ordered=False)
+                    written += len(operations)
+                    operations = []
+            if operations:
+                report_buckets_collection.bulk_write(operations, ordered=False)
+                written += len(operations)
+
+    # Bucket không có trong lần tính lại này và không bị ghi trực tiếp kể từ khi bắt đầu
+    report_buckets_collection.delete_many({
+        "rebuilt_at": {"$ne": started},
+        "$or": [{"updated_at": {"$lt": started}}, {"updated_at": None}]
+    })
+    return written
+
+
+# ==================== TOP-N PRODUCTS ====================
+
+# Tên trường tương ứng trong product_stats
+_STATS_TOP_FIELDS = {"revenue": "total_revenue", "profit": "total_profit", "total_sold": "total_sold"}
+
+
+def get_top_products_exact(metric, n, since=None):
+    """Top n sản phẩm chính xác.
+
+    since=None: từ product_stats (toàn thời gian); ngược lại cộng các bucket sản phẩm
+    của report_buckets từ since tới nay. Chọn top n bằng heap (heapq.nlargest).
+    """
+    if since is None:
+        field = _STATS_TOP_FIELDS[metric]
+        cursor = product_stats_collection.find(
+            {"report_count": {"$gt": 0}}, {"_id": 0, "product_id": 1, field: 1, "report_count": 1}
+        )
+        top = heapq.nlargest(n, cursor, key=lambda stats: stats.get(field, 0))
+        return [{"product_id": s["product_id"], metric: s.get(field, 0), "reports": s["report_count"]} for s in top]
+
+    # Dưới 2 ngày dùng bucket theo giờ để sát mốc since hơn
+    granularity = "hour" if datetime.utcnow() - since <= timedelta(days=2) else "day"
+    rows = report_buckets_collection.aggregate([
+        {"$match": {
+            "granularity": granularity,
+            "product_id": {"$ne": None},
+            "bucket": {"$gte": bucket_start(since, granularity)}
+        }},
+        {"$group": {"_id": "$product_id", "value": {"$sum": f"${metric}"}, "reports": {"$sum": "$report_count"}}},
+        {"$match": {"reports": {"$gt": 0}}}
+    ])
+    top = heapq.nlargest(n, rows, key=lambda row: row["value"])
+    return [{"product_id": row["_id"], metric: row["value"], "reports": row["reports"]} for row in top]
+
+
+def warm_up_leaderboard(batch_size=1000):
+    """Nạp product_reports trong khoảng sketch còn giữ vào product_leaderboard (khi khởi động)"""
+    now = datetime.utcnow()
+    # Báo cáo tạo từ mốc now được cộng qua apply_product_stats; báo cáo cũ hơn chỉ lấy từ lần quét này
+    product_leaderboard.begin_backfill(now)
+    try:
+        cursor = product_reports_collection.find(
+            {"created_at": {"$gte": now - product_leaderboard.horizon, "$lt": now}},
+            {"_id": 0, "order_report_id": 1, "product_id": 1, "total_sold": 1, "revenue": 1, "profit": 1, "created_at": 1}
+        ).batch_size(batch_size)
+        count = 0
+        for report in cursor:
+            product_leaderboard.add(report, backfill=True)
+            count += 1
+    finally:
+        product_leaderboard.end_backfill()
+    return count
+
+
+# Thống kê tổng hợp
+def get_product_statistics_by_id(product_id):
+    """Thống kê tổng hợp cho một sản phẩm (đọc một document từ product_stats)"""
+    stats = product_stats_collection.find_one(
+        {"product_id": int(product_id), "report_count": {"$gt": 0}},
+        {"_id": 0, "product_id": 1, "total_sold": 1, "total_revenue": 1, "total_cost": 1, "total_profit": 1}
+    )
+    return stats
+
+
+# ==================== BACKGROUND JOBS ====================
+
+def acquire_job_lease(name, owner, lease_seconds):
+    """Giữ quyền chạy job trong lease_seconds giây (chỉ một instance chạy tại một thời điểm).
+
+    Trả về trạng thái job nếu giữ được quyền, ngược lại None.
+    """
+    now = datetime.utcnow()
+    try:
+        return report_jobs_collection.find_one_and_update(
+            {"name": name, "$or": [{"locked_until": {"$lte": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "locked_until": now + timedelta(seconds=lease_seconds)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Job đã tồn tại và đang được instance khác giữ
+        return None
+
+
+def finish_job_run(name, owner, cursor, run_stats):
+    """Ghi kết quả lần chạy và con trỏ mới một cách nguyên tử.
+
+    cursor: {"updated_at", "owner", "id"} của đơn hàng cuối cùng đã xử lý.
+    Chỉ instance đang giữ lease mới ghi được; watermark (updated_at của con trỏ) không bao giờ lùi.
+    """
+    state = {"last_" + key: value for key, value in run_stats.items()}
+    state["locked_until"] = datetime.utcnow()
+    state["cursor"] = cursor
+    result = report_jobs_collection.update_one(
+        {"name": name, "owner": owner},
+        {
+            "$set": state,
+            "$max": {"watermark": cursor["updated_at"]},
+            "$inc": {"total_processed": run_stats.get("processed", 0)}
+        }
+    )
+    return result.modified_count > 0
+
+
+def _format_state(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {field: _format_state(item) for field, item in value.items()}
+    return value
+
+
+def get_job_state(name):
+    state = report_jobs_collection.find_one({"name": name}, {"_id": 0})
+    return _format_state(state) if state else state
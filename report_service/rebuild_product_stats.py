@@ -0,0 +1,11 @@
+"""Tính lại collection product_stats từ product_reports.
+
+product_stats được duy trì bằng $inc khi thêm/xóa báo cáo sản phẩm; chạy lệnh này để
+sửa rollup bị lệch (ví dụ do ghi dở dang). Chạy: python rebuild_product_stats.py
+"""
+from models.report_model import rebuild_product_stats
+
+
+if __name__ == "__main__":
+    count = rebuild_product_stats()
+    print(f"[ROLLUP] Đã tính lại thống kê cho {count} sản phẩm")
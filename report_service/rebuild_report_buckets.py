@@ -0,0 +1,11 @@
+"""Tính lại collection report_buckets (chuỗi thời gian theo giờ/ngày/tháng) từ các báo cáo.
+
+report_buckets được duy trì bằng $inc khi thêm/xóa báo cáo; chạy lệnh này để sửa
+bucket bị lệch hoặc tạo bucket cho dữ liệu cũ. Chạy: python rebuild_report_buckets.py
+"""
+from models.report_model import rebuild_report_buckets
+
+
+if __name__ == "__main__":
+    count = rebuild_report_buckets()
+    print(f"[ROLLUP] Đã tính lại {count} bucket")
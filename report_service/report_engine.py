@@ -0,0 +1,189 @@
+"""Tính doanh thu / chi phí / lợi nhuận cho báo cáo.
+
+Hai cách tính cho cùng một kết quả:
+- python: vòng lặp từng item (phù hợp đơn nhỏ)
+- numpy:  đưa items vào mảng và tính theo cột, dùng cho đơn lớn và tạo báo cáo hàng loạt
+
+Tổng theo nhóm dùng np.add.at (cộng tuần tự theo thứ tự item) nên kết quả
+trùng khớp từng bit với vòng lặp Python.
+"""
+try:
+    import numpy as np
+except ImportError:  # numpy là tuỳ chọn, không có thì luôn dùng vòng lặp Python
+    np = None
+
+# Không có giá vốn (cost) trong sản phẩm -> giá vốn = 70% giá bán;
+# không lấy được sản phẩm -> chi phí = 70% doanh thu
+DEFAULT_COST_RATIO = 0.7
+
+
+def unit_cost(product):
+    """Giá vốn một đơn vị, None nếu không có thông tin sản phẩm"""
+    if not product:
+        return None
+    return float(product.get("cost", product.get("price", 0) * DEFAULT_COST_RATIO))
+
+
+def item_figures(item, product):
+    """(số lượng, doanh thu, chi phí) của một order item"""
+    quantity = int(item.get("quantity", 0))
+    revenue = quantity * float(item.get("unit_price", 0))
+    cost_per_unit = unit_cost(product)
+    if cost_per_unit is None:
+        return quantity, revenue, revenue * DEFAULT_COST_RATIO
+    return quantity, revenue, quantity * cost_per_unit
+
+
+class ReportEngine:
+    """Chọn cách tính theo số item: mode="auto" dùng numpy khi có numpy và số item >= min_items"""
+
+    def __init__(self, mode="auto", min_items=1000):
+        self.mode = mode
+        self.min_items = min_items
+
+    @property
+    def numpy_available(self):
+        return np is not None
+
+    def use_numpy(self, item_count):
+        if np is None or self.mode == "python":
+            return False
+        return self.mode == "numpy" or item_count >= self.min_items
+
+    # ---- Báo cáo đơn hàng ----
+    def order_reports(self, orders, products):
+        """Tính báo cáo cho danh sách đơn hàng (đã kèm items).
+
+        products: {product_id: product hoặc None}.
+        Trả về danh sách {"order_id", "total_revenue", "total_cost", "total_profit", "product_reports"}
+        theo thứ tự của orders; product_reports có một dòng cho mỗi item.
+        """
+        item_count = sum(len(order.get("items", [])) for order in orders)
+        if self.use_numpy(item_count):
+            return self._order_reports_numpy(orders, products)
+        return [self._order_report_python(order, products) for order in orders]
+
+    @staticmethod
+    def _order_report_python(order, products):
+        total_revenue = 0.0
+        total_cost = 0.0
+        product_reports = []
+        for item in order.get("items", []):
+            product_id = item.get("product_id")
+            quantity, revenue, cost = item_figures(item, products.get(int(product_id)))
+            total_revenue += revenue
+            total_cost += cost
+            product_reports.append({
+                "product_id": product_id,
+                "total_sold": quantity,
+                "revenue": revenue,
+                "cost": cost,
+                "profit": revenue - cost
+            })
+        return {
+            "order_id": order.get("id"),
+            "total_revenue": total_revenue,
+            "total_cost": total_cost,
+            "total_profit": total_revenue - total_cost,
+            "product_reports": product_reports
+        }
+
+    def _order_reports_numpy(self, orders, products):
+        items = [item for order in orders for item in order.get("items", [])]
+        product_ids = [item.get("product_id") for item in items]
+        # Vị trí đơn hàng của từng item
+        order_index = np.repeat(np.arange(len(orders)), [len(order.get("items", [])) for order in orders])
+
+        quantity, revenue, cost = self._item_columns(items, product_ids, products)
+        profit = revenue - cost
+
+        total_revenue = np.zeros(len(orders))
+        total_cost = np.zeros(len(orders))
+        np.add.at(total_revenue, order_index, revenue)
+        np.add.at(total_cost, order_index, cost)
+        total_profit = total_revenue - total_cost
+
+        # tolist() trả về int/float Python để ghi MongoDB và jsonify như cách tính Python
+        rows = [
+            {"product_id": pid, "total_sold": sold, "revenue": rev, "cost": cst, "profit": prf}
+            for pid, sold, rev, cst, prf in zip(
+                product_ids, quantity.tolist(), revenue.tolist(), cost.tolist(), profit.tolist()
+            )
+        ]
+        reports = []
+        position = 0
+        for order, order_revenue, order_cost, order_profit in zip(
+                orders, total_revenue.tolist(), total_cost.tolist(), total_profit.tolist()):
+            end = position + len(order.get("items", []))
+            reports.append({
+                "order_id": order.get("id"),
+                "total_revenue": order_revenue,
+                "total_cost": order_cost,
+                "total_profit": order_profit,
+                "product_reports": rows[position:end]
+            })
+            position = end
+        return reports
+
+    @staticmethod
+    def _item_columns(items, product_ids, products):
+        """Mảng (số lượng, doanh thu, chi phí) cho từng item"""
+        count = len(items)
+        quantity = np.fromiter((int(item.get("quantity", 0)) for item in items), dtype=np.int64, count=count)
+        unit_price = np.fromiter((float(item.get("unit_price", 0)) for item in items), dtype=np.float64, count=count)
+
+        # Giá vốn tính một lần cho mỗi sản phẩm, NaN = không có thông tin sản phẩm
+        unit_costs = {}
+        for product_id in product_ids:
+            if product_id not in unit_costs:
+                value = unit_cost(products.get(int(product_id)))
+                unit_costs[product_id] = np.nan if value is None else value
+        cost_per_unit = np.fromiter((unit_costs[pid] for pid in product_ids), dtype=np.float64, count=count)
+
+        revenue = quantity * unit_price
+        known = ~np.isnan(cost_per_unit)
+        cost = np.where(known, quantity * np.where(known, cost_per_unit, 0.0), revenue * DEFAULT_COST_RATIO)
+        return quantity, revenue, cost
+
+    # ---- Tổng theo sản phẩm ----
+    def product_totals(self, items, products):
+        """Tổng theo product_id của các items: {product_id: {"total_sold", "revenue", "cost", "profit"}}"""
+        if self.use_numpy(len(items)):
+            return self._product_totals_numpy(items, products)
+        totals = {}
+        for item in items:
+            product_id = int(item.get("product_id"))
+            quantity, revenue, cost = item_figures(item, products.get(product_id))
+            total = totals.setdefault(product_id, {"total_sold": 0, "revenue": 0.0, "cost": 0.0})
+            total["total_sold"] += quantity
+            total["revenue"] += revenue
+            total["cost"] += cost
+        for total in totals.values():
+            total["profit"] = total["revenue"] - total["cost"]
+        return totals
+
+    def _product_totals_numpy(self, items, products):
+        product_ids = [int(item.get("product_id")) for item in items]
+        quantity, revenue, cost = self._item_columns(items, product_ids, products)
+        keys, group = np.unique(np.asarray(product_ids, dtype=np.int64), return_inverse=True)
+
+        total_sold = np.zeros(len(keys), dtype=np.int64)
+        total_revenue = np.zeros(len(keys))
+        total_cost = np.zeros(len(keys))
+        np.add.at(total_sold, group, quantity)
+        np.add.at(total_revenue, group, revenue)
+        np.add.at(total_cost, group, cost)
+        total_profit = total_revenue - total_cost
+
+        return {
+            product_id: {
+                "total_sold": sold,
+                "revenue": rev,
+                "cost": cst,
+                "profit": prf
+            }
+            for product_id, sold, rev, cst, prf in zip(
+                keys.tolist(), total_sold.tolist(), total_revenue.tolist(),
+                total_cost.tolist(), total_profit.tolist()
+            )
+        }
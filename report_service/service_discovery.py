@@ -0,0 +1,134 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+import consul
+
+
+class ServiceDiscovery:
+    """Bảng instance cục bộ cho từng service, được làm mới bằng blocking query của Consul.
+
+    - Chỉ giữ các instance có health check "passing".
+    - Mỗi service có một thread theo dõi (watch) chạy nền, không gọi Consul trên đường request.
+    - Khi Consul không truy cập được, tiếp tục dùng bảng tốt gần nhất (last-known-good).
+    - Chọn instance theo "round_robin" hoặc "least_outstanding" (ít request đang xử lý nhất).
+    """
+
+    def __init__(self, host, port, strategy="round_robin", wait="30s", retry_interval=2):
+        self.host = host
+        self.port = port
+        self.strategy = strategy
+        self.wait = wait
+        self.retry_interval = retry_interval
+        self._client = consul.Consul(host=host, port=port)
+        self._lock = threading.Lock()
+        self._watch_lock = threading.Lock()  # tuần tự hoá lần lấy đầu tiên của mỗi service
+        self._instances = {}     # service_name -> [instance, ...]
+        self._indexes = {}       # service_name -> Consul index
+        self._counters = {}      # service_name -> itertools.count (round robin)
+        self._outstanding = {}   # instance id -> số request đang xử lý
+        self._watchers = {}      # service_name -> thread
+
+    # ---- Consul ----
+    def _fetch(self, service_name, index=None):
+        """Gọi Consul health API, trả về (index, [instance passing])"""
+        index, entries = self._client.health.service(
+            service_name, index=index, wait=self.wait if index else None, passing=True
+        )
+        instances = []
+        for entry in entries:
+            service = entry["Service"]
+            address = service.get("Address") or entry["Node"]["Address"]
+            instances.append({
+                "id": service["ID"],
+                "address": address,
+                "port": service["Port"],
+                "url": f"http://{address}:{service['Port']}"
+            })
+        return index, instances
+
+    def _update(self, service_name, index, instances):
+        with self._lock:
+            self._indexes[service_name] = index
+            self._instances[service_name] = instances
+
+    def _watch(self, service_name):
+        while True:
+            try:
+                index, instances = self._fetch(service_name, self._indexes.get(service_name))
+                self._update(service_name, index, instances)
+            except Exception as e:
+                # Giữ nguyên bảng cũ, thử lại sau
+                print(f"[CONSUL] Watch {service_name} lỗi: {e}")
+                time.sleep(self.retry_interval)
+
+    def _ensure_watched(self, service_name):
+        if service_name in self._watchers:
+            return
+        with self._watch_lock:
+            if service_name in self._watchers:
+                return
+            # Lần đầu lấy đồng bộ để có dữ liệu ngay; chỉ công bố watcher sau khi
+            # bảng đã có dữ liệu, để request đồng thời không thấy danh sách rỗng
+            try:
+                index, instances = self._fetch(service_name)
+                self._update(service_name, index, instances)
+            except Exception as e:
+                print(f"[CONSUL] Không lấy được {service_name}: {e}")
+            thread = threading.Thread(target=self._watch, args=(service_name,), daemon=True)
+            thread.start()
+            self._watchers[service_name] = thread
+
+    # ---- Selection ----
+    def get_instances(self, service_name):
+        """Danh sách instance passing (bản sao của bảng cục bộ)"""
+        self._ensure_watched(service_name)
+        with self._lock:
+            return list(self._instances.get(service_name, []))
+
+    def _select(self, service_name):
+        instances = self.get_instances(service_name)
+        if not instances:
+            return None
+
+        with self._lock:
+            if self.strategy == "least_outstanding":
+                return min(instances, key=lambda i: self._outstanding.get(i["id"], 0))
+            counter = self._counters.setdefault(service_name, itertools.count())
+            return instances[next(counter) % len(instances)]
+
+    def acquire(self, service_name):
+        """Chọn một instance và tăng số request đang xử lý của nó"""
+        instance = self._select(service_name)
+        if instance:
+            with self._lock:
+                self._outstanding[instance["id"]] = self._outstanding.get(instance["id"], 0) + 1
+        return instance
+
+    def release(self, instance):
+        if not instance:
+            return
+        with self._lock:
+            count = self._outstanding.get(instance["id"], 0) - 1
+            if count > 0:
+                self._outstanding[instance["id"]] = count
+            else:
+                self._outstanding.pop(instance["id"], None)
+
+    @contextmanager
+    def instance(self, service_name):
+        """with discovery.instance(name) as inst: ... (tự release khi xong)"""
+        instance = self.acquire(service_name)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "services": {name: len(items) for name, items in self._instances.items()},
+                "outstanding": dict(self._outstanding)
+            }